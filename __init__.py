@@ -8,7 +8,15 @@ __appname__ = 'labelme'
 
 #import shape
 import rstools.utils
-from rstools.shape import Shape
 
 __appname__ = 'rstools'
 
+
+def __getattr__(name):
+    # Shape needs Qt, only import it when asked for so that the label
+    # file and raster code can be used headless.
+    if name == 'Shape':
+        from rstools.shape import Shape
+        return Shape
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,140 @@
+import numpy as np
+
+from rstools import utils
+
+
+SHAPE_TYPES = ['polygon', 'rectangle', 'point', 'line', 'circle', 'linestrip']
+
+
+def points_bounds(points, shape_type):
+    """(xmin, ymin, xmax, ymax) of the area of a shape with vertex array
+    `points`: the circle around its first point for circles, else the
+    vertices themselves.
+    """
+    if shape_type == 'circle' and len(points) == 2:
+        (cx, cy), (px, py) = points
+        r = np.hypot(px - cx, py - cy)
+        return (float(cx - r), float(cy - r),
+                float(cx + r), float(cy + r))
+    xmin, ymin = points.min(axis=0)
+    xmax, ymax = points.max(axis=0)
+    return float(xmin), float(ymin), float(xmax), float(ymax)
+
+
+class Annotation(object):
+
+    """Geometry and label of one shape, without any Qt dependency.
+
+    This is the compact model used to process label files headless: the
+    vertices are a single (N, 2) float64 array instead of a list of point
+    objects, and instances have no `__dict__`.  `rstools.shape.Shape`
+    converts from and to it for drawing and editing on the canvas.
+    """
+
+    __slots__ = ['label', 'points', 'shape_type', 'flags',
+                 'line_color', 'fill_color']
+
+    def __init__(self, label=None, points=None, shape_type=None, flags=None,
+                 line_color=None, fill_color=None):
+        if shape_type is None:
+            shape_type = 'polygon'
+        if shape_type not in SHAPE_TYPES:
+            raise ValueError('Unexpected shape_type: {}'.format(shape_type))
+        self.label = label
+        self.points = np.array(points if points is not None else [],
+                               dtype=np.float64).reshape(-1, 2)
+        self.shape_type = shape_type
+        self.flags = flags
+        self.line_color = line_color
+        self.fill_color = fill_color
+
+    @classmethod
+    def from_dict(cls, data):
+        """Annotation for a shape as stored in a label file."""
+        return cls(
+            label=data['label'],
+            points=data['points'],
+            shape_type=data.get('shape_type'),
+            flags=data.get('flags', {}),
+            line_color=data.get('line_color'),
+            fill_color=data.get('fill_color'),
+        )
+
+    def to_dict(self):
+        return dict(
+            label=self.label,
+            points=self.points.tolist(),
+            line_color=self.line_color,
+            fill_color=self.fill_color,
+            shape_type=self.shape_type,
+            flags=self.flags,
+        )
+
+    def copy(self):
+        return Annotation(self.label, self.points, self.shape_type,
+                          dict(self.flags) if self.flags else self.flags,
+                          self.line_color, self.fill_color)
+
+    def __len__(self):
+        return len(self.points)
+
+    def __repr__(self):
+        return '<Annotation {!r} {} with {} points>'.format(
+            self.label, self.shape_type, len(self.points))
+
+    def bounds(self):
+        """(xmin, ymin, xmax, ymax) of the area covered by the shape."""
+        return points_bounds(self.points, self.shape_type)
+
+    def move_by(self, dx, dy):
+        self.points = self.points + (dx, dy)
+
+    def nearest_vertex(self, point, epsilon):
+        return utils.nearest_vertex(self.points, point, epsilon)
+
+    def nearest_edge(self, point, epsilon):
+        return utils.nearest_edge(self.points, point, epsilon)
+
+    def contains(self, point):
+        """Whether `point` is inside the area of the shape."""
+        x, y = point
+        if self.shape_type == 'rectangle' and len(self.points) == 2:
+            xmin, ymin, xmax, ymax = self.bounds()
+            return xmin <= x <= xmax and ymin <= y <= ymax
+        if self.shape_type == 'circle' and len(self.points) == 2:
+            (cx, cy), (px, py) = self.points
+            return (x - cx) ** 2 + (y - cy) ** 2 <= \
+                (px - cx) ** 2 + (py - cy) ** 2
+        if self.shape_type != 'polygon' or len(self.points) < 3:
+            return False
+        # Even-odd crossing test over all edges at once.
+        x1, y1 = self.points[:, 0], self.points[:, 1]
+        x2, y2 = np.roll(x1, 1), np.roll(y1, 1)
+        crosses = (y1 > y) != (y2 > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xs = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        return bool(np.count_nonzero(crosses & (x < xs)) % 2)
+
+
+def _from_shapes(shapes):
+    for label, points, line_color, fill_color, shape_type, flags in shapes:
+        yield Annotation(
+            label, points, shape_type, flags, line_color, fill_color)
+
+
+def load_annotations(label_file):
+    """Annotations of the shapes of a loaded `LabelFile`."""
+    if hasattr(label_file.shapes, 'annotations'):
+        # Binary label files build them from their arrays directly.
+        return label_file.shapes.annotations()
+    return list(_from_shapes(label_file.shapes))
+
+
+def iter_annotations(filename, data=None):
+    """Annotations of a label file, one by one as the file is parsed.
+
+    See `LabelFile.iter_shapes` for `data`.
+    """
+    # Imported here, label_file uses this module for binary label files.
+    from rstools.label_file import LabelFile
+    return _from_shapes(LabelFile.iter_shapes(filename, data))
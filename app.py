@@ -1,8 +1,10 @@
 #
 #
 #
-import os.path as osp
+import concurrent.futures
 import functools
+import os
+import os.path as osp
 from PyQt5 import QtWidgets
 from qtpy import QtCore
 from PyQt5.QtCore import Qt
@@ -10,18 +12,80 @@ from PyQt5 import QtGui
 from rstools import utils
 from rstools.label_file import LabelFile
 from rstools.label_file import LabelFileError
+from rstools.annotation import iter_annotations
+from rstools.autosave import AutoSaver
+from rstools.journal import Journal
+from rstools.journal import JournalError
+from rstools.journal import file_state
+from rstools.journal import journal_filename
+from rstools.journal import read_journal
+from rstools.journal import replay
+from rstools.shape import Shape
+from rstools.prefetch import Prefetcher
+from rstools.pyramid import RasterPyramid
 #import rstools.config
 from rstools.config import get_config
 import rstools.widgets
 #from . import widgets
 from rstools.widgets import ToolBar
-from rstools.widgets import LabelQListWidget
 from rstools.widgets import Canvas
+from rstools.widgets import ShapeListView
 from rstools.widgets import ZoomWidget
 
+def load_image(filename):
+    """Decode an image file into a QImage, safe to call from any thread."""
+    # Decode once and hand the pixel buffer to Qt, the encoded bytes
+    # are only read back when they have to be embedded in a label file.
+    img_arr = LabelFile.load_image_array(filename)
+    if img_arr is None:
+        return None
+    return utils.img_arr_to_qimage(img_arr)
+
+
+def image_nbytes(image):
+    return image.bytesPerLine() * image.height()
+
+
+# Shapes of a label file are handed to the canvas in batches of this size
+# while the rest of the file is still being read.
+LABEL_BATCH_SIZE = 2000
+
+# Top-level keys of label files written from the shapes and the image,
+# the others are kept as they were read.
+LABEL_FILE_KEYS = ['version', 'shapes', 'imagePath', 'imageData', 'imageHash',
+                   'imageHeight', 'imageWidth', 'lineColor', 'fillColor',
+                   'flags']
+
+
+def shape_state(shape):
+    """What autosave needs of a shape, cheap to take on the GUI thread.
+
+    The vertex array is shared, not copied: it is replaced, never modified,
+    when the shape changes.
+    """
+    line_color = shape.__dict__.get('line_color')
+    fill_color = shape.__dict__.get('fill_color')
+    return (
+        shape.label,
+        shape.pointArray(),
+        list(line_color.getRgb()) if line_color else None,
+        list(fill_color.getRgb()) if fill_color else None,
+        shape.shape_type,
+        dict(shape.flags) if shape.flags else shape.flags,
+    )
+
+
 class MainWindow(QtWidgets.QMainWindow):
     __appname__ = "Rs tools"
     FIT_WINDOW, FIT_WIDTH, MANUAL_ZOOM = 0, 1, 2
+
+    # Emitted from loader threads with (generation, filename, future).
+    previewLoaded = QtCore.Signal(int, str, object)
+    imageLoaded = QtCore.Signal(int, str, object)
+    statisticsLoaded = QtCore.Signal(int, str, object)
+    labelsLoaded = QtCore.Signal(int, str, object)
+    # (generation, batch of shapes) while a label file is read.
+    shapesLoaded = QtCore.Signal(int, object)
     def __init__(
         self,
         config=None,
@@ -37,12 +101,17 @@ class MainWindow(QtWidgets.QMainWindow):
 
         config = get_config()
         self._config = config
-        self.labelList = LabelQListWidget()
-        self.labelList.setParent(self)
-        self.canvas = self.labelList.canvas = Canvas(
+        self.canvas = Canvas(
             epsilon=self._config['epsilon'],
+            undo_depth=self._config['undo_depth'],
+            undo_max_bytes=self._config['undo_max_bytes'],
         )
+        self.labelList = ShapeListView(self.canvas)
+        self.labelList.shapesReordered.connect(self.setDirty)
         self.canvas.zoomRequest.connect(self.zoomRequest)
+        for signal in [self.canvas.newShape, self.canvas.shapeMoved,
+                       self.canvas.shapesDeleted, self.canvas.shapesRestored]:
+            signal.connect(self.setDirty)
         scrollArea = QtWidgets.QScrollArea()
         scrollArea.setWidget(self.canvas)
         scrollArea.setWidgetResizable(True)
@@ -61,6 +130,12 @@ class MainWindow(QtWidgets.QMainWindow):
                       'Quit application')
         open_ = action('&Open', self.openFile, shortcuts['open'], 'open',
                        'Open image or label file')
+        openNextImg = action('&Next Image', self.openNextImg,
+                             shortcuts['open_next'], 'next',
+                             'Open next image', enabled=False)
+        openPrevImg = action('&Prev Image', self.openPrevImg,
+                             shortcuts['open_prev'], 'prev',
+                             'Open previous image', enabled=False)
 
         zoom = QtWidgets.QWidgetAction(self)
         zoom.setDefaultWidget(self.zoomWidget)
@@ -96,6 +171,30 @@ class MainWindow(QtWidgets.QMainWindow):
                           shortcuts['fit_width'], 'fit-width',
                           'Zoom follows window width',
                           checkable=True, enabled=False)
+        # Band combinations and contrast stretches of multiband rasters.
+        bandGroup = QtWidgets.QActionGroup(self)
+        bandActions = []
+        for bands in self._config['band_presets']:
+            a = action('Bands %s' % '-'.join(str(b) for b in bands),
+                       functools.partial(self.setBandCombination, bands),
+                       tip='Show bands %s as red, green and blue' %
+                       ', '.join(str(b) for b in bands),
+                       checkable=True, enabled=False)
+            a.setData(bands)
+            bandGroup.addAction(a)
+            bandActions.append(a)
+        stretchGroup = QtWidgets.QActionGroup(self)
+        stretchActions = []
+        for mode, text in [('none', '&No Stretch'),
+                           ('minmax', '&Min-Max Stretch'),
+                           ('percent', '&Percent Clip Stretch')]:
+            a = action(text, functools.partial(self.setStretch, mode),
+                       tip='Contrast stretch of raster bands',
+                       checkable=True, enabled=False)
+            a.setData(mode)
+            stretchGroup.addAction(a)
+            stretchActions.append(a)
+
         # Group zoom controls into a list for easier toggling.
         zoomActions = (self.zoomWidget, zoomIn, zoomOut, zoomOrg,
                        fitWindow, fitWidth)
@@ -114,8 +213,10 @@ class MainWindow(QtWidgets.QMainWindow):
             zoom=zoom, zoomIn=zoomIn, zoomOut=zoomOut, zoomOrg=zoomOrg,
             fitWindow=fitWindow, fitWidth=fitWidth,
             zoomActions=zoomActions,
+            openNextImg=openNextImg, openPrevImg=openPrevImg,
+            bandActions=bandActions, stretchActions=stretchActions,
 
-            fileMenuActions=(open_, quit),
+            fileMenuActions=(open_, openNextImg, openPrevImg, quit),
             tool=(),
             # menu shown at right click
 
@@ -131,16 +232,22 @@ class MainWindow(QtWidgets.QMainWindow):
             self.menus.file,
             (
                 open_,
+                openNextImg,
+                openPrevImg,
                 None,
                 quit,
             ),
         )
         self.menus.file.aboutToShow.connect(self.updateFileMenu)
+        utils.addActions(
+            self.menus.view, bandActions + [None] + stretchActions)
 
         self.tools = self.toolbar('Tools')
         # Menu buttons on Left
         self.actions.tool = (
             open_,
+            openNextImg,
+            openPrevImg,
             None,
             zoomIn,
             zoom,
@@ -151,6 +258,11 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.statusBar().showMessage('%s started.' % self.__appname__)
         self.statusBar().show()
+        self.loadProgress = QtWidgets.QProgressBar()
+        self.loadProgress.setRange(0, 0)  # busy indicator
+        self.loadProgress.setMaximumWidth(120)
+        self.loadProgress.hide()
+        self.statusBar().addPermanentWidget(self.loadProgress)
 
         self.output_dir = output_dir
         # Application state.
@@ -164,6 +276,38 @@ class MainWindow(QtWidgets.QMainWindow):
         self.zoom_level = 100
         self.fit_window = False
         self.filename = filename
+        self.imageList = []
+        self.bandCombination = self._config['band_combination']
+        self.stretch = self._config['stretch']['mode']
+
+        # Images around the current one in imageList are decoded ahead of
+        # time so that paging through a directory does not stall.
+        prefetch = self._config['prefetch']
+        self.prefetcher = Prefetcher(
+            load_image, image_nbytes,
+            max_bytes=prefetch['max_bytes'],
+            workers=prefetch['workers'],
+        )
+        # Files requested by the user are decoded on their own workers, so
+        # that the GUI thread never blocks on I/O or decoding.
+        self.loader = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self.loadFutures = []
+        self.loadGeneration = 0
+        self.pendingFilename = None
+        self.previewLoaded.connect(self.previewReady)
+        self.imageLoaded.connect(self.imageReady)
+        self.statisticsLoaded.connect(self.statisticsReady)
+        self.labelsLoaded.connect(self.labelsReady)
+        self.shapesLoaded.connect(self.shapesReady)
+        self.labelsLoading = False
+        # Incremented on each edit, to tell whether a save is up to date.
+        self.editCount = 0
+        self.flags = None
+        self.autoSaver = AutoSaver(
+            self.labelSnapshot, self.writeLabels,
+            delay=self._config['auto_save_delay'], parent=self)
+        self.autoSaver.finished.connect(self.labelsSaved)
+        self.journal = None
 
         # XXX: Could be completely declarative.
         # Restore application settings.
@@ -267,15 +411,15 @@ class MainWindow(QtWidgets.QMainWindow):
         h1 = self.centralWidget().height() - e
         a1 = w1 / h1
         # Calculate a new scale value based on the pixmap's aspect ratio.
-        w2 = self.canvas.pixmap.width() - 0.0
-        h2 = self.canvas.pixmap.height() - 0.0
+        w2 = self.canvas.pyramid.width() - 0.0
+        h2 = self.canvas.pyramid.height() - 0.0
         a2 = w2 / h2
         return w1 / w2 if a2 >= a1 else h1 / h2
 
     def scaleFitWidth(self):
         # The epsilon does not seem to work too well here.
         w = self.centralWidget().width() - 2.0
-        return w / self.canvas.pixmap.width()
+        return w / self.canvas.pyramid.width()
 
     def updateFileMenu(self):
         current = self.filename
@@ -296,6 +440,10 @@ class MainWindow(QtWidgets.QMainWindow):
     def mayContinue(self):
         if not self.dirty:
             return True
+        if self._config['auto_save'] and not self.labelsLoading and \
+                self.autoSaver.flush() is None:
+            # Saved up to the last edit.
+            return True
         mb = QtWidgets.QMessageBox
         msg = 'Save annotations to "{}" before closing?'.format(self.filename)
         answer = mb.question(self,
@@ -307,7 +455,8 @@ class MainWindow(QtWidgets.QMainWindow):
             return True
         elif answer == mb.Save:
             self.saveFile()
-            return True
+            # Closing or loading another image must not lose the save.
+            return not self.labelsLoading and self.autoSaver.flush() is None
         else:  # answer == mb.Cancel
             return False
 
@@ -321,6 +470,9 @@ class MainWindow(QtWidgets.QMainWindow):
         #     self.fileListWidget.repaint()
         #     return
 
+        if not self.mayContinue():
+            return False
+        self.cancelLoad()
         self.resetState()
         self.canvas.setEnabled(False)
         if filename is None:
@@ -331,13 +483,110 @@ class MainWindow(QtWidgets.QMainWindow):
                 'Error opening file', 'No such file: <b>%s</b>' % filename)
             return False
         # assumes same name, but json extension
-        self.status("Loading %s..." % osp.basename(str(filename)))
+        self.status("Loading %s..." % osp.basename(str(filename)), delay=0)
+
+        # TIFFs are mapped, tiles are read (and decoded when compressed)
+        # as they are shown.
+        reader = utils.open_mapped_raster(filename)
+        if reader is not None:
+            return self.finishLoad(filename, raster=reader)
+
+        image = self.prefetcher.cache.get(osp.abspath(filename))
+        if image is not None:
+            return self.finishLoad(filename, image)
+
+        # Decode in the background: a reduced preview is shown first when
+        # the format allows it, then swapped for the full image.
+        self.loadGeneration += 1
+        generation = self.loadGeneration
+        self.pendingFilename = filename
+        self.loadProgress.show()
+        preview = self.loader.submit(LabelFile.load_image_preview, filename)
+        preview.add_done_callback(
+            lambda f: self.previewLoaded.emit(generation, filename, f))
+        full = self.loader.submit(
+            self.prefetcher.result, osp.abspath(filename))
+        full.add_done_callback(
+            lambda f: self.imageLoaded.emit(generation, filename, f))
+        self.loadFutures = [preview, full]
+        return True
 
-        self.imageData = LabelFile.load_image_file(filename)
-        if self.imageData:
-            self.imagePath = filename
+    def cancelLoad(self):
+        """Forget the load in progress; its results will be ignored."""
+        for future in self.loadFutures:
+            future.cancel()
+        self.loadFutures = []
+        self.loadGeneration += 1
+        self.labelsLoading = False
+        self.pendingFilename = None
+        self.loadProgress.hide()
+
+    def previewReady(self, generation, filename, future):
+        if generation != self.loadGeneration or future.cancelled() or \
+                future.exception() is not None:
+            return
+        result = future.result()
+        if result is None or self.canvas.pyramid:
+            return
+        img_arr, (width, height) = result
+        self.image = utils.img_arr_to_qimage(img_arr)
+        self.canvas.loadImage(self.image, size=QtCore.QSize(width, height))
+        self.adjustScale(initial=True)
+        self.paintCanvas()
+        self.status("Loading %s... (preview)" % osp.basename(filename),
+                    delay=0)
+
+    def imageReady(self, generation, filename, future):
+        if generation != self.loadGeneration or future.cancelled():
+            return
+        self.loadFutures = []
+        self.pendingFilename = None
+        self.loadProgress.hide()
+        image = None
+        if future.exception() is None:
+            image = future.result()
+        elif isinstance(future.exception(), LabelFileError):
+            self.errorMessage('Error opening file',
+                              '<p>%s</p>' % future.exception())
+            self.status("Error reading %s" % filename)
+            return
+        self.finishLoad(filename, image)
+
+    def statisticsReady(self, generation, filename, future):
+        if generation != self.loadGeneration or future.cancelled() or \
+                future.exception() is not None or \
+                future.result() is None or \
+                not isinstance(self.canvas.pyramid, RasterPyramid):
+            return
+        self.canvas.pyramid.setStatistics(future.result())
+        self.canvas.update()
 
-        image = QtGui.QImage.fromData(self.imageData)
+    def finishLoad(self, filename, image=None, raster=None):
+        if raster is not None:
+            # Approximate statistics are enough to show the raster, exact
+            # ones are computed in the background and saved for next time.
+            stats = utils.raster_statistics(filename, raster,
+                                            approximate=True)
+            pyramid = RasterPyramid(raster, *self.rasterDisplay(),
+                                    statistics=stats)
+            if stats.approximate:
+                generation = self.loadGeneration
+                # A full pass over a large raster: it must not hold a
+                # loader thread once another file is opened.
+                future = self.loader.submit(
+                    utils.raster_statistics, filename, raster,
+                    cancelled=lambda: generation != self.loadGeneration)
+                future.add_done_callback(
+                    lambda f: self.statisticsLoaded.emit(
+                        generation, filename, f))
+                self.loadFutures.append(future)
+            # The coarsest level stands in for the image, it is mostly
+            # used for its size and as a thumbnail.
+            image = pyramid.levelImage(pyramid.numLevels() - 1)
+        if image is not None:
+            self.imagePath = filename
+        else:
+            image = QtGui.QImage()
 
         if image.isNull():
             formats = ['*.{}'.format(fmt.data().decode())
@@ -352,17 +601,330 @@ class MainWindow(QtWidgets.QMainWindow):
         self.image = image
         self.filename = filename
 
-        self.canvas.loadPixmap(QtGui.QPixmap.fromImage(image))
+        if raster is not None:
+            self.canvas.loadPyramid(pyramid)
+            self.adjustScale(initial=True)
+        elif self.canvas.pyramid:
+            # A preview is shown, keep its zoom and scroll position.
+            self.canvas.setImage(image)
+        else:
+            self.canvas.loadImage(image)
+            self.adjustScale(initial=True)
 
         self.setClean()
         self.canvas.setEnabled(True)
-        self.adjustScale(initial=True)
         self.paintCanvas()
         #self.addRecentFile(self.filename)
         self.toggleActions(True)
+        self.updateRasterActions()
+        self.updateImageList(filename)
         self.status("Loaded %s" % osp.basename(str(filename)))
+        self.loadLabels(filename)
+        return True
+
+    def labelFilename(self, filename):
+        """Existing label file of an image, or None."""
+        base = osp.splitext(filename)[0]
+        if self.output_dir:
+            base = osp.join(self.output_dir, osp.basename(base))
+        for suffix in [LabelFile.suffix, LabelFile.packed_suffix,
+                       LabelFile.binary_suffix]:
+            if osp.exists(base + suffix):
+                return base + suffix
+        return None
+
+    def loadLabels(self, filename):
+        """Read the label file of the image in the background.
+
+        Shapes are shown batch by batch as they are parsed, so that the
+        first ones appear before a large file is read completely.
+        """
+        label_file = self.labelFilename(filename)
+        if label_file is None:
+            self.openJournal()
+            return
+        # Nothing is saved until all shapes are on the canvas.
+        self.labelsLoading = True
+        generation = self.loadGeneration
+        future = self.loader.submit(
+            self.streamShapes, generation, label_file)
+        future.add_done_callback(
+            lambda f: self.labelsLoaded.emit(generation, label_file, f))
+        self.loadFutures.append(future)
+
+    def streamShapes(self, generation, label_file):
+        # Runs on a loader thread; stops early once another file is opened.
+        count = 0
+        batch = []
+        data = {}
+        for annotation in iter_annotations(label_file, data):
+            if generation != self.loadGeneration:
+                return count, data
+            batch.append(Shape.fromAnnotation(annotation))
+            if len(batch) == LABEL_BATCH_SIZE:
+                self.shapesLoaded.emit(generation, batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            self.shapesLoaded.emit(generation, batch)
+            count += len(batch)
+        return count, data
+
+    def shapesReady(self, generation, shapes):
+        if generation != self.loadGeneration:
+            return
+        self.canvas.appendShapes(shapes)
+
+    def labelsReady(self, generation, label_file, future):
+        if generation != self.loadGeneration or future.cancelled():
+            return
+        self.labelsLoading = False
+        if future.exception() is not None:
+            self.errorMessage(
+                'Error opening file',
+                '<p>Make sure <i>{0}</i> is a valid label file.</p>'
+                '<p>{1}</p>'.format(label_file, future.exception()))
+            return
+        count, data = future.result()
+        self.flags = data.get('flags')
+        self.lineColor = data.get('lineColor')
+        self.fillColor = data.get('fillColor')
+        self.otherData = {key: value for key, value in data.items()
+                          if key not in LABEL_FILE_KEYS}
+        self.status('Loaded {} shapes from {}'.format(
+            count, osp.basename(label_file)))
+        self.openJournal()
+
+    def openJournal(self):
+        """Record the edits of the current image, see rstools.journal.
+
+        Edits left in the journal by a session that ended without saving
+        them are replayed first, then saved into the label file.
+        """
+        config = self._config['journal']
+        if not config['enabled']:
+            return
+        label_file = self.saveFilename()
+        filename = journal_filename(label_file)
+        base = file_state(label_file)
+        records = []
+        if osp.exists(filename):
+            try:
+                journal_base, records = read_journal(filename)
+                if journal_base != base:
+                    raise JournalError(
+                        '{} was changed after the edits were made'.format(
+                            osp.basename(label_file)))
+                annotations = replay(records, self.canvas.annotations())
+            except (OSError, JournalError) as e:
+                # Kept aside rather than applied to the wrong shapes.
+                os.replace(filename, filename + '.old')
+                records = []
+                self.errorMessage(
+                    'Error recovering edits',
+                    '<p>Unsaved edits of <i>{0}</i> could not be restored '
+                    'and were moved to <i>{1}</i>.</p><p>{2}</p>'.format(
+                        self.filename, filename + '.old', e))
+            else:
+                if records:
+                    self.canvas.replaceShapes(
+                        [Shape.fromAnnotation(a) for a in annotations])
+                else:
+                    os.remove(filename)
+        self.journal = Journal(filename, base,
+                               sync_interval=config['sync_interval'],
+                               resume=bool(records))
+        self.canvas.journal = self.journal
+        if records:
+            self.setDirty()
+            self.autoSaver.save()
+            self.status('Recovered {} unsaved edits of {}'.format(
+                len(records), osp.basename(self.filename)))
+
+    def closeJournal(self):
+        # Only called once the edits are saved or the user discarded them.
+        if self.journal is not None:
+            self.journal.close(discard=True)
+        self.journal = self.canvas.journal = None
+
+    def setDirty(self):
+        self.dirty = True
+        self.editCount += 1
+        if self.filename is not None:
+            self.setWindowTitle('{} - {}*'.format(
+                self.__appname__, self.filename))
+        if self._config['auto_save']:
+            self.autoSaver.schedule()
+
+    def saveFilename(self):
+        """Label file of the current image, the existing one if any."""
+        label_file = self.labelFilename(self.filename)
+        if label_file is not None:
+            return label_file
+        base = osp.splitext(self.filename)[0]
+        if self.output_dir:
+            base = osp.join(self.output_dir, osp.basename(base))
+        if self._config['store_data'] == 'packed':
+            return base + LabelFile.packed_suffix
+        return base + LabelFile.suffix
+
+    def saveFile(self, _value=False):
+        """Save the shapes in the background, see AutoSaver."""
+        if self.filename is not None:
+            self.autoSaver.save()
+
+    def labelSnapshot(self):
+        # Called on the GUI thread: only references, no serialization.
+        if self.filename is None or self.canvas.pyramid is None or \
+                self.labelsLoading:
+            return None
+        return dict(
+            filename=self.saveFilename(),
+            image=self.filename,
+            edit=self.editCount,
+            shapes=[shape_state(s) for s in self.canvas.shapes],
+            imageHeight=self.canvas.pyramid.height(),
+            imageWidth=self.canvas.pyramid.width(),
+            # Mapped rasters can be huge, they are never embedded.
+            embed=self._config['store_data'] is True and
+            not isinstance(self.canvas.pyramid, RasterPyramid),
+            lineColor=self.lineColor,
+            fillColor=self.fillColor,
+            otherData=dict(self.otherData or {}),
+            flags=dict(self.flags or {}),
+            # Edits up to here are in the label file once it is written.
+            journal=self.journal,
+            journal_position=self.journal.position()
+            if self.journal is not None else 0,
+        )
+
+    def writeLabels(self, snapshot):
+        # Runs on the autosave thread.
+        filename = snapshot['filename']
+        imageData = None
+        if snapshot['embed']:
+            imageData = LabelFile.load_image_file(snapshot['image'])
+        # Converted while written, see label_file._dump.
+        shapes = (
+            dict(label=label, points=points.tolist(), line_color=line_color,
+                 fill_color=fill_color, shape_type=shape_type, flags=flags)
+            for label, points, line_color, fill_color, shape_type, flags
+            in snapshot['shapes']
+        )
+        LabelFile().save(
+            filename,
+            shapes=shapes,
+            imagePath=osp.relpath(snapshot['image'], osp.dirname(filename)),
+            imageHeight=snapshot['imageHeight'],
+            imageWidth=snapshot['imageWidth'],
+            imageData=imageData,
+            lineColor=snapshot['lineColor'],
+            fillColor=snapshot['fillColor'],
+            otherData=snapshot['otherData'],
+            flags=snapshot['flags'],
+        )
+        if snapshot['journal'] is not None:
+            snapshot['journal'].rebase(
+                snapshot['journal_position'], file_state(filename))
+
+    def labelsSaved(self, snapshot, error):
+        if error is not None:
+            self.status('Error saving {}: {}'.format(
+                osp.basename(snapshot['filename']), error))
+            return
+        if snapshot['image'] == self.filename and \
+                snapshot['edit'] == self.editCount:
+            self.setClean()
+        self.status('Saved {}'.format(osp.basename(snapshot['filename'])))
+
+    def rasterDisplay(self):
+        """Bands (0-based) and stretch for RasterPyramid from the settings."""
+        bands = None
+        if self.bandCombination:
+            bands = [b - 1 for b in self.bandCombination]
+        stretch = self._config['stretch']
+        return bands, (self.stretch, stretch['low'], stretch['high'])
+
+    def setBandCombination(self, bands, _value=False):
+        self.bandCombination = bands
+        self.updateRasterDisplay()
+
+    def setStretch(self, mode, _value=False):
+        self.stretch = mode
+        self.updateRasterDisplay()
+
+    def updateRasterDisplay(self):
+        # Only the tiles in view are rendered again.
+        self.canvas.setRasterDisplay(*self.rasterDisplay())
+        self.updateRasterActions()
+
+    def updateRasterActions(self):
+        pyramid = self.canvas.pyramid
+        raster = isinstance(pyramid, RasterPyramid)
+        for a in self.actions.bandActions:
+            bands = [b - 1 for b in a.data()]
+            a.setEnabled(raster and max(bands) < pyramid.reader.bands)
+            a.setChecked(raster and tuple(bands) == pyramid.bands)
+        for a in self.actions.stretchActions:
+            a.setEnabled(raster)
+            a.setChecked(raster and a.data() == pyramid.stretch[0])
+
+    def scanAllImages(self, folderPath):
+        extensions = ['.%s' % fmt.data().decode().lower()
+                      for fmt in QtGui.QImageReader.supportedImageFormats()]
+        images = []
+        for root, dirs, files in os.walk(folderPath):
+            for file in files:
+                if file.lower().endswith(tuple(extensions)):
+                    images.append(osp.join(root, file))
+        images.sort(key=lambda x: x.lower())
+        return images
+
+    def updateImageList(self, filename):
+        """Track the directory of `filename` and prefetch its neighbours."""
+        filename = osp.abspath(filename)
+        if filename not in self.imageList:
+            self.imageList = self.scanAllImages(osp.dirname(filename))
+        if filename not in self.imageList:
+            self.imageList = [filename]
+        index = self.imageList.index(filename)
+        prefetch = self._config['prefetch']
+        # Nearest images first, the next ones before the previous ones.
+        following = self.imageList[index + 1:index + 1 + prefetch['next']]
+        preceding = self.imageList[max(0, index - prefetch['prev']):index]
+        self.prefetcher.prefetch([
+            f for f in following + preceding[::-1] if not self.isMapped(f)])
+        self.actions.openNextImg.setEnabled(index + 1 < len(self.imageList))
+        self.actions.openPrevImg.setEnabled(index > 0)
+
+    def isMapped(self, filename):
+        reader = utils.open_mapped_raster(filename)
+        if reader is None:
+            return False
+        reader.close()
         return True
 
+    def openNextImg(self, _value=False):
+        self.openImageAt(1)
+
+    def openPrevImg(self, _value=False):
+        self.openImageAt(-1)
+
+    def openImageAt(self, step):
+        filename = self.filename or self.pendingFilename
+        if filename is None or not self.imageList:
+            return
+        filename = osp.abspath(filename)
+        if filename not in self.imageList:
+            return
+        index = self.imageList.index(filename) + step
+        if 0 <= index < len(self.imageList):
+            self.loadFile(self.imageList[index])
+
+    def errorMessage(self, title, message):
+        return QtWidgets.QMessageBox.critical(
+            self, title, '<p><b>%s</b></p>%s' % (title, message))
+
     def resetState(self):
         #self.labelList.clear()
         self.filename = None
@@ -370,6 +932,10 @@ class MainWindow(QtWidgets.QMainWindow):
         self.imageData = None
         #self.labelFile = None
         self.otherData = None
+        self.flags = None
+        self.lineColor = None
+        self.fillColor = None
+        self.closeJournal()
         self.canvas.resetState()
 
     def status(self, message, delay=5000):
@@ -436,6 +1002,12 @@ class MainWindow(QtWidgets.QMainWindow):
     def closeEvent(self, event):
         if not self.mayContinue():
             event.ignore()
+        else:
+            self.cancelLoad()
+            self.loader.shutdown(wait=False)
+            self.prefetcher.shutdown()
+            self.autoSaver.shutdown()
+            self.closeJournal()
         self.settings.setValue(
             'filename', self.filename if self.filename else '')
         self.settings.setValue('window/size', self.size())
@@ -446,20 +1018,3 @@ class MainWindow(QtWidgets.QMainWindow):
         self.settings.setValue('recentFiles', self.recentFiles)
         # ask the use for where to save the labels
         # self.settings.setValue('window/geometry', self.saveGeometry())
-
-    def mayContinue(self):
-        mb = QtWidgets.QMessageBox
-        msg = 'Save  to "{}" before closing?'.format(self.filename)
-        answer = mb.question(self,
-                             'Save annotations?',
-                             msg,
-                             mb.Save | mb.Discard | mb.Cancel,
-                             mb.Save)
-        if answer == mb.Discard:
-            return True
-        elif answer == mb.Save:
-            #self.saveFile()
-            print('OK')
-            return True
-        else:  # answer == mb.Cancel
-            return False
\ No newline at end of file
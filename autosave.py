@@ -0,0 +1,90 @@
+import concurrent.futures
+
+from PyQt5 import QtCore
+
+
+class AutoSaver(QtCore.QObject):
+
+    """Save after edits have settled, on a background thread.
+
+    `schedule` is called on every edit and restarts a single-shot timer, so
+    that a burst of edits leads to one save `delay` milliseconds after the
+    last one.  Then `snapshot()` is called on the GUI thread to capture what
+    to save, which must be cheap (references to immutable data, no
+    serialization), and `write(snapshot)` runs on a worker thread.  Saves
+    run one at a time and in order; a save due while the previous one is
+    still writing waits for it instead of queueing up.
+    """
+
+    # (snapshot, error); error is None on success.  Emitted from the
+    # worker thread, delivered on the GUI thread.
+    finished = QtCore.pyqtSignal(object, object)
+
+    def __init__(self, snapshot, write, delay=1000, parent=None):
+        super(AutoSaver, self).__init__(parent)
+        self.snapshot = snapshot
+        self.write = write
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.save)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+    def schedule(self):
+        """Save `delay` after the last call."""
+        self.timer.start()
+
+    def isPending(self):
+        return self.timer.isActive()
+
+    def cancel(self):
+        self.timer.stop()
+
+    def save(self):
+        """Take a snapshot now and write it in the background.
+
+        Returns False when the save is postponed: the previous one is still
+        writing or `snapshot()` returned None, e.g. while shapes are still
+        being loaded.
+        """
+        self.timer.stop()
+        if self.future is not None and not self.future.done():
+            self.timer.start()
+            return False
+        snapshot = self.snapshot()
+        if snapshot is None:
+            self.timer.start()
+            return False
+        self.future = self.executor.submit(self._write, snapshot)
+        return True
+
+    def _write(self, snapshot):
+        try:
+            self.write(snapshot)
+        except Exception as e:
+            self.finished.emit(snapshot, e)
+            raise
+        self.finished.emit(snapshot, None)
+
+    def wait(self):
+        """Block until the save in progress, if any, is written."""
+        if self.future is not None:
+            concurrent.futures.wait([self.future])
+
+    def flush(self):
+        """Write a pending save now and wait for it, e.g. before closing.
+
+        Returns the error of the last save, or None.
+        """
+        self.wait()
+        if self.timer.isActive() and self.save():
+            self.wait()
+        self.timer.stop()
+        if self.future is not None:
+            return self.future.exception()
+        return None
+
+    def shutdown(self):
+        self.timer.stop()
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,121 @@
+"""Compare the streaming LabelFile.load with the old json.load loader.
+
+Writes a synthetic label file with many polygons and an embedded image,
+then reports the time and the peak of traced memory of each loader.  Run
+from the directory containing the rstools package::
+
+    python -m rstools.benchmarks.bench_label_file_load --shapes 50000
+"""
+import argparse
+import base64
+import itertools
+import json
+import os
+import os.path as osp
+import shutil
+import tempfile
+import timeit
+import tracemalloc
+
+import numpy as np
+import PIL.Image
+
+from rstools.label_file import LabelFile
+
+
+def legacy_load(filename):
+    # The loader as it was before streaming: the whole file through
+    # json.load, the image decoded from base64 up front.
+    with open(filename, 'rb') as f:
+        data = json.load(f)
+    imageData = None
+    if data['imageData'] is not None:
+        imageData = base64.b64decode(data['imageData'])
+    shapes = (
+        (
+            s['label'],
+            s['points'],
+            s['line_color'],
+            s['fill_color'],
+            s.get('shape_type', 'polygon'),
+            s.get('flags', {}),
+        )
+        for s in data['shapes']
+    )
+    return list(shapes), imageData
+
+
+def streaming_load(filename):
+    label_file = LabelFile(filename)
+    return label_file.shapes, label_file.imageData
+
+
+def first_batch(filename, n=2000):
+    return list(itertools.islice(LabelFile.iter_shapes(filename), n))
+
+
+def make_label_file(filename, n_shapes, image_size, points=16):
+    rs = np.random.RandomState(0)
+    img = rs.randint(0, 256, (image_size, image_size, 3)).astype(np.uint8)
+    image_file = osp.join(osp.dirname(filename), 'scene.jpg')
+    PIL.Image.fromarray(img).save(image_file, quality=90)
+    with open(image_file, 'rb') as f:
+        imageData = f.read()
+    angles = np.linspace(0, 2 * np.pi, points, endpoint=False)
+    centers = rs.uniform(0, image_size, (n_shapes, 2))
+    radii = rs.uniform(2, 20, n_shapes)
+    shapes = []
+    for i, ((cx, cy), r) in enumerate(zip(centers, radii)):
+        xy = np.column_stack([cx + r * np.cos(angles),
+                              cy + r * np.sin(angles)])
+        shapes.append(dict(
+            label='class{}'.format(i % 10), points=xy.round(2).tolist(),
+            line_color=None, fill_color=None, shape_type='polygon',
+            flags={}))
+    LabelFile().save(filename, shapes=shapes, imagePath='scene.jpg',
+                     imageHeight=image_size, imageWidth=image_size,
+                     imageData=imageData)
+
+
+def measure(func, filename, repeat):
+    seconds = min(timeit.repeat(lambda: func(filename), number=1,
+                                repeat=repeat))
+    tracemalloc.start()
+    try:
+        func(filename)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shapes', type=int, default=50000)
+    parser.add_argument('--image-size', type=int, default=4000,
+                        help='side of the embedded noise JPEG in pixels')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filename = osp.join(tmp_dir, 'scene.json')
+        make_label_file(filename, args.shapes, args.image_size)
+        print('label file: {} shapes, {:.1f} MB'.format(
+            args.shapes, os.path.getsize(filename) / 1e6))
+        rows = [
+            ('json.load, before', legacy_load),
+            ('streaming, shapes', lambda f: LabelFile(f).shapes),
+            ('streaming, + image', streaming_load),
+            ('first 2000 shapes', first_batch),
+        ]
+        for name, func in rows:
+            seconds, peak = measure(func, filename, args.repeat)
+            print('{:<20} {:8.3f} s  peak {:8.1f} MB'.format(
+                name, seconds, peak / 1e6))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
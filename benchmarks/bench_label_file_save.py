@@ -0,0 +1,83 @@
+"""Compare LabelFile.save on a large JPEG with the old full-decode check.
+
+Run from the directory containing the rstools package::
+
+    python -m rstools.benchmarks.bench_label_file_save --size 8000
+"""
+import argparse
+import os.path as osp
+import shutil
+import tempfile
+import timeit
+
+import numpy as np
+import PIL.Image
+
+from rstools import utils
+from rstools.label_file import LabelFile
+
+
+def legacy_check_image_height_and_width(imageData, imageHeight, imageWidth):
+    # The check as it was before reading the header only: base64 round trip
+    # and full decode into an array.
+    import base64
+    img_arr = utils.img_b64_to_arr(base64.b64encode(imageData))
+    if imageHeight is not None and img_arr.shape[0] != imageHeight:
+        imageHeight = img_arr.shape[0]
+    if imageWidth is not None and img_arr.shape[1] != imageWidth:
+        imageWidth = img_arr.shape[1]
+    return imageHeight, imageWidth
+
+
+def make_jpeg(filename, size):
+    x = np.linspace(0, 255, size, dtype=np.float32)
+    img = np.dstack([
+        np.add.outer(x, x) / 2,
+        np.subtract.outer(x, x) % 256,
+        np.random.RandomState(0).randint(0, 256, (size, size)),
+    ]).astype(np.uint8)
+    PIL.Image.fromarray(img).save(filename, quality=90)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=8000,
+                        help='side of the square test image in pixels')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        image_file = osp.join(tmp_dir, 'scene.jpg')
+        make_jpeg(image_file, args.size)
+        imageData = LabelFile.load_image_file(image_file)
+        label_file = osp.join(tmp_dir, 'scene.json')
+
+        def save():
+            LabelFile().save(
+                label_file,
+                shapes=[],
+                imagePath='scene.jpg',
+                imageHeight=args.size,
+                imageWidth=args.size,
+                imageData=imageData,
+            )
+
+        print('image: {0}x{0}, {1:.1f} MB JPEG'.format(
+            args.size, len(imageData) / 1e6))
+        after = min(timeit.repeat(save, number=1, repeat=args.repeat))
+        check = LabelFile._check_image_height_and_width
+        LabelFile._check_image_height_and_width = staticmethod(
+            legacy_check_image_height_and_width)
+        try:
+            before = min(timeit.repeat(save, number=1, repeat=args.repeat))
+        finally:
+            LabelFile._check_image_height_and_width = check
+        print('save before: {:.3f} s'.format(before))
+        print('save after:  {:.3f} s ({:.1f}x)'.format(after, before / after))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Micro-benchmark of Shape.nearestVertex/nearestEdge on a long polygon.
+
+Compares the vectorized queries with the per-vertex loops they replaced,
+which called utils.distance and a numpy based utils.distancetoline for
+every vertex, and checks that both pick the same vertices and edges.
+Run from the directory containing the rstools package::
+
+    python -m rstools.benchmarks.bench_nearest_edge --vertices 2000
+"""
+import argparse
+import math
+import timeit
+
+import numpy as np
+from PyQt5 import QtCore
+
+from rstools import utils
+from rstools.shape import Shape
+
+
+def numpy_distancetoline(point, line):
+    # utils.distancetoline as it was, with small numpy arrays per call.
+    p1, p2 = line
+    p1 = np.array([p1.x(), p1.y()])
+    p2 = np.array([p2.x(), p2.y()])
+    p3 = np.array([point.x(), point.y()])
+    if np.dot((p3 - p1), (p2 - p1)) < 0:
+        return np.linalg.norm(p3 - p1)
+    if np.dot((p3 - p2), (p1 - p2)) < 0:
+        return np.linalg.norm(p3 - p2)
+    return np.linalg.norm(np.cross(p2 - p1, p1 - p3)) / np.linalg.norm(p2 - p1)
+
+
+def legacy_nearest_vertex(shape, point, epsilon):
+    min_distance = float('inf')
+    min_i = None
+    for i, p in enumerate(shape.points):
+        dist = utils.distance(p - point)
+        if dist <= epsilon and dist < min_distance:
+            min_distance = dist
+            min_i = i
+    return min_i
+
+
+def legacy_nearest_edge(shape, point, epsilon):
+    min_distance = float('inf')
+    post_i = None
+    for i in range(len(shape.points)):
+        line = [shape.points[i - 1], shape.points[i]]
+        dist = numpy_distancetoline(point, line)
+        if dist <= epsilon and dist < min_distance:
+            min_distance = dist
+            post_i = i
+    return post_i
+
+
+def make_coastline(n):
+    rand = np.random.RandomState(0)
+    angles = np.linspace(0, 2 * math.pi, n, endpoint=False)
+    radii = 1000 + np.cumsum(rand.normal(0, 5, n))
+    shape = Shape(label='coastline')
+    for a, r in zip(angles, radii):
+        shape.addPoint(QtCore.QPointF(2000 + r * math.cos(a),
+                                      2000 + r * math.sin(a)))
+    shape.close()
+    return shape
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vertices', type=int, default=2000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--epsilon', type=float, default=10.0)
+    args = parser.parse_args()
+
+    shape = make_coastline(args.vertices)
+    rand = np.random.RandomState(1)
+    queries = [QtCore.QPointF(x, y)
+               for x, y in rand.uniform(900, 3100, (args.queries, 2))]
+    queries += list(shape.points[::max(1, args.vertices // 50)])
+
+    for q in queries:
+        assert shape.nearestVertex(q, args.epsilon) == \
+            legacy_nearest_vertex(shape, q, args.epsilon)
+        assert shape.nearestEdge(q, args.epsilon) == \
+            legacy_nearest_edge(shape, q, args.epsilon)
+
+    def run(func):
+        return min(timeit.repeat(
+            lambda: [func(shape, q, args.epsilon) for q in queries],
+            number=1, repeat=3)) / len(queries) * 1e3
+
+    print('{} vertices, {} queries, results identical'.format(
+        args.vertices, len(queries)))
+    for name, legacy, method in [
+        ('nearestVertex', legacy_nearest_vertex, Shape.nearestVertex),
+        ('nearestEdge', legacy_nearest_edge, Shape.nearestEdge),
+    ]:
+        before = run(legacy)
+        after = run(method)
+        print('{:14s} loop: {:8.3f} ms  vectorized: {:6.3f} ms  ({:.0f}x)'
+              .format(name, before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+"""Compact binary label files.
+
+The same content as a 3.1 JSON label file, laid out so that it is read
+without parsing the shapes: a header, a table of the distinct labels, and
+per-shape arrays pointing into one packed array of coordinates.  All
+integers are little-endian::
+
+    header      magic 'RSLB', format version (H), coordinate item size (H),
+                number of shapes, points and labels (Q each), then the
+                (offset, length) in bytes of each section below (Q each)
+    meta        UTF-8 JSON of the top-level keys other than shapes and
+                imageData, of the shape attributes that are not defaults
+                (colors, flags, unknown keys), and of which coordinates
+                are integers in shapes that also have floats
+    label_ends  uint32 end offset of each label in label_data
+    label_data  UTF-8 labels, back to back
+    labels      uint32 label index per shape, NO_LABEL for null
+    types       uint8 index in SHAPE_TYPES per shape, NO_TYPE otherwise
+    kinds       uint8 per shape, INT_POINTS when coordinates are integers
+    ends        uint64 end of each shape in the points
+    points      (points, 2) float32 or float64 coordinates
+    image       image bytes as they are, or empty
+
+Sections start at multiples of 8 bytes so that they are mapped straight
+into numpy arrays.  Coordinates are stored as float32 only when that is
+exact for all of them, so converting from and to JSON loses nothing.
+"""
+import base64
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from rstools.annotation import SHAPE_TYPES
+from rstools.annotation import Annotation
+
+
+MAGIC = b'RSLB'
+FORMAT_VERSION = 1
+SECTIONS = ['meta', 'label_ends', 'label_data', 'labels', 'types', 'kinds',
+            'ends', 'points', 'image']
+HEADER = struct.Struct('<4sHHQQQ' + 'QQ' * len(SECTIONS))
+
+NO_LABEL = 0xffffffff
+NO_TYPE = 0xff
+INT_POINTS = 1
+
+# Shape attributes kept in the meta section only when they differ.
+SHAPE_DEFAULTS = {'line_color': None, 'fill_color': None, 'flags': {}}
+
+
+class BinaryLabelError(Exception):
+    pass
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+def _int_mask(points):
+    return [type(v) is int for point in points for v in point]
+
+
+def write_binary_label(filename, data):
+    """Write a label file dict of the 3.1 JSON schema in binary.
+
+    `imageData` may be base64 text as in JSON files, or raw bytes.
+    """
+    meta = {}
+    for key, value in data.items():
+        # Placeholders keep the position of the keys in the file.
+        meta[key] = None if key in ['shapes', 'imageData'] else value
+    shapes = list(data.get('shapes') or [])
+    label_table = {}
+    labels = np.empty(len(shapes), dtype='<u4')
+    types = np.empty(len(shapes), dtype=np.uint8)
+    kinds = np.zeros(len(shapes), dtype=np.uint8)
+    ends = np.empty(len(shapes), dtype='<u8')
+    attributes = {}
+    # Which coordinates are integers, for shapes mixing them with floats.
+    int_masks = {}
+    coords = []
+    end = 0
+    for i, shape in enumerate(shapes):
+        label = shape.get('label')
+        if label is None:
+            labels[i] = NO_LABEL
+        else:
+            labels[i] = label_table.setdefault(label, len(label_table))
+        shape_type = shape.get('shape_type', 'polygon')
+        if shape_type in SHAPE_TYPES:
+            types[i] = SHAPE_TYPES.index(shape_type)
+        else:
+            types[i] = NO_TYPE
+        points = shape.get('points') or []
+        if points:
+            mask = _int_mask(points)
+            if all(mask):
+                kinds[i] = INT_POINTS
+            elif any(mask):
+                int_masks[str(i)] = [j for j, v in enumerate(mask) if v]
+        coords.extend(points)
+        end += len(points)
+        ends[i] = end
+        extra = {}
+        for key, value in shape.items():
+            if key in ['label', 'points']:
+                continue
+            if key == 'shape_type':
+                if types[i] == NO_TYPE:
+                    extra[key] = value
+            elif key not in SHAPE_DEFAULTS or value != SHAPE_DEFAULTS[key]:
+                extra[key] = value
+        if extra:
+            attributes[str(i)] = extra
+    points = np.array(coords, dtype='<f8').reshape(-1, 2)
+    # float32 when it holds every coordinate exactly.
+    with np.errstate(over='ignore'):
+        points32 = points.astype('<f4')
+    if np.array_equal(points32.astype('<f8'), points, equal_nan=True):
+        points = points32
+    label_bytes = [label.encode('utf-8') for label in label_table]
+    label_ends = np.cumsum([len(b) for b in label_bytes], dtype='<u4') \
+        if label_bytes else np.empty(0, dtype='<u4')
+    image = data.get('imageData') or b''
+    if isinstance(image, str):
+        image = base64.b64decode(image)
+    sections = [
+        json.dumps({'data': meta, 'shapes': attributes, 'ints': int_masks},
+                   ensure_ascii=False).encode('utf-8'),
+        label_ends.tobytes(),
+        b''.join(label_bytes),
+        labels.tobytes(),
+        types.tobytes(),
+        kinds.tobytes(),
+        ends.tobytes(),
+        points.tobytes(),
+        image,
+    ]
+    table = []
+    offset = _align(HEADER.size)
+    for section in sections:
+        table.extend([offset, len(section)])
+        offset = _align(offset + len(section))
+    # Written aside and renamed: a mapped file must not be truncated under
+    # the arrays of a BinaryLabel reading it.
+    tmp_file = filename + '.tmp'
+    try:
+        with open(tmp_file, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, points.itemsize,
+                                len(shapes), len(points), len(label_table),
+                                *table))
+            for section, start in zip(sections, table[::2]):
+                f.write(b'\0' * (start - f.tell()))
+                f.write(section)
+        os.replace(tmp_file, filename)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+class BinaryLabel(object):
+
+    """Read-only view of a binary label file.
+
+    The file is mapped, and the arrays are views into the mapping: opening
+    costs the same for any number of shapes, which are only converted to
+    Python objects when accessed.  Indexing and iterating give shape tuples
+    in the same order as `LabelFile.shapes`.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise BinaryLabelError('empty file')
+        try:
+            self._parse()
+        except (ValueError, struct.error) as e:
+            self.close()
+            raise BinaryLabelError('{}: {}'.format(filename, e))
+
+    def _parse(self):
+        header = HEADER.unpack_from(self._mmap)
+        magic, version, itemsize, n_shapes, n_points, n_labels = header[:6]
+        if magic != MAGIC:
+            raise ValueError('not a binary label file')
+        if version > FORMAT_VERSION:
+            raise ValueError('unsupported format version {}'.format(version))
+        if itemsize not in [4, 8]:
+            raise ValueError('unexpected coordinate size {}'.format(itemsize))
+        sections = dict(zip(SECTIONS, zip(header[6::2], header[7::2])))
+
+        def section(name, dtype='u1', count=None):
+            offset, length = sections[name]
+            if offset + length > len(self._mmap):
+                raise ValueError('truncated {} section'.format(name))
+            array = np.frombuffer(self._mmap, dtype=dtype,
+                                  count=length // np.dtype(dtype).itemsize,
+                                  offset=offset)
+            if count is not None and len(array) != count:
+                raise ValueError('unexpected {} size'.format(name))
+            return array
+
+        meta = json.loads(section('meta').tobytes().decode('utf-8'))
+        self.data = meta['data']
+        self._attributes = {
+            int(i): value for i, value in meta['shapes'].items()}
+        self._int_masks = {
+            int(i): value for i, value in meta.get('ints', {}).items()}
+        label_ends = section('label_ends', '<u4', n_labels)
+        label_data = section('label_data').tobytes()
+        starts = [0] + label_ends[:-1].tolist()
+        self.label_names = [label_data[start:end].decode('utf-8')
+                            for start, end in zip(starts, label_ends.tolist())]
+        self.labels = section('labels', '<u4', n_shapes)
+        self.types = section('types', 'u1', n_shapes)
+        self.kinds = section('kinds', 'u1', n_shapes)
+        self.ends = section('ends', '<u8', n_shapes)
+        self.points = section(
+            'points', '<f{}'.format(itemsize), n_points * 2).reshape(-1, 2)
+        if n_shapes and self.ends[-1] != n_points:
+            raise ValueError('shapes do not end with the points')
+        self._image = sections['image']
+
+    def __len__(self):
+        return len(self.labels)
+
+    def label(self, i):
+        index = self.labels[i]
+        return None if index == NO_LABEL else self.label_names[index]
+
+    def shape_points(self, i):
+        """(N, 2) coordinates of a shape, a view into the file."""
+        start = self.ends[i - 1] if i else 0
+        return self.points[start:self.ends[i]]
+
+    def shape_type(self, i):
+        attributes = self._attributes.get(i, {})
+        if 'shape_type' in attributes:
+            return attributes['shape_type']
+        return SHAPE_TYPES[self.types[i]]
+
+    def shape(self, i):
+        """Shape dict as stored in JSON label files."""
+        points = self.shape_points(i).tolist()
+        if self.kinds[i] & INT_POINTS:
+            points = [[int(x), int(y)] for x, y in points]
+        elif i in self._int_masks:
+            for j in self._int_masks[i]:
+                points[j // 2][j % 2] = int(points[j // 2][j % 2])
+        shape = dict(
+            label=self.label(i),
+            points=points,
+            line_color=None,
+            fill_color=None,
+            shape_type=self.shape_type(i),
+            flags={},
+        )
+        shape.update(self._attributes.get(i, {}))
+        return shape
+
+    def __getitem__(self, i):
+        s = self.shape(i)
+        return (s['label'], s['points'], s['line_color'], s['fill_color'],
+                s['shape_type'], s['flags'])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def annotations(self):
+        """`Annotation` of every shape, without going through dicts."""
+        names = self.label_names + [None]
+        labels = self.labels.astype(np.int64)
+        labels[labels == NO_LABEL] = -1
+        types = [SHAPE_TYPES[t] if t != NO_TYPE else None
+                 for t in self.types.tolist()]
+        ends = self.ends.tolist()
+        annotations = []
+        start = 0
+        for i, (label, shape_type, end) in enumerate(
+                zip(labels.tolist(), types, ends)):
+            attributes = self._attributes.get(i, {})
+            annotations.append(Annotation(
+                names[label], self.points[start:end],
+                attributes.get('shape_type', shape_type),
+                attributes.get('flags', {}),
+                attributes.get('line_color'),
+                attributes.get('fill_color'),
+            ))
+            start = end
+        return annotations
+
+    def has_image(self):
+        return self._image[1] > 0
+
+    @property
+    def imageData(self):
+        offset, length = self._image
+        if not length:
+            return None
+        return self._mmap[offset:offset + length]
+
+    def to_dict(self):
+        """The label file as a dict of the 3.1 JSON schema."""
+        data = dict(self.data)
+        data['shapes'] = [self.shape(i) for i in range(len(self))]
+        imageData = self.imageData
+        if imageData is not None:
+            data['imageData'] = base64.b64encode(imageData).decode('utf-8')
+        return data
+
+    def close(self):
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Arrays still refer to the mapping, it goes away with them.
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
@@ -0,0 +1,179 @@
+"""Cut annotated images into fixed-size training chips.
+
+Each chip is a window of the image, read on its own so that a scene is
+never decoded whole when it is a mapped TIFF, with the shapes clipped to
+it.  Shapes are found per chip through a `utils.GridIndex` of their
+bounds.  A chip is written as an image next to its labels: a label file
+with the clipped shapes, or a class mask.
+
+Chips are exported on a process pool from `rstools.cli chips`.
+"""
+import functools
+import io
+import os
+import os.path as osp
+
+import numpy as np
+import PIL.Image
+
+from rstools import utils
+from rstools.annotation import Annotation
+from rstools.annotation import load_annotations
+from rstools.label_file import LabelFile
+
+
+def chip_windows(height, width, size, overlap=0):
+    """(x, y) of the top left corner of chips of `size` covering an image.
+
+    Chips are `size - overlap` apart; the last ones of a row or column
+    are moved back to end on the edge of the image, so that no chip
+    sticks out of an image at least `size` wide and high.
+    """
+    stride = size - overlap
+    if stride <= 0:
+        raise ValueError('overlap must be smaller than the chip size')
+
+    def starts(n):
+        if n <= size:
+            return [0]
+        s = list(range(0, n - size + 1, stride))
+        if s[-1] != n - size:
+            s.append(n - size)
+        return s
+
+    return [(x, y) for y in starts(height) for x in starts(width)]
+
+
+def clip_annotation(annotation, box):
+    """Parts of an annotation inside `box`, in coordinates of the box.
+
+    Polygons, rectangles, lines and linestrips are cut at the box, a
+    linestrip possibly in several pieces; circles and points are kept
+    whole when their center is inside.
+    """
+    x1, y1, x2, y2 = box
+    a = annotation
+    points = a.points
+    shape_type = a.shape_type
+    if shape_type == 'polygon':
+        points = utils.clip_polygon(points, box)
+        parts = [points] if len(points) >= 3 else []
+    elif shape_type == 'rectangle':
+        if len(points) != 2:
+            return []
+        lo = np.maximum(points.min(axis=0), [x1, y1])
+        hi = np.minimum(points.max(axis=0), [x2, y2])
+        parts = [np.array([lo, hi])] if (hi > lo).all() else []
+    elif shape_type in ['line', 'linestrip']:
+        parts = utils.clip_polyline(points, box)
+    else:
+        center = points[0] if len(points) else None
+        inside = center is not None and \
+            x1 <= center[0] <= x2 and y1 <= center[1] <= y2
+        parts = [points] if inside else []
+    return [Annotation(a.label, part - [x1, y1], shape_type,
+                       dict(a.flags) if a.flags else a.flags,
+                       a.line_color, a.fill_color)
+            for part in parts]
+
+
+class Scene(object):
+
+    """Image and shapes of a label file, to read chips from."""
+
+    def __init__(self, filename):
+        label_file = LabelFile(filename)
+        self.filename = filename
+        self.height, self.width = label_file.image_size()
+        self.annotations = load_annotations(label_file)
+        if label_file.imageFile is not None:
+            # Mapped when it is an uncompressed TIFF.
+            self.reader = utils.open_raster(label_file.imageFile)
+        else:
+            image = PIL.Image.open(io.BytesIO(label_file.imageData))
+            self.reader = utils.ArrayReader(
+                np.asarray(utils.apply_exif_orientation(image)))
+        self.index = utils.GridIndex(cell_size=512)
+        for i, a in enumerate(self.annotations):
+            if len(a):
+                self.index.insert(i, a.bounds())
+
+    def chip(self, x, y, size):
+        """(size, size, bands) pixels of a chip, zero outside the image."""
+        pixels = self.reader.read_window(x, y, size, size)
+        if pixels.shape[:2] == (size, size):
+            return pixels
+        chip = np.zeros((size, size, pixels.shape[2]), dtype=pixels.dtype)
+        chip[:pixels.shape[0], :pixels.shape[1]] = pixels
+        return chip
+
+    def chip_annotations(self, x, y, size):
+        box = (x, y, x + size, y + size)
+        annotations = []
+        for i in self.index.query(box):
+            annotations.extend(clip_annotation(self.annotations[i], box))
+        return annotations
+
+
+@functools.lru_cache(maxsize=1)
+def open_scene(filename):
+    # Tasks of the same file follow each other: each worker process only
+    # keeps the scene it is working on.
+    return Scene(filename)
+
+
+def write_image(filename, pixels):
+    """Write a chip as PNG when it fits, as .npy otherwise.
+
+    PNG holds 8-bit images with 1, 3 or 4 bands; other images, e.g. 16-bit
+    multispectral ones, are saved as arrays.  Returns the file written.
+    """
+    if pixels.dtype == np.uint8 and pixels.shape[2] in [1, 3, 4]:
+        filename += '.png'
+        # Fastest compression: imagery hardly compresses any better.
+        PIL.Image.fromarray(
+            pixels[:, :, 0] if pixels.shape[2] == 1 else pixels
+        ).save(filename, compress_level=1)
+    else:
+        filename += '.npy'
+        np.save(filename, pixels)
+    return filename
+
+
+def export_chips(filename, windows, size, output_dir, root,
+                 output_format='json', label_name_to_value=None,
+                 skip_empty=False):
+    """Write the chips of a label file at `windows`, (x, y) corners.
+
+    Files are named after the label file, relative to `root`, and the
+    chip corner: <name>_<x>_<y>.png with <name>_<x>_<y>.json, or
+    <name>_<x>_<y>_mask.png for masks.  Returns the number of chips
+    written.
+    """
+    scene = open_scene(filename)
+    base = osp.splitext(osp.join(output_dir, osp.relpath(filename, root)))[0]
+    if not osp.exists(osp.dirname(base)):
+        os.makedirs(osp.dirname(base), exist_ok=True)
+    written = 0
+    for x, y in windows:
+        annotations = scene.chip_annotations(x, y, size)
+        if skip_empty and not annotations:
+            continue
+        name = '{}_{}_{}'.format(base, x, y)
+        image_file = write_image(name, scene.chip(x, y, size))
+        if output_format == 'mask':
+            cls, _ = utils.rasterize_masks(
+                annotations, label_name_to_value, size, size)
+            PIL.Image.fromarray(cls.astype(
+                np.uint8 if cls.max(initial=0) < 256 else np.uint16)
+            ).save(name + '_mask.png')
+        else:
+            LabelFile().save(
+                name + LabelFile.suffix,
+                shapes=[a.to_dict() for a in annotations],
+                imagePath=osp.basename(image_file),
+                imageHeight=size,
+                imageWidth=size,
+            )
+        written += 1
+    return written
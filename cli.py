@@ -0,0 +1,684 @@
+"""Headless batch processing of label files over directory trees.
+
+Nothing here imports Qt, so it runs on servers without a display::
+
+    python -m rstools.cli validate DIR
+    python -m rstools.cli stats DIR
+    python -m rstools.cli convert DIR -o OUT --image-data strip
+    python -m rstools.cli convert DIR -o OUT --binary
+    python -m rstools.cli rasterize DIR -o OUT --labels labels.txt
+    python -m rstools.cli rasterize DIR -o OUT --labels labels.txt \\
+        --format npy --instances
+    python -m rstools.cli chips DIR -o OUT --size 512 --overlap 64
+    python -m rstools.cli export DIR -o coco.json --labels labels.txt
+    python -m rstools.cli export DIR -o shapes.geojson --format geojson
+    python -m rstools.cli import coco.json -o DIR --image-dir IMAGES
+
+Files are processed on a pool of processes, one per available core by
+default.  Per-file results are written to stdout as they come in and a
+summary with the throughput to stderr.
+"""
+import argparse
+import collections
+import concurrent.futures
+import functools
+import os
+import os.path as osp
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import PIL.Image
+
+from rstools import converters
+from rstools import utils
+from rstools.annotation import load_annotations
+from rstools.chips import chip_windows
+from rstools.chips import export_chips
+from rstools.label_file import LabelFile
+from rstools.label_file import LabelFileError
+
+
+# Number of points each shape type needs, as (minimum, maximum).
+SHAPE_POINTS = {
+    'polygon': (3, None),
+    'rectangle': (2, 2),
+    'circle': (2, 2),
+    'line': (2, 2),
+    'linestrip': (2, None),
+    'point': (1, 1),
+}
+
+
+def cpu_count():
+    """Cores this process may run on."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def find_label_files(root):
+    """Label files under `root` in a stable order, or `root` if a file."""
+    if not osp.isdir(root):
+        yield root
+        return
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if LabelFile.is_label_file(filename):
+                yield osp.join(dirpath, filename)
+
+
+def shape_dicts(label_file):
+    return [
+        dict(label=label, points=points, line_color=line_color,
+             fill_color=fill_color, shape_type=shape_type, flags=flags)
+        for label, points, line_color, fill_color, shape_type, flags
+        in label_file.shapes
+    ]
+
+
+def check_shape(shape):
+    """Problem with a shape of a label file, or None if it is valid."""
+    shape_type = shape['shape_type'] or 'polygon'
+    if shape_type not in SHAPE_POINTS:
+        return 'unknown shape_type {!r}'.format(shape_type)
+    points = shape['points']
+    try:
+        if any(len(point) != 2 for point in points) or \
+                not np.isfinite(np.asarray(points, dtype=float)).all():
+            return 'points are not finite (x, y) pairs'
+    except (TypeError, ValueError):
+        return 'points are not finite (x, y) pairs'
+    n_min, n_max = SHAPE_POINTS[shape_type]
+    if len(points) < n_min or (n_max is not None and len(points) > n_max):
+        return '{} with {} points'.format(shape_type, len(points))
+    return None
+
+
+# Workers: module level functions so they can be sent to the processes.
+# Each one returns (filename, error, result) and never raises for a bad
+# file, so that one broken file does not stop the batch.
+
+def validate_file(filename):
+    try:
+        label_file = LabelFile(filename)
+        shapes = shape_dicts(label_file)
+        # Reads referenced images and checks their content hash.
+        label_file.verify_image()
+    except LabelFileError as e:
+        return filename, str(e), None
+    problems = []
+    for i, shape in enumerate(shapes):
+        problem = check_shape(shape)
+        if problem is not None:
+            problems.append('shape {} ({}): {}'.format(
+                i, shape['label'], problem))
+    return filename, '; '.join(problems) or None, len(shapes)
+
+
+def stats_file(filename):
+    try:
+        annotations = load_annotations(LabelFile(filename))
+    except (LabelFileError, ValueError) as e:
+        return filename, str(e), None
+    labels = collections.Counter(a.label for a in annotations)
+    types = collections.Counter(a.shape_type for a in annotations)
+    points = sum(len(a) for a in annotations)
+    return filename, None, (labels, types, points)
+
+
+def convert_file(filename, root, output_dir, image_data, binary=False):
+    out_file = osp.join(output_dir, osp.relpath(filename, root))
+    if image_data == 'pack':
+        suffix = LabelFile.packed_suffix
+    elif binary:
+        suffix = LabelFile.binary_suffix
+    else:
+        suffix = LabelFile.suffix
+    out_file = osp.splitext(out_file)[0] + suffix
+    out_dir = osp.dirname(out_file)
+    try:
+        label_file = LabelFile(filename)
+        height, width = label_file.image_size()
+        data = None
+        if label_file.imageFile is not None:
+            # Keep pointing at the same image from the new location.
+            image_path = osp.relpath(label_file.imageFile, out_dir)
+        else:
+            image_path = osp.basename(label_file.imagePath)
+        if image_data == 'embed' or label_file.imageFile is None:
+            data = label_file.imageData
+            if data is None:
+                raise LabelFileError(
+                    'Failed opening image file: {}'.format(image_path))
+        if not osp.exists(out_dir):
+            os.makedirs(out_dir, exist_ok=True)
+        if image_data == 'strip' and data is not None:
+            # Embedded or packed image, write it beside the label file.
+            with open(osp.join(out_dir, image_path), 'wb') as f:
+                f.write(data)
+            data = None
+        LabelFile().save(
+            out_file,
+            shapes=shape_dicts(label_file),
+            imagePath=image_path,
+            imageHeight=height,
+            imageWidth=width,
+            imageData=data,
+            lineColor=label_file.lineColor,
+            fillColor=label_file.fillColor,
+            otherData=label_file.otherData,
+            flags=label_file.flags,
+        )
+    except (LabelFileError, IOError, OSError) as e:
+        return filename, str(e), None
+    return filename, None, out_file
+
+
+def rasterize_file(filename, root, output_dir, label_name_to_value,
+                   output_format='png', instances=False, tile_size=1024):
+    base = osp.splitext(osp.join(output_dir, osp.relpath(filename, root)))[0]
+    out_file = base + '.' + output_format
+    instance_file = base + '_instances.' + output_format \
+        if instances else None
+    try:
+        label_file = LabelFile(filename)
+        height, width = label_file.image_size()
+        annotations = load_annotations(label_file)
+        if not osp.exists(osp.dirname(out_file)):
+            os.makedirs(osp.dirname(out_file), exist_ok=True)
+        if output_format == 'npy':
+            # Written band by band, never held whole in memory.
+            utils.write_masks(annotations, label_name_to_value, height,
+                              width, out_file, instance_file,
+                              tile_size=tile_size)
+        else:
+            cls, inst = utils.rasterize_masks(
+                annotations, label_name_to_value, height, width,
+                instances=instances, tile_size=tile_size)
+            PIL.Image.fromarray(cls.astype(
+                np.uint8 if cls.max(initial=0) < 256 else np.uint16)
+            ).save(out_file)
+            if instances:
+                # PNG holds up to 16 bits.
+                if inst.max(initial=0) > 65535:
+                    raise ValueError('too many shapes for an instance PNG, '
+                                     'use --format npy')
+                PIL.Image.fromarray(inst.astype(np.uint16)).save(
+                    instance_file)
+    except (LabelFileError, IOError, OSError, ValueError) as e:
+        return filename, str(e), None
+    return filename, None, out_file
+
+
+def chips_task(task, **kwargs):
+    filename, windows = task
+    try:
+        n_chips = export_chips(filename, windows, **kwargs)
+    except (LabelFileError, utils.RasterError, IOError, OSError,
+            ValueError) as e:
+        return filename, str(e), None
+    return filename, None, n_chips
+
+
+def iter_chip_tasks(filenames, size, overlap, chips_per_task=16):
+    """(filename, windows) tasks of a few chips of each label file.
+
+    Only the image size is needed here; large scenes are split over all
+    the workers.  Files that cannot be read give one task with no chips,
+    for the worker to report the error.
+    """
+    for filename in filenames:
+        try:
+            height, width = LabelFile(filename).image_size()
+        except LabelFileError:
+            yield filename, []
+            continue
+        windows = chip_windows(height, width, size, overlap)
+        for i in range(0, len(windows), chips_per_task):
+            yield filename, windows[i:i + chips_per_task]
+
+
+def export_task(filenames, output_format, root, category_ids=None):
+    """Encoded entries of a batch of label files, see `converters`."""
+    results = []
+    for filename in filenames:
+        try:
+            if output_format == 'coco':
+                entry = converters.coco_entry(filename, root, category_ids)
+            else:
+                entry = converters.geojson_entry(filename, root)
+        except (LabelFileError, IOError, OSError, ValueError) as e:
+            results.append((filename, str(e), None))
+            continue
+        results.append((filename, None, entry))
+    return results
+
+
+def import_task(task, output_dir, image_dir, labels=None):
+    spool_file, images = task
+    return converters.write_label_files(
+        spool_file, images, output_dir, image_dir, labels)
+
+
+def iter_batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run(worker, filenames, jobs):
+    """Apply `worker` to the files, yielding results in order as they come.
+
+    With more than one job the files are spread over a process pool, in
+    chunks to keep the per-file overhead low.
+    """
+    if jobs <= 1:
+        for filename in filenames:
+            yield worker(filename)
+        return
+    filenames = list(filenames)
+    chunksize = max(1, min(64, len(filenames) // (jobs * 4)))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        for result in pool.map(worker, filenames, chunksize=chunksize):
+            yield result
+
+
+def run_bounded(worker, tasks, jobs, pending=4):
+    """Like `run` for tasks produced lazily, yielding results in order.
+
+    At most `pending` tasks per process are submitted ahead, so that
+    neither the tasks nor their results pile up in memory.
+    """
+    if jobs <= 1:
+        for task in tasks:
+            yield worker(task)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = collections.deque()
+        for task in tasks:
+            futures.append(pool.submit(worker, task))
+            if len(futures) >= jobs * pending:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+class Progress(object):
+
+    """Count processed files and errors, report the throughput to stderr."""
+
+    def __init__(self, command, stream=sys.stderr, unit='files'):
+        self.command = command
+        self.stream = stream
+        self.unit = unit
+        self.files = 0
+        self.errors = 0
+        self.start = time.time()
+        self._last = self.start
+
+    def update(self, error, count=1):
+        self.files += count
+        if error is not None:
+            self.errors += 1
+        now = time.time()
+        if self.stream.isatty() and now - self._last >= 1:
+            self._last = now
+            self.stream.write('\r{0}: {1} {3} ({2:.1f} {3}/s)'.format(
+                self.command, self.files, self.rate(), self.unit))
+            self.stream.flush()
+
+    def rate(self):
+        return self.files / max(time.time() - self.start, 1e-9)
+
+    def summary(self):
+        if self.stream.isatty():
+            self.stream.write('\r')
+        self.stream.write(
+            '{0}: {1} {5} in {2:.2f} s ({3:.1f} {5}/s), {4} errors\n'.format(
+                self.command, self.files, time.time() - self.start,
+                self.rate(), self.errors, self.unit))
+
+
+def cmd_validate(args):
+    progress = Progress('validate')
+    for filename, error, n_shapes in run(
+            validate_file, find_label_files(args.input), args.jobs):
+        progress.update(error)
+        if error is not None:
+            print('{}: {}'.format(filename, error))
+        elif args.verbose:
+            print('{}: ok, {} shapes'.format(filename, n_shapes))
+    progress.summary()
+    return 1 if progress.errors else 0
+
+
+def cmd_stats(args):
+    progress = Progress('stats')
+    labels = collections.Counter()
+    types = collections.Counter()
+    points = 0
+    for filename, error, result in run(
+            stats_file, find_label_files(args.input), args.jobs):
+        progress.update(error)
+        if error is not None:
+            print('{}: {}'.format(filename, error), file=sys.stderr)
+            continue
+        labels.update(result[0])
+        types.update(result[1])
+        points += result[2]
+    print('files\t{}'.format(progress.files - progress.errors))
+    print('shapes\t{}'.format(sum(labels.values())))
+    print('points\t{}'.format(points))
+    for shape_type, count in types.most_common():
+        print('shape_type:{}\t{}'.format(shape_type, count))
+    for label, count in labels.most_common():
+        print('label:{}\t{}'.format(label, count))
+    progress.summary()
+    return 1 if progress.errors else 0
+
+
+def _mirror(args, worker, command):
+    progress = Progress(command)
+    for filename, error, out_file in run(
+            worker, find_label_files(args.input), args.jobs):
+        progress.update(error)
+        if error is not None:
+            print('{}: {}'.format(filename, error), file=sys.stderr)
+        else:
+            print(out_file)
+    progress.summary()
+    return 1 if progress.errors else 0
+
+
+def cmd_convert(args):
+    root = args.input if osp.isdir(args.input) else osp.dirname(args.input)
+    worker = functools.partial(
+        convert_file, root=root, output_dir=args.output,
+        image_data=args.image_data, binary=args.binary)
+    return _mirror(args, worker, 'convert')
+
+
+def read_label_names(filename):
+    """Class values of the labels listed in a file, one per line.
+
+    Values are line numbers starting at 1, or at 0 when the first line is
+    `_background_`; a `__ignore__` line is skipped.
+    """
+    with open(filename) as f:
+        names = [line.strip() for line in f]
+    names = [name for name in names if name and name != '__ignore__']
+    start = 0 if names and names[0] == '_background_' else 1
+    return {name: i for i, name in enumerate(names, start)}
+
+
+def cmd_rasterize(args):
+    root = args.input if osp.isdir(args.input) else osp.dirname(args.input)
+    worker = functools.partial(
+        rasterize_file, root=root, output_dir=args.output,
+        label_name_to_value=read_label_names(args.labels),
+        output_format=args.format, instances=args.instances,
+        tile_size=args.tile_size)
+    return _mirror(args, worker, 'rasterize')
+
+
+def cmd_chips(args):
+    root = args.input if osp.isdir(args.input) else osp.dirname(args.input)
+    label_name_to_value = None
+    if args.format == 'mask':
+        label_name_to_value = read_label_names(args.labels)
+    worker = functools.partial(
+        chips_task, size=args.size, output_dir=args.output, root=root,
+        output_format=args.format, label_name_to_value=label_name_to_value,
+        skip_empty=args.skip_empty)
+    tasks = iter_chip_tasks(find_label_files(args.input), args.size,
+                            args.overlap)
+    progress = Progress('chips', unit='chips')
+    for filename, error, n_chips in run_bounded(worker, tasks, args.jobs):
+        if error is not None:
+            progress.update(error, 0)
+            print('{}: {}'.format(filename, error), file=sys.stderr)
+        else:
+            progress.update(None, n_chips)
+    progress.summary()
+    return 1 if progress.errors else 0
+
+
+def cmd_export(args):
+    root = args.input if osp.isdir(args.input) else osp.dirname(args.input)
+    out_dir = osp.dirname(osp.abspath(args.output))
+    if not osp.exists(out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+    if args.format == 'coco':
+        label_name_to_value = read_label_names(args.labels)
+        # The same table for every file, computed once.
+        category_ids = {name: value
+                        for name, value in label_name_to_value.items()
+                        if value > 0}
+        writer = converters.CocoWriter(
+            args.output, converters.coco_categories(label_name_to_value))
+    else:
+        category_ids = None
+        writer = converters.GeoJSONWriter(args.output)
+    worker = functools.partial(
+        export_task, output_format=args.format, root=root,
+        category_ids=category_ids)
+    # Batches of files keep the per-task overhead of the pool low.
+    batches = iter_batches(find_label_files(args.input), 64)
+    progress = Progress('export')
+    skipped = 0
+    with writer:
+        for results in run_bounded(worker, batches, args.jobs):
+            for filename, error, entry in results:
+                progress.update(error)
+                if error is not None:
+                    print('{}: {}'.format(filename, error), file=sys.stderr)
+                    continue
+                writer.add(*entry[:-1])
+                skipped += entry[-1]
+    if skipped:
+        print('export: {} shapes skipped, {}'.format(
+            skipped, 'without area or label not in --labels'
+            if args.format == 'coco' else 'with too few points'),
+            file=sys.stderr)
+    print(args.output)
+    progress.summary()
+    return 1 if progress.errors else 0
+
+
+def spool_dataset(filename, output_format, spool):
+    """Spool the shapes of a dataset by image.
+
+    Returns the images by key, None for GeoJSON, the label names of the
+    spooled labels, and the number of entries that were not converted.
+    """
+    images = {} if output_format == 'coco' else None
+    labels = {} if output_format == 'coco' else None
+    unsupported = 0
+    with open(filename, 'rb') as f:
+        if output_format == 'coco':
+            for kind, value in converters.iter_coco(f):
+                if kind == 'annotation':
+                    shapes = converters.coco_shapes(value)
+                    if shapes is None:
+                        unsupported += 1
+                        continue
+                    for shape in shapes:
+                        spool.add(value['image_id'], shape)
+                elif kind == 'image':
+                    images[value['id']] = dict(
+                        file_name=value['file_name'],
+                        height=value.get('height'),
+                        width=value.get('width'))
+                elif kind == 'category':
+                    labels[value['id']] = value['name']
+        else:
+            for feature in converters.iter_features(f):
+                image = (feature.get('properties') or {}).get('image')
+                if image is None:
+                    unsupported += 1
+                    continue
+                for shape in converters.feature_shapes(feature):
+                    spool.add(image, shape)
+    return images, labels, unsupported
+
+
+def cmd_import(args):
+    image_dir = args.image_dir or osp.dirname(osp.abspath(args.input))
+    if not osp.exists(args.output):
+        os.makedirs(args.output, exist_ok=True)
+    progress = Progress('import')
+    spool_dir = tempfile.mkdtemp(prefix='.import-', dir=args.output)
+    try:
+        spool = converters.ShapeSpool(spool_dir)
+        try:
+            images, labels, unsupported = spool_dataset(
+                args.input, args.format, spool)
+        except (utils.JSONStreamError, IOError, OSError, KeyError,
+                TypeError, ValueError) as e:
+            print('{}: {}'.format(args.input, e), file=sys.stderr)
+            return 1
+        finally:
+            spool.close()
+        if unsupported:
+            print('import: {} entries skipped, {}'.format(
+                unsupported, 'with run-length encoded masks'
+                if args.format == 'coco' else 'without an image property'),
+                file=sys.stderr)
+        parts = spool.partition(images) if images is not None \
+            else [None] * spool.buckets
+        tasks = [(spool.filename(i), parts[i]) for i in range(spool.buckets)]
+        worker = functools.partial(
+            import_task, output_dir=args.output, image_dir=image_dir,
+            labels=labels)
+        for results in run_bounded(worker, tasks, args.jobs):
+            for out_file, error, n_shapes in results:
+                progress.update(error)
+                if error is not None:
+                    print('{}: {}'.format(out_file, error), file=sys.stderr)
+                else:
+                    print(out_file)
+    finally:
+        shutil.rmtree(spool_dir)
+    progress.summary()
+    return 1 if progress.errors else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='rstools.cli', description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=cpu_count(),
+        help='worker processes (default: %(default)s, the available cores)')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    p = subparsers.add_parser('validate', help='check label files')
+    p.add_argument('input', help='label file or directory')
+    p.add_argument('-v', '--verbose', action='store_true',
+                   help='also list the valid files')
+    p.set_defaults(func=cmd_validate)
+
+    p = subparsers.add_parser(
+        'stats', help='count shapes per label and shape type')
+    p.add_argument('input', help='label file or directory')
+    p.set_defaults(func=cmd_stats)
+
+    p = subparsers.add_parser(
+        'convert', help='rewrite label files into another directory')
+    p.add_argument('input', help='label file or directory')
+    p.add_argument('-o', '--output', required=True, help='output directory')
+    p.add_argument('--image-data', choices=['strip', 'embed', 'pack'],
+                   default='strip',
+                   help='reference the image by path and content hash, '
+                   'embed it in base64, or pack it uncompressed with the '
+                   'label file in a %s archive' % LabelFile.packed_suffix)
+    p.add_argument('--binary', action='store_true',
+                   help='write binary %s label files, which load without '
+                   'parsing; an embedded image is stored as it is, not in '
+                   'base64' % LabelFile.binary_suffix)
+    p.set_defaults(func=cmd_convert)
+
+    p = subparsers.add_parser(
+        'rasterize', help='write a class label mask per label file')
+    p.add_argument('input', help='label file or directory')
+    p.add_argument('-o', '--output', required=True, help='output directory')
+    p.add_argument('--labels', required=True,
+                   help='file listing the label names, one per line')
+    p.add_argument('--format', choices=['png', 'npy'], default='png',
+                   help='npy masks are written band by band, for images '
+                   'too large to hold in memory')
+    p.add_argument('--instances', action='store_true',
+                   help='also write a mask numbering the shapes, '
+                   '<name>_instances.<format>')
+    p.add_argument('--tile-size', type=int, default=1024,
+                   help='side in pixels of the squares rasterized at once')
+    p.set_defaults(func=cmd_rasterize)
+
+    p = subparsers.add_parser(
+        'chips', help='cut images and their shapes into training chips')
+    p.add_argument('input', help='label file or directory')
+    p.add_argument('-o', '--output', required=True, help='output directory')
+    p.add_argument('--size', type=int, default=512,
+                   help='side of the chips in pixels (default: %(default)s)')
+    p.add_argument('--overlap', type=int, default=0,
+                   help='pixels shared by neighbouring chips')
+    p.add_argument('--format', choices=['json', 'mask'], default='json',
+                   help='write the clipped shapes in a label file per chip, '
+                   'or a class mask PNG')
+    p.add_argument('--labels',
+                   help='file listing the label names, one per line, '
+                   'required for masks')
+    p.add_argument('--skip-empty', action='store_true',
+                   help='do not write chips without shapes')
+    p.set_defaults(func=cmd_chips)
+
+    p = subparsers.add_parser(
+        'export', help='write all label files as one COCO or GeoJSON file')
+    p.add_argument('input', help='label file or directory')
+    p.add_argument('-o', '--output', required=True, help='output file')
+    p.add_argument('--format', choices=['coco', 'geojson'], default='coco',
+                   help='COCO instances, with the label names as categories, '
+                   'or a GeoJSON FeatureCollection in pixel coordinates')
+    p.add_argument('--labels',
+                   help='file listing the label names, one per line, '
+                   'required for COCO; their numbers are the category ids')
+    p.set_defaults(func=cmd_export)
+
+    p = subparsers.add_parser(
+        'import', help='write label files of a COCO or GeoJSON file')
+    p.add_argument('input', help='COCO or GeoJSON file')
+    p.add_argument('-o', '--output', required=True, help='output directory')
+    p.add_argument('--format', choices=['coco', 'geojson'], default='coco')
+    p.add_argument('--image-dir',
+                   help='directory the image paths are relative to '
+                   '(default: the directory of the input file)')
+    p.set_defaults(func=cmd_import)
+
+    args = parser.parse_args(argv)
+    if args.command == 'chips':
+        if args.format == 'mask' and not args.labels:
+            parser.error('--format mask requires --labels')
+        if not 0 <= args.overlap < args.size:
+            parser.error('--overlap must be between 0 and --size')
+    if args.command == 'export' and args.format == 'coco' and \
+            not args.labels:
+        parser.error('--format coco requires --labels')
+    if getattr(args, 'binary', False) and args.image_data == 'pack':
+        parser.error('--binary cannot be used with --image-data pack')
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    # Run the imported module, not __main__, so that the workers sent to
+    # the pool are found by name in the child processes.
+    from rstools import cli
+    sys.exit(cli.main())
@@ -53,6 +53,16 @@ def validate_config_item(key, value):
         raise ValueError(
             "Duplicates are detected for config key 'labels': {}".format(value)
         )
+    if key == 'store_data' and value not in [True, False, 'packed']:
+        raise ValueError(
+            "Unexpected value for config key 'store_data': {}".format(value)
+        )
+    if key == 'stretch' and isinstance(value, dict) and 'mode' in value \
+            and value['mode'] not in ['none', 'minmax', 'percent']:
+        raise ValueError(
+            "Unexpected value for config key 'stretch.mode': {}"
+            .format(value['mode'])
+        )
 
 
 def get_config(config_from_args=None, config_file=None):
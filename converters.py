@@ -0,0 +1,442 @@
+"""Conversion of label files from and to COCO and GeoJSON datasets.
+
+A whole directory tree of label files becomes one COCO instance dataset
+or one GeoJSON FeatureCollection, and back.  Neither side is ever held
+in memory whole:
+
+- Export encodes the entries of each label file on its own, e.g. in a
+  worker process, and a writer appends them to the dataset as they come.
+  Annotation ids are only known in order, so the COCO entries are encoded
+  without them and completed by the writer with a string format.
+- Import parses the dataset incrementally and spools the shapes to
+  temporary files, bucketed by image, since the annotations of an image
+  may be anywhere in the file.  Each bucket then fits in memory and is
+  written out as label files on its own, e.g. by a worker process.
+
+Coordinates are image pixels in both formats.
+"""
+import json
+import os
+import os.path as osp
+import shutil
+
+import numpy as np
+
+from rstools import utils
+from rstools.annotation import Annotation
+from rstools.annotation import load_annotations
+from rstools.label_file import LabelFile
+from rstools.label_file import LabelFileError
+
+
+# Vertices of the polygon standing for a circle in COCO.
+CIRCLE_VERTICES = 32
+
+
+def _encode(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+def coco_categories(label_name_to_value):
+    """COCO categories of the label values, e.g. from a labels file.
+
+    The background, value 0, is not a category.
+    """
+    return [dict(id=value, name=name, supercategory='')
+            for name, value in sorted(label_name_to_value.items(),
+                                      key=lambda item: item[1])
+            if value > 0]
+
+
+def image_file_name(label_file, root):
+    """Path of the image of a loaded label file, relative to `root`."""
+    if label_file.imageFile is not None:
+        return osp.relpath(label_file.imageFile, root)
+    # Embedded image: where it would be written beside the label file.
+    return osp.relpath(osp.join(osp.dirname(label_file.filename),
+                                osp.basename(label_file.imagePath)), root)
+
+
+def coco_geometry(annotation):
+    """(segmentation, area, bbox) of an annotation, None without area.
+
+    Rectangles and circles become polygons; lines and points have no
+    area and no COCO instance geometry.
+    """
+    points = annotation.points
+    shape_type = annotation.shape_type
+    if shape_type == 'polygon' and len(points) >= 3:
+        x, y = points[:, 0], points[:, 1]
+        area = 0.5 * abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
+    elif shape_type == 'rectangle' and len(points) == 2:
+        (x1, y1), (x2, y2) = points.min(axis=0), points.max(axis=0)
+        points = np.array([[x1, y1], [x2, y1], [x2, y2], [x1, y2]])
+        area = (x2 - x1) * (y2 - y1)
+    elif shape_type == 'circle' and len(points) == 2:
+        (cx, cy), (px, py) = points
+        r = np.hypot(px - cx, py - cy)
+        t = np.linspace(0, 2 * np.pi, CIRCLE_VERTICES, endpoint=False)
+        points = np.stack([cx + r * np.cos(t), cy + r * np.sin(t)], axis=1)
+        area = np.pi * r * r
+    else:
+        return None
+    xmin, ymin, xmax, ymax = annotation.bounds()
+    return ([points.ravel().tolist()], float(area),
+            [xmin, ymin, xmax - xmin, ymax - ymin])
+
+
+def coco_entry(filename, root, category_ids):
+    """COCO image and encoded annotations of a label file.
+
+    Returns `(image, annotations, skipped)`.  The annotations are the
+    JSON text of their members but `id` and `image_id`, without braces,
+    see `CocoWriter.add`.  Shapes whose label is not in `category_ids`,
+    or without area, are skipped and counted.
+    """
+    label_file = LabelFile(filename)
+    height, width = label_file.image_size()
+    image = dict(file_name=image_file_name(label_file, root),
+                 height=height, width=width)
+    annotations = []
+    skipped = 0
+    for a in load_annotations(label_file):
+        geometry = coco_geometry(a) if a.label in category_ids else None
+        if geometry is None:
+            skipped += 1
+            continue
+        segmentation, area, bbox = geometry
+        data = dict(category_id=category_ids[a.label],
+                    segmentation=segmentation, area=area, bbox=bbox,
+                    iscrowd=0)
+        if a.flags:
+            data['attributes'] = a.flags
+        annotations.append(_encode(data)[1:-1])
+    return image, annotations, skipped
+
+
+def geojson_geometry(annotation):
+    """GeoJSON geometry of an annotation, None if it has too few points."""
+    points = annotation.points
+    shape_type = annotation.shape_type
+    if shape_type == 'polygon' and len(points) >= 3:
+        ring = np.concatenate([points, points[:1]])
+        return dict(type='Polygon', coordinates=[ring.tolist()])
+    if shape_type == 'rectangle' and len(points) == 2:
+        (x1, y1), (x2, y2) = points.min(axis=0), points.max(axis=0)
+        return dict(type='Polygon', coordinates=[[
+            [x1, y1], [x2, y1], [x2, y2], [x1, y2], [x1, y1]]])
+    if shape_type in ['line', 'linestrip'] and len(points) >= 2:
+        return dict(type='LineString', coordinates=points.tolist())
+    if shape_type in ['point', 'circle'] and len(points):
+        return dict(type='Point', coordinates=points[0].tolist())
+    return None
+
+
+def geojson_entry(filename, root):
+    """Encoded GeoJSON features of the shapes of a label file.
+
+    Returns `(features, skipped)`.  Properties hold the image path
+    relative to `root`, the label, shape type and flags, and the radius
+    of circles, so that `feature_shapes` gives the shapes back.
+    """
+    label_file = LabelFile(filename)
+    image = image_file_name(label_file, root)
+    features = []
+    skipped = 0
+    for a in load_annotations(label_file):
+        geometry = geojson_geometry(a)
+        if geometry is None:
+            skipped += 1
+            continue
+        properties = dict(image=image, label=a.label,
+                          shape_type=a.shape_type, flags=a.flags or {})
+        if a.shape_type == 'circle':
+            (cx, cy), (px, py) = a.points[:2]
+            properties['radius'] = float(np.hypot(px - cx, py - cy))
+        features.append(_encode(dict(
+            type='Feature', geometry=geometry, properties=properties)))
+    return features, skipped
+
+
+class _ArrayWriter(object):
+
+    """JSON text written to a temporary file, renamed when complete."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._tmp_file = filename + '.tmp'
+        self._f = open(self._tmp_file, 'w', encoding='utf-8')
+
+    def _append(self, f, text, first):
+        f.write('\n' if first else ',\n')
+        f.write(text)
+
+    def _finish(self):
+        pass
+
+    def close(self):
+        self._finish()
+        self._f.close()
+        os.replace(self._tmp_file, self.filename)
+
+    def abort(self):
+        """Stop writing, leaving any previous file in place."""
+        self._f.close()
+        os.remove(self._tmp_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class CocoWriter(_ArrayWriter):
+
+    """COCO instance dataset written one image at a time.
+
+    Annotations go straight to the file; the images, which the format
+    lists apart, are kept in a second temporary file and appended after
+    them on `close`.
+    """
+
+    def __init__(self, filename, categories, info=None):
+        super(CocoWriter, self).__init__(filename)
+        self._images = open(filename + '.images.tmp', 'w+', encoding='utf-8')
+        self.n_images = 0
+        self.n_annotations = 0
+        self._f.write('{{"info":{},"licenses":[],"categories":{},\n'
+                      '"annotations":['.format(
+                          _encode(info or {}), _encode(categories)))
+
+    def add(self, image, annotations):
+        """Add an image dict and its encoded annotations, see `coco_entry`.
+
+        Returns the id given to the image.
+        """
+        self.n_images += 1
+        image_id = self.n_images
+        image = dict(image, id=image_id)
+        self._append(self._images, _encode(image), image_id == 1)
+        for annotation in annotations:
+            self.n_annotations += 1
+            self._append(self._f, '{{"id":{},"image_id":{},{}}}'.format(
+                self.n_annotations, image_id, annotation),
+                self.n_annotations == 1)
+        return image_id
+
+    def _finish(self):
+        self._f.write('\n],\n"images":[' if self.n_annotations else '],\n'
+                      '"images":[')
+        self._images.seek(0)
+        shutil.copyfileobj(self._images, self._f)
+        self._f.write('\n]}\n' if self.n_images else ']}\n')
+        self._close_images()
+
+    def _close_images(self):
+        self._images.close()
+        os.remove(self._images.name)
+
+    def abort(self):
+        self._close_images()
+        super(CocoWriter, self).abort()
+
+
+class GeoJSONWriter(_ArrayWriter):
+
+    """GeoJSON FeatureCollection written a few features at a time."""
+
+    def __init__(self, filename):
+        super(GeoJSONWriter, self).__init__(filename)
+        self.n_features = 0
+        self._f.write('{"type":"FeatureCollection","features":[')
+
+    def add(self, features):
+        """Add encoded features, see `geojson_entry`."""
+        for feature in features:
+            self.n_features += 1
+            self._append(self._f, feature, self.n_features == 1)
+
+    def _finish(self):
+        self._f.write('\n]}\n' if self.n_features else ']}\n')
+
+
+def coco_shapes(annotation):
+    """(category id, points, shape type, flags) of a COCO annotation.
+
+    Each polygon of the segmentation is a shape; without one, the box is.
+    Run-length encoded masks are not converted: None.
+    """
+    segmentation = annotation.get('segmentation')
+    flags = annotation.get('attributes') or {}
+    category_id = annotation['category_id']
+    if isinstance(segmentation, dict):
+        return None
+    if segmentation:
+        return [(category_id, np.reshape(polygon, (-1, 2)).tolist(),
+                 'polygon', flags)
+                for polygon in segmentation if len(polygon) >= 6]
+    x, y, w, h = annotation['bbox']
+    return [(category_id, [[x, y], [x + w, y + h]], 'rectangle', flags)]
+
+
+def feature_shapes(feature):
+    """(label, points, shape type, flags) of the shapes of a feature.
+
+    Shape types written by `geojson_entry` are restored; other features
+    give polygons, of their exterior rings, linestrips and points.
+    """
+    geometry = feature.get('geometry') or {}
+    properties = feature.get('properties') or {}
+    label = properties.get('label')
+    flags = properties.get('flags') or {}
+    shape_type = properties.get('shape_type')
+    kind = geometry.get('type')
+    coordinates = geometry.get('coordinates')
+    if kind in ['Polygon', 'MultiPolygon']:
+        polygons = [coordinates] if kind == 'Polygon' else coordinates
+        shapes = []
+        for rings in polygons:
+            ring = np.asarray(rings[0], dtype=np.float64)[:, :2]
+            if shape_type == 'rectangle':
+                points = [ring.min(axis=0).tolist(), ring.max(axis=0).tolist()]
+                shapes.append((label, points, 'rectangle', flags))
+                continue
+            if len(ring) > 1 and (ring[0] == ring[-1]).all():
+                ring = ring[:-1]
+            if len(ring) >= 3:
+                shapes.append((label, ring.tolist(), 'polygon', flags))
+        return shapes
+    if kind in ['LineString', 'MultiLineString']:
+        lines = [coordinates] if kind == 'LineString' else coordinates
+        if shape_type not in ['line', 'linestrip']:
+            shape_type = 'linestrip'
+        return [(label, [p[:2] for p in line], shape_type, flags)
+                for line in lines if len(line) >= 2]
+    if kind in ['Point', 'MultiPoint']:
+        points = [coordinates] if kind == 'Point' else coordinates
+        radius = properties.get('radius')
+        if shape_type == 'circle' and radius is not None:
+            return [(label, [p[:2], [p[0] + radius, p[1]]], 'circle', flags)
+                    for p in points]
+        return [(label, [p[:2]], 'point', flags) for p in points]
+    return []
+
+
+def iter_coco(f):
+    """('category' | 'image' | 'annotation', dict) of a COCO dataset.
+
+    Parsed incrementally from a binary file object, see
+    `utils.iter_json_object`; other top-level keys are yielded as they are.
+    """
+    return utils.iter_json_object(f, {
+        'categories': 'category',
+        'images': 'image',
+        'annotations': 'annotation',
+    })
+
+
+def iter_features(f):
+    """Features of a GeoJSON FeatureCollection, parsed incrementally."""
+    for key, value in utils.iter_json_object(f, {'features': 'feature'}):
+        if key == 'feature':
+            yield value
+
+
+class ShapeSpool(object):
+
+    """Shapes spooled to files by image, to write them out bucket by bucket.
+
+    An image always goes to the same one of `buckets` files, so that all
+    its shapes are found by reading that file only.
+    """
+
+    def __init__(self, directory, buckets=64):
+        self.directory = directory
+        self.buckets = buckets
+        self._files = [None] * buckets
+
+    def bucket(self, image):
+        return hash(image) % self.buckets
+
+    def filename(self, bucket):
+        return osp.join(self.directory, '{}.jsonl'.format(bucket))
+
+    def add(self, image, shape):
+        """Spool `shape`, a (label, points, shape type, flags) tuple."""
+        i = self.bucket(image)
+        if self._files[i] is None:
+            self._files[i] = open(self.filename(i), 'w', encoding='utf-8')
+        self._files[i].write(_encode([image] + list(shape)) + '\n')
+
+    def close(self):
+        for f in self._files:
+            if f is not None:
+                f.close()
+        self._files = [None] * self.buckets
+
+    def partition(self, images):
+        """Dicts of the `images` dict items of each bucket."""
+        parts = [{} for _ in range(self.buckets)]
+        for key, image in images.items():
+            parts[self.bucket(key)][key] = image
+        return parts
+
+
+def write_label_files(spool_file, images, output_dir, image_dir,
+                      labels=None):
+    """Write the label files of the shapes of a spool bucket.
+
+    `images` maps the image keys of the bucket to dicts with `file_name`,
+    and optionally `height` and `width`; images without shapes get an
+    empty label file.  With None, the keys are the file names.  `labels`
+    maps the labels spooled, e.g. COCO category ids, to label names.
+    Label files mirror the file names under `output_dir`, referencing
+    the images under `image_dir`.
+
+    Returns `(label file, error, number of shapes)` per image.
+    """
+    shapes = {}
+    if osp.exists(spool_file):
+        with open(spool_file, encoding='utf-8') as f:
+            for line in f:
+                image, label, points, shape_type, flags = json.loads(line)
+                if labels is not None:
+                    label = labels.get(label, label)
+                shapes.setdefault(image, []).append(Annotation(
+                    label, points, shape_type, flags).to_dict())
+    if images is None:
+        images = {key: dict(file_name=key) for key in shapes}
+    results = []
+    for key in sorted(shapes.keys() - images.keys(), key=str):
+        results.append((str(key), 'shapes of an unknown image',
+                        len(shapes[key])))
+    for key, image in images.items():
+        file_name = osp.normpath(image['file_name'])
+        out_file = osp.join(output_dir,
+                            osp.splitext(file_name)[0] + LabelFile.suffix)
+        image_shapes = shapes.get(key, [])
+        if osp.isabs(file_name) or file_name.startswith(os.pardir):
+            results.append((out_file, 'image outside of the image '
+                            'directory: {}'.format(file_name), None))
+            continue
+        out_dir = osp.dirname(out_file)
+        try:
+            if not osp.exists(out_dir):
+                os.makedirs(out_dir, exist_ok=True)
+            LabelFile().save(
+                out_file,
+                shapes=image_shapes,
+                imagePath=osp.relpath(osp.join(image_dir, file_name),
+                                      out_dir),
+                imageHeight=image.get('height'),
+                imageWidth=image.get('width'),
+            )
+        except (LabelFileError, IOError, OSError) as e:
+            results.append((out_file, str(e), None))
+            continue
+        results.append((out_file, None, len(image_shapes)))
+    return results
@@ -0,0 +1,213 @@
+"""Crash recovery journal of the edits made since a label file was saved.
+
+Every change to the shapes is appended as one JSON line to
+`<label file>.journal`, which costs one small write per edit instead of
+rewriting the label file.  Lines are flushed to the operating system as
+they are written, so they survive the application dying; `os.fsync`, for
+surviving the system going down, is batched to at most one per
+`sync_interval` seconds on a timer thread.
+
+The first line records the size and modification time of the label file
+the edits apply to.  When the same label file is opened again, `replay`
+applies the edits to its shapes; once they are saved, `rebase` drops
+them from the journal.
+"""
+import json
+import os
+import os.path as osp
+import threading
+
+from rstools.annotation import Annotation
+from rstools.undo import move_items
+
+
+FORMAT_VERSION = 2
+
+
+class JournalError(Exception):
+    pass
+
+
+def journal_filename(label_file):
+    return label_file + '.journal'
+
+
+def file_state(filename):
+    """[size, mtime_ns] of a file, None if it does not exist."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+class Journal(object):
+
+    """Append-only log of shape edits, identified by position in the list.
+
+    The file is only created with the first record, so that opening an
+    image without editing it leaves nothing behind.  With `resume`, the
+    records go after those of an existing journal of the same base.
+    """
+
+    def __init__(self, filename, base, sync_interval=1.0, resume=False):
+        self.filename = filename
+        self.base = base
+        self.sync_interval = sync_interval
+        self._file = None
+        self._lock = threading.Lock()
+        self._timer = None
+        if resume and osp.exists(filename):
+            self._file = open(filename, 'ab')
+
+    def position(self):
+        """Position in the journal, to `rebase` on it after a save."""
+        with self._lock:
+            if self._file is None:
+                return 0
+            return self._file.tell()
+
+    def _write(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.filename, 'wb')
+                self._file.write((json.dumps(dict(
+                    op='begin', version=FORMAT_VERSION, base=self.base,
+                )) + '\n').encode('utf-8'))
+            self._file.write(line)
+            self._file.flush()
+            if self._timer is None and self.sync_interval is not None:
+                self._timer = threading.Timer(self.sync_interval, self.sync)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def sync(self):
+        with self._lock:
+            self._timer = None
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+
+    def add(self, index, shape):
+        """`shape` is a dict as in label files, inserted at `index`."""
+        self._write(dict(op='add', index=index, shape=shape))
+
+    def remove(self, index):
+        self._write(dict(op='remove', index=index))
+
+    def points(self, index, points):
+        self._write(dict(op='points', index=index, points=points))
+
+    def label(self, index, label, flags):
+        self._write(dict(op='label', index=index, label=label, flags=flags))
+
+    def move(self, source, target):
+        """Shapes moved between positions, see `rstools.undo.move_items`."""
+        self._write(dict(op='move', source=source, target=target))
+
+    def replace(self, shapes):
+        self._write(dict(op='replace', shapes=shapes))
+
+    def rebase(self, position, base):
+        """Forget the edits before `position`, saved in a file in `base`.
+
+        Edits made while the save was written are kept; the journal is
+        removed when there are none.
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self.base = base
+            if self._file is None:
+                return
+            self._file.flush()
+            size = self._file.tell()
+            self._file.close()
+            self._file = None
+            if position >= size:
+                os.remove(self.filename)
+                return
+            with open(self.filename, 'rb') as f:
+                f.seek(position)
+                tail = f.read()
+            tmp_file = self.filename + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                f.write((json.dumps(dict(
+                    op='begin', version=FORMAT_VERSION, base=base,
+                )) + '\n').encode('utf-8'))
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.filename)
+            self._file = open(self.filename, 'ab')
+
+    def close(self, discard=False):
+        """Close the journal, and remove it with `discard`."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if discard and osp.exists(self.filename):
+                os.remove(self.filename)
+
+
+def read_journal(filename):
+    """Base and records of a journal.
+
+    A last line cut short by a crash while it was written is ignored.
+    """
+    with open(filename, 'rb') as f:
+        lines = f.read().split(b'\n')
+    records = []
+    for i, line in enumerate(lines):
+        if not line:
+            continue
+        try:
+            records.append(json.loads(line.decode('utf-8')))
+        except ValueError:
+            if i == len(lines) - 1:
+                break
+            raise JournalError(
+                'Invalid record on line {} of {}'.format(i + 1, filename))
+    if not records or records[0].get('op') != 'begin':
+        raise JournalError('Not a journal: {}'.format(filename))
+    if records[0].get('version', 0) > FORMAT_VERSION:
+        raise JournalError('Unsupported journal version: {}'.format(
+            records[0]['version']))
+    return records[0].get('base'), records[1:]
+
+
+def replay(records, annotations):
+    """Annotations resulting from applying the records to `annotations`."""
+    annotations = list(annotations)
+    try:
+        for record in records:
+            op = record['op']
+            if op == 'add':
+                annotations.insert(
+                    record['index'], Annotation.from_dict(record['shape']))
+            elif op == 'remove':
+                del annotations[record['index']]
+            elif op == 'points':
+                annotation = annotations[record['index']]
+                annotation.points = Annotation(
+                    points=record['points']).points
+            elif op == 'label':
+                annotation = annotations[record['index']]
+                annotation.label = record['label']
+                annotation.flags = record['flags']
+            elif op == 'move':
+                annotations = move_items(
+                    annotations, record['source'], record['target'])
+            elif op == 'replace':
+                annotations = [Annotation.from_dict(shape)
+                               for shape in record['shapes']]
+            else:
+                raise JournalError('Unknown journal record: {}'.format(op))
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        raise JournalError('Invalid journal record: {!r}'.format(e))
+    return annotations
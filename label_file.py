@@ -1,8 +1,12 @@
 import base64
+import hashlib
 import io
 import json
+import os
 import os.path as osp
+import zipfile
 
+import numpy as np
 import PIL.Image
 
 #from labelme._version import __version__
@@ -11,35 +15,166 @@ import PIL.Image
 #from labelme import QT4
 #from labelme import utils
 from rstools import utils
+from rstools.binary_label import BinaryLabel
+from rstools.binary_label import write_binary_label
 
 
 class LabelFileError(Exception):
     pass
 
 
+def _dump(data, f):
+    """`json.dump(data, f, ensure_ascii=False, indent=2)`, shape by shape.
+
+    Writes the same text, but each shape is encoded and written on its
+    own, so `shapes` may be any iterable, e.g. a generator converting
+    shapes as they are written.  Only one shape dict is alive at a time,
+    which keeps memory flat and does not trigger full garbage collections
+    of the application heap when saving in the background.
+    """
+    f.write('{')
+    for i, (key, value) in enumerate(data.items()):
+        f.write(',\n  ' if i else '\n  ')
+        f.write(json.dumps(key, ensure_ascii=False) + ': ')
+        if key != 'shapes' or value is None:
+            f.write(json.dumps(value, ensure_ascii=False, indent=2)
+                    .replace('\n', '\n  '))
+            continue
+        f.write('[')
+        empty = True
+        for shape in value:
+            f.write('\n    ' if empty else ',\n    ')
+            f.write(json.dumps(shape, ensure_ascii=False, indent=2)
+                    .replace('\n', '\n    '))
+            empty = False
+        f.write(']' if empty else '\n  ]')
+    f.write('\n}' if data else '}')
+
+
+# Content hashes of image files, keyed by path, size and mtime so that
+# saving again does not read an unchanged image.
+_image_hashes = {}
+
+
 class LabelFile(object):
 
     suffix = '.json'
+    # Zip archive holding the label file and, uncompressed, its image.
+    packed_suffix = '.rspack'
+    packed_label = 'label.json'
+    # Binary layout of the same content, see rstools.binary_label.
+    binary_suffix = '.rsbin'
+    hash_algorithm = 'sha256'
 
     def __init__(self, filename=None):
         self.shapes = ()
         self.imagePath = None
-        self.imageData = None
+        self.imageHash = None
+        self.imageHeight = None
+        self.imageWidth = None
+        # Path of the image when it is referenced rather than embedded.
+        self.imageFile = None
+        self._imageData = None
+        # Where imageData is read from on first use, see _read_image.
+        self._imageSource = None
         if filename is not None:
             self.load(filename)
         self.filename = filename
 
+    @property
+    def imageData(self):
+        """Image bytes, read and checked against imageHash on first use.
+
+        Label files referencing their image by path or packing it only
+        read it when it is needed.
+        """
+        if self._imageData is None and self._imageSource is not None:
+            source, self._imageSource = self._imageSource, None
+            self._imageData = self._read_image(source)
+        return self._imageData
+
+    @imageData.setter
+    def imageData(self, value):
+        self._imageData = value
+        self._imageSource = None
+
+    def _read_image(self, source):
+        kind, name = source[:2]
+        if kind == 'base64':
+            return self._read_embedded_image(*source[1:])
+        if kind == 'binary':
+            return name.imageData
+        try:
+            if kind == 'file':
+                with open(name, 'rb') as f:
+                    data = f.read()
+            else:
+                with zipfile.ZipFile(source[2]) as z:
+                    data = z.read(name)
+        except (IOError, OSError, KeyError):
+            return None
+        if self.imageHash is not None and \
+                self.hash_image_data(data) != self.imageHash:
+            raise LabelFileError(
+                'Image does not match the hash of the label file: {}'
+                .format(name))
+        return self.load_image_data(data, name)
+
+    def _read_embedded_image(self, filename, start, end, stat):
+        # The base64 string was skipped when loading, read it back by its
+        # byte range unless the label file changed since.
+        try:
+            st = os.stat(filename)
+            if (st.st_size, st.st_mtime_ns) != stat:
+                raise LabelFileError(
+                    'Label file changed since it was loaded: {}'
+                    .format(filename))
+            with open(filename, 'rb') as f:
+                f.seek(start)
+                imageData = base64.b64decode(f.read(end - start))
+            self._check_image_height_and_width(
+                imageData, self.imageHeight, self.imageWidth)
+        except LabelFileError:
+            raise
+        except Exception as e:
+            raise LabelFileError(e)
+        return imageData
+
+    @classmethod
+    def hash_image_data(cls, data):
+        return '{}:{}'.format(
+            cls.hash_algorithm, hashlib.new(cls.hash_algorithm, data)
+            .hexdigest())
+
+    @classmethod
+    def hash_image_file(cls, filename):
+        """Content hash of an image file, read in chunks and cached."""
+        st = os.stat(filename)
+        key = (osp.abspath(filename), st.st_size, st.st_mtime_ns)
+        digest = _image_hashes.get(key)
+        if digest is None:
+            h = hashlib.new(cls.hash_algorithm)
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    h.update(chunk)
+            digest = _image_hashes[key] = '{}:{}'.format(
+                cls.hash_algorithm, h.hexdigest())
+        return digest
+
     @staticmethod
-    def load_image_file(filename):
+    def load_image_data(data, filename):
+        """Image bytes as stored in label files, from the file's content."""
         try:
-            image_pil = PIL.Image.open(filename)
+            image_pil = PIL.Image.open(io.BytesIO(data))
         except IOError:
-            #logger.error('Failed opening image file: {}'.format(filename))
             return
+        oriented = utils.apply_exif_orientation(image_pil)
+        if oriented is image_pil and image_pil.format in ['JPEG', 'PNG']:
+            return data
+        return LabelFile._encode_image(oriented, filename)
 
-        # apply orientation to image according to exif
-        image_pil = utils.apply_exif_orientation(image_pil)
-
+    @staticmethod
+    def _encode_image(image_pil, filename):
         with io.BytesIO() as f:
             ext = osp.splitext(filename)[1].lower()
             if ext in ['.jpg', '.jpeg']:
@@ -50,10 +185,134 @@ class LabelFile(object):
             f.seek(0)
             return f.read()
 
+    @staticmethod
+    def load_image_file(filename):
+        try:
+            image_pil = PIL.Image.open(filename)
+        except IOError:
+            #logger.error('Failed opening image file: {}'.format(filename))
+            return
+
+        # apply orientation to image according to exif
+        oriented = utils.apply_exif_orientation(image_pil)
+
+        if oriented is image_pil and image_pil.format in ['JPEG', 'PNG']:
+            # Already in a format Qt decodes, embed the file as it is.
+            with open(filename, 'rb') as f:
+                return f.read()
+        return LabelFile._encode_image(oriented, filename)
+
+    @staticmethod
+    def load_image_array(filename):
+        """Decode an image once into an array Qt can display directly.
+
+        Raises LabelFileError for images PIL would read with fewer bands
+        or bits than stored, rather than show part of them.
+        """
+        try:
+            image_pil = PIL.Image.open(filename)
+        except IOError:
+            return
+        try:
+            utils.check_pil_image(image_pil)
+        except utils.RasterError as e:
+            raise LabelFileError('{}: {}'.format(filename, e))
+        image_pil = utils.apply_exif_orientation(image_pil)
+        if image_pil.mode not in ['L', 'RGB', 'RGBA']:
+            if 'A' in image_pil.getbands() or \
+                    'transparency' in image_pil.info:
+                image_pil = image_pil.convert('RGBA')
+            else:
+                image_pil = image_pil.convert('RGB')
+        return np.asarray(image_pil)
+
+    @staticmethod
+    def load_image_preview(filename, max_size=1024):
+        """Quickly decode a reduced version of an image.
+
+        Returns the preview array and the (width, height) of the full
+        image, or None when the format has no cheap reduced decode (only
+        JPEG does, through PIL's draft mode).
+        """
+        try:
+            image_pil = PIL.Image.open(filename)
+        except IOError:
+            return
+        width, height = image_pil.size
+        image_pil.draft('RGB', (max_size, max_size))
+        if image_pil.size == (width, height):
+            return
+        preview = utils.apply_exif_orientation(image_pil)
+        if preview.size != image_pil.size:
+            width, height = height, width
+        if preview.mode not in ['L', 'RGB']:
+            preview = preview.convert('RGB')
+        return np.asarray(preview), (width, height)
+
+    @classmethod
+    def _open_label(cls, filename):
+        """Binary file object of the JSON of a label file."""
+        if cls.is_packed_file(filename):
+            z = zipfile.ZipFile(filename)
+            try:
+                return z.open(cls.packed_label)
+            finally:
+                # The member stays readable after the archive is closed.
+                z.close()
+        return open(filename, 'rb')
+
+    @staticmethod
+    def _shape_tuple(s):
+        return (
+            s['label'],
+            s['points'],
+            s['line_color'],
+            s['fill_color'],
+            s.get('shape_type', 'polygon'),
+            s.get('flags', {}),
+        )
+
+    @classmethod
+    def iter_shapes(cls, filename, data=None):
+        """Shapes of a label file as they are parsed, like `shapes`.
+
+        Only the shapes are decoded, and only one at a time, so that the
+        first ones are available before the rest of the file is read.  The
+        other top-level keys are stored in the dict `data` if given, apart
+        from imageData.
+        """
+        if data is None:
+            data = {}
+        if cls.is_binary_file(filename):
+            binary = cls._load_binary(filename)
+            data.update(binary.data)
+            for shape in binary:
+                yield shape
+            return
+        try:
+            with cls._open_label(filename) as f:
+                for key, value in utils.iter_label_file(f):
+                    if key == 'shape':
+                        yield cls._shape_tuple(value)
+                    elif key != 'imageData':
+                        data[key] = value
+        except LabelFileError:
+            raise
+        except Exception as e:
+            raise LabelFileError(e)
+
+    @staticmethod
+    def _load_binary(filename):
+        try:
+            return BinaryLabel(filename)
+        except Exception as e:
+            raise LabelFileError(e)
+
     def load(self, filename):
         keys = [
             'imageData',
             'imagePath',
+            'imageHash',
             'lineColor',
             'fillColor',
             'shapes',  # polygonal annotations
@@ -61,37 +320,37 @@ class LabelFile(object):
             'imageHeight',
             'imageWidth',
         ]
+        packed = self.is_packed_file(filename)
+        binary = None
         try:
-            with open(filename, 'rb' if '2' else 'r') as f:
-                data = json.load(f)
-            if data['imageData'] is not None:
-                imageData = base64.b64decode(data['imageData'])
-                # if PY2 and QT4:
-                #     imageData = utils.img_data_to_png_data(imageData)
+            if self.is_binary_file(filename):
+                # Mapped; the shapes are a sequence converted on access.
+                binary = self._load_binary(filename)
+                data = dict(binary.data)
+                shapes = binary
+            else:
+                data, shapes = self._load_json(filename)
+            imageSource = None
+            if binary is not None and binary.has_image():
+                imageSource = ('binary', binary)
+            elif data['imageData'] is not None:
+                # Only read from the file, and decoded, on first use.
+                st = os.stat(filename)
+                imageSource = ('base64', filename) + \
+                    tuple(data['imageData']) + \
+                    ((st.st_size, st.st_mtime_ns),)
+            elif packed:
+                # The image is only read, and its hash checked, when
+                # imageData is first used.
+                imageSource = ('zip', data['imagePath'], filename)
             else:
                 # relative path from label file to relative path from cwd
-                imagePath = osp.join(osp.dirname(filename), data['imagePath'])
-                imageData = self.load_image_file(imagePath)
+                imageSource = ('file', osp.join(
+                    osp.dirname(filename), data['imagePath']))
             flags = data.get('flags') or {}
             imagePath = data['imagePath']
-            self._check_image_height_and_width(
-                base64.b64encode(imageData).decode('utf-8'),
-                data.get('imageHeight'),
-                data.get('imageWidth'),
-            )
             lineColor = data['lineColor']
             fillColor = data['fillColor']
-            shapes = (
-                (
-                    s['label'],
-                    s['points'],
-                    s['line_color'],
-                    s['fill_color'],
-                    s.get('shape_type', 'polygon'),
-                    s.get('flags', {}),
-                )
-                for s in data['shapes']
-            )
         except Exception as e:
             raise LabelFileError(e)
 
@@ -104,27 +363,57 @@ class LabelFile(object):
         self.flags = flags
         self.shapes = shapes
         self.imagePath = imagePath
-        self.imageData = imageData
+        self.imageHash = data.get('imageHash')
+        self.imageHeight = data.get('imageHeight')
+        self.imageWidth = data.get('imageWidth')
+        self._imageData = None
+        self._imageSource = imageSource
+        self.imageFile = imageSource[1] \
+            if imageSource[0] == 'file' else None
         self.lineColor = lineColor
         self.fillColor = fillColor
         self.filename = filename
         self.otherData = otherData
 
+    def _load_json(self, filename):
+        # Parsed incrementally: shapes are converted one by one and the
+        # base64 imageData is skipped, so that neither the whole text nor
+        # the embedded image is held in memory.
+        data = {}
+        shapes = []
+        with self._open_label(filename) as f:
+            for key, value in utils.iter_label_file(f):
+                if key == 'shape':
+                    shapes.append(self._shape_tuple(value))
+                else:
+                    data[key] = value
+        # Only yielded here when it is not an array.
+        if not isinstance(data.pop('shapes', []), list):
+            raise ValueError('shapes is not a list')
+        return data, shapes
+
+    def verify_image(self):
+        """Read the image now, LabelFileError if missing or modified."""
+        if self.imageData is None:
+            raise LabelFileError(
+                'Failed opening image file: {}'.format(self.imagePath))
+
     @staticmethod
     def _check_image_height_and_width(imageData, imageHeight, imageWidth):
-        img_arr = utils.img_b64_to_arr(imageData)
-        if imageHeight is not None and img_arr.shape[0] != imageHeight:
+        # Only the header is parsed, the pixels are never decoded.
+        height, width = utils.img_data_to_size(imageData)
+        if imageHeight is not None and height != imageHeight:
             # logger.error(
             #     'imageHeight does not match with imageData or imagePath, '
             #     'so getting imageHeight from actual image.'
             # )
-            imageHeight = img_arr.shape[0]
-        if imageWidth is not None and img_arr.shape[1] != imageWidth:
+            imageHeight = height
+        if imageWidth is not None and width != imageWidth:
             # logger.error(
             #     'imageWidth does not match with imageData or imagePath, '
             #     'so getting imageWidth from actual image.'
             # )
-            imageWidth = img_arr.shape[1]
+            imageWidth = width
         return imageHeight, imageWidth
 
     def save(
@@ -140,11 +429,30 @@ class LabelFile(object):
         otherData=None,
         flags=None,
     ):
+        """Write a label file.
+
+        With `imageData` the image is embedded in base64, otherwise it is
+        referenced by `imagePath`, relative to the label file, along with
+        its content hash.  Files named with `packed_suffix` hold the image
+        bytes as they are, from `imageData` or `imagePath`, and files
+        named with `binary_suffix` hold `imageData` as it is.
+        """
+        packed = self.is_packed_file(filename)
+        binary = self.is_binary_file(filename)
+        imageFile = osp.join(osp.dirname(filename), imagePath)
+        imageHash = None
         if imageData is not None:
-            imageData = base64.b64encode(imageData).decode('utf-8')
             imageHeight, imageWidth = self._check_image_height_and_width(
                 imageData, imageHeight, imageWidth
             )
+            if packed:
+                imageHash = self.hash_image_data(imageData)
+            elif not binary:
+                imageData = base64.b64encode(imageData).decode('utf-8')
+        elif osp.exists(imageFile):
+            imageHash = self.hash_image_file(imageFile)
+        if packed:
+            imagePath = osp.basename(imagePath)
         if otherData is None:
             otherData = {}
         if flags is None:
@@ -156,19 +464,68 @@ class LabelFile(object):
             lineColor=lineColor,
             fillColor=fillColor,
             imagePath=imagePath,
-            imageData=imageData,
+            imageData=None if packed else imageData,
             imageHeight=imageHeight,
             imageWidth=imageWidth,
         )
+        if imageHash is not None:
+            data['imageHash'] = imageHash
         for key, value in otherData.items():
             data[key] = value
         try:
-            with open(filename, 'wb' if '2' else 'w') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            if binary:
+                write_binary_label(filename, data)
+            else:
+                # Written aside and renamed, so that the label file is
+                # never left half written, e.g. by a crash during autosave.
+                tmp_file = filename + '.tmp'
+                try:
+                    if packed:
+                        self._save_packed(
+                            tmp_file, data, imageData, imageFile)
+                    else:
+                        with open(tmp_file, 'w', encoding='utf-8') as f:
+                            _dump(data, f)
+                    os.replace(tmp_file, filename)
+                finally:
+                    if osp.exists(tmp_file):
+                        os.remove(tmp_file)
             self.filename = filename
         except Exception as e:
             raise LabelFileError(e)
 
+    def _save_packed(self, filename, data, imageData, imageFile):
+        # Stored, not deflated: images are compressed already, and the
+        # image member can be read without inflating it.
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_STORED,
+                             allowZip64=True) as z:
+            with z.open(self.packed_label, 'w') as member:
+                with io.TextIOWrapper(member, encoding='utf-8') as f:
+                    _dump(data, f)
+            if imageData is not None:
+                z.writestr(data['imagePath'], imageData)
+            else:
+                z.write(imageFile, data['imagePath'])
+
+    def image_size(self):
+        """(height, width) of the image, from its header if not stored."""
+        if self.imageHeight is not None and self.imageWidth is not None:
+            return self.imageHeight, self.imageWidth
+        if self.imageData is None:
+            raise LabelFileError(
+                'Failed opening image file: {}'.format(self.imagePath))
+        return utils.img_data_to_size(self.imageData)
+
     @staticmethod
     def is_label_file(filename):
-        return osp.splitext(filename)[1].lower() == LabelFile.suffix
+        return osp.splitext(filename)[1].lower() in \
+            [LabelFile.suffix, LabelFile.packed_suffix,
+             LabelFile.binary_suffix]
+
+    @staticmethod
+    def is_packed_file(filename):
+        return osp.splitext(filename)[1].lower() == LabelFile.packed_suffix
+
+    @staticmethod
+    def is_binary_file(filename):
+        return osp.splitext(filename)[1].lower() == LabelFile.binary_suffix
@@ -0,0 +1,127 @@
+import collections
+import concurrent.futures
+import threading
+
+
+class ImageCache(object):
+
+    """Thread-safe LRU cache of decoded images bounded by their byte size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            self._items.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value, nbytes):
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, size) = self._items.popitem(last=False)
+                self.nbytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+
+class Prefetcher(object):
+
+    """Decode images ahead of time on a worker pool into an ImageCache.
+
+    `load(filename)` must be safe to call from worker threads and return the
+    decoded image or None; `sizeof(image)` gives its size in bytes.
+    """
+
+    def __init__(self, load, sizeof, max_bytes, workers=2):
+        self.load = load
+        self.sizeof = sizeof
+        self.cache = ImageCache(max_bytes)
+        self._pending = {}
+        # Re-entrant: futures run their done callbacks right away when
+        # cancelled or already finished, while the lock is held.
+        self._lock = threading.RLock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+
+    def _load(self, filename):
+        image = self.load(filename)
+        if image is not None:
+            self.cache.put(filename, image, self.sizeof(image))
+        return image
+
+    def _done(self, filename, future):
+        with self._lock:
+            if self._pending.get(filename) is future:
+                del self._pending[filename]
+
+    def prefetch(self, filenames):
+        """Decode `filenames` in the background, in order of priority.
+
+        Queued decodes of files no longer wanted are cancelled, e.g. after
+        jumping to a different part of the list; running ones are let
+        finish since their result may still be cached.
+        """
+        wanted = set(filenames)
+        with self._lock:
+            for filename, future in list(self._pending.items()):
+                if filename not in wanted and future.cancel():
+                    del self._pending[filename]
+            for filename in filenames:
+                if filename in self._pending or filename in self.cache:
+                    continue
+                future = self._executor.submit(self._load, filename)
+                self._pending[filename] = future
+                future.add_done_callback(
+                    lambda f, filename=filename: self._done(filename, f))
+
+    def result(self, filename):
+        """Decoded image for `filename`, from the cache if possible.
+
+        Waits for a prefetch already running for it, otherwise decodes it
+        in the calling thread, which may be a worker of another pool.
+        """
+        image = self.cache.get(filename)
+        if image is not None:
+            return image
+        with self._lock:
+            future = self._pending.get(filename)
+            # A queued prefetch could wait behind others, take it over.
+            if future is not None and future.cancel():
+                future = None
+        if future is not None:
+            try:
+                return future.result()
+            except concurrent.futures.CancelledError:
+                pass
+        return self._load(filename)
+
+    def shutdown(self):
+        with self._lock:
+            for future in list(self._pending.values()):
+                future.cancel()
+            self._pending.clear()
+        self._executor.shutdown(wait=False)
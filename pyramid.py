@@ -0,0 +1,261 @@
+import collections
+import math
+
+import numpy as np
+from PyQt5 import QtCore
+from PyQt5 import QtGui
+
+from rstools import utils
+
+
+class ImagePyramid(object):
+
+    """Tiled, multi-resolution view of an image for drawing on the canvas.
+
+    Level 0 is the image itself and every following level halves its size,
+    until the whole image fits in a single tile.  Levels are built lazily
+    the first time they are needed and tiles are converted to pixmaps on
+    demand and kept in a bounded LRU cache, so the cost of a repaint only
+    depends on the number of tiles covering the viewport.
+
+    `size` is the size of the image the pyramid stands for when `image` is
+    a reduced preview of it; it is stretched to cover that area.
+    """
+
+    tile_size = 512
+    max_tiles = 192
+
+    def __init__(self, image, size=None, tile_size=None, max_tiles=None):
+        if tile_size is not None:
+            self.tile_size = tile_size
+        if max_tiles is not None:
+            self.max_tiles = max_tiles
+        self._levels = [image]
+        self._tiles = collections.OrderedDict()
+        if size is None:
+            size = image.size()
+        self._width = size.width()
+        self._height = size.height()
+        # Level 0 pixels per image pixel, more than one for a preview.
+        self._factor = float(self._width) / max(1, image.width())
+        self._num_levels = 1
+        w, h = image.width(), image.height()
+        while w > self.tile_size or h > self.tile_size:
+            w, h = max(1, w // 2), max(1, h // 2)
+            self._num_levels += 1
+
+    def __bool__(self):
+        return self._width > 0 and self._height > 0
+
+    __nonzero__ = __bool__
+
+    def width(self):
+        return self._width
+
+    def height(self):
+        return self._height
+
+    def size(self):
+        return QtCore.QSize(self._width, self._height)
+
+    def numLevels(self):
+        return self._num_levels
+
+    def levelForScale(self, scale):
+        """Coarsest level whose resolution is still at least `scale`."""
+        if scale <= 0:
+            return self._num_levels - 1
+        scale *= self._factor
+        level = int(math.floor(math.log(1.0 / scale, 2))) \
+            if scale < 1 else 0
+        return max(0, min(level, self._num_levels - 1))
+
+    def levelImage(self, level):
+        while len(self._levels) <= level:
+            prev = self._levels[-1]
+            self._levels.append(prev.scaled(
+                max(1, prev.width() // 2), max(1, prev.height() // 2),
+                QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation,
+            ))
+        return self._levels[level]
+
+    def levelSize(self, level):
+        image = self.levelImage(level)
+        return image.width(), image.height()
+
+    def tileImage(self, level, col, row):
+        s = self.tile_size
+        image = self.levelImage(level)
+        # Edge tiles are smaller: QImage.copy pads outside the image with
+        # opaque black pixels, which would be drawn beside it.
+        return image.copy(
+            QtCore.QRect(col * s, row * s, s, s).intersected(image.rect()))
+
+    def tile(self, level, col, row):
+        key = (level, col, row)
+        pixmap = self._tiles.get(key)
+        if pixmap is not None:
+            self._tiles.move_to_end(key)
+            return pixmap
+        pixmap = QtGui.QPixmap.fromImage(
+            self.tileImage(level, col, row).convertToFormat(
+                QtGui.QImage.Format_ARGB32_Premultiplied))
+        self._tiles[key] = pixmap
+        while len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+        return pixmap
+
+    def clearCache(self):
+        self._tiles.clear()
+
+    def paint(self, painter, rect, scale):
+        """Draw the tiles intersecting `rect`, given in level 0 coordinates."""
+        rect = rect.intersected(QtCore.QRectF(0, 0, self._width, self._height))
+        if rect.isEmpty():
+            return
+        level = self.levelForScale(scale)
+        width, height = self.levelSize(level)
+        # Size of a level pixel in level 0 pixels, per axis.
+        fx = float(self._width) / width
+        fy = float(self._height) / height
+        s = self.tile_size
+        col1 = int(rect.left() / fx) // s
+        row1 = int(rect.top() / fy) // s
+        col2 = int(math.ceil(rect.right() / fx)) // s
+        row2 = int(math.ceil(rect.bottom() / fy)) // s
+        for row in range(row1, min(row2, (height - 1) // s) + 1):
+            for col in range(col1, min(col2, (width - 1) // s) + 1):
+                pixmap = self.tile(level, col, row)
+                target = QtCore.QRectF(
+                    col * s * fx, row * s * fy,
+                    pixmap.width() * fx, pixmap.height() * fy,
+                )
+                painter.drawPixmap(target, pixmap,
+                                   QtCore.QRectF(pixmap.rect()))
+
+
+class RasterPyramid(ImagePyramid):
+
+    """Pyramid over a raster reader from `rstools.utils.raster`.
+
+    Tiles are read window by window from the reader, so only the visible
+    part of the raster is ever loaded, and mapped to 8 bits for display:
+    `bands` picks the raster bands shown as red, green and blue (or a
+    single gray band), and `stretch` is a `(mode, low, high)` contrast
+    stretch as taken by `utils.band_limits`, estimated on an overview.
+    8 and 16 bit bands are stretched through lookup tables, which are
+    cached per band and stretch.
+    """
+
+    def __init__(self, reader, bands=None, stretch=None, statistics=None,
+                 tile_size=None, max_tiles=None):
+        if tile_size is not None:
+            self.tile_size = tile_size
+        if max_tiles is not None:
+            self.max_tiles = max_tiles
+        self.reader = reader
+        self._tiles = collections.OrderedDict()
+        self._width = reader.width
+        self._height = reader.height
+        self._factor = 1.0
+        self._num_levels = 1
+        w, h = reader.width, reader.height
+        while (w > self.tile_size or h > self.tile_size) and \
+                self._num_levels < reader.num_levels:
+            w, h = reader.level_size(self._num_levels)
+            self._num_levels += 1
+        self._sample = None
+        self._limits = {}
+        self._luts = {}
+        self.statistics = statistics
+        self.bands = None
+        self.stretch = None
+        self.setDisplay(bands, stretch)
+
+    def setDisplay(self, bands=None, stretch=None):
+        """Change the bands shown and their stretch, False if unchanged.
+
+        Bands default to the first three (or the first one for fewer),
+        and out of range combinations fall back to that.
+        """
+        n = self.reader.bands
+        if not bands or max(bands) >= n or min(bands) < 0:
+            bands = range(3) if n >= 3 else [0]
+        bands = tuple(bands)
+        if stretch is None:
+            stretch = ('none',) if self.reader.dtype == np.uint8 \
+                else ('minmax',)
+        stretch = tuple(stretch)
+        if (bands, stretch) == (self.bands, self.stretch):
+            return False
+        self.bands = bands
+        self.stretch = stretch
+        self.clearCache()
+        return True
+
+    def setStatistics(self, statistics):
+        """Use new statistics, e.g. exact ones replacing approximate ones."""
+        self.statistics = statistics
+        self._limits.clear()
+        self._luts.clear()
+        self.clearCache()
+
+    def sample(self):
+        """Coarse overview of the raster the stretch is estimated on."""
+        if self._sample is None:
+            level = self.reader.num_levels - 1
+            while level > 0 and max(self.reader.level_size(level)) < 512:
+                level -= 1
+            w, h = self.reader.level_size(level)
+            self._sample = self.reader.read_window(0, 0, w, h, level)
+        return self._sample
+
+    def bandLimits(self, band):
+        key = (band,) + self.stretch
+        limits = self._limits.get(key)
+        if limits is None:
+            if self.statistics is not None and self.stretch[0] != 'none':
+                limits = self.statistics.limits(band, *self.stretch)
+            else:
+                lo, hi = utils.band_limits(
+                    self.sample()[:, :, band:band + 1], *self.stretch)
+                limits = float(lo[0]), float(hi[0])
+            self._limits[key] = limits
+        return limits
+
+    def bandLut(self, band):
+        key = (band,) + self.stretch
+        lut = self._luts.get(key)
+        if lut is None:
+            lut = self._luts[key] = utils.stretch_lut(
+                self.reader.dtype, *self.bandLimits(band))
+        return lut
+
+    def levelSize(self, level):
+        return self.reader.level_size(level)
+
+    def levelImage(self, level):
+        w, h = self.levelSize(level)
+        return self.display(self.reader.read_window(0, 0, w, h, level))
+
+    def display(self, arr):
+        """QImage for an (H, W, bands) array of raster values."""
+        use_lut = self.reader.dtype.kind in 'ui' and \
+            self.reader.dtype.itemsize <= 2
+        out = np.empty(arr.shape[:2] + (len(self.bands),), np.uint8)
+        for i, band in enumerate(self.bands):
+            if use_lut:
+                out[:, :, i] = utils.apply_lut(arr[:, :, band],
+                                               self.bandLut(band))
+            else:
+                out[:, :, i] = utils.stretch_values(
+                    arr[:, :, band].astype(np.float64),
+                    *self.bandLimits(band))
+        if len(self.bands) == 1:
+            out = out[:, :, 0]
+        return utils.img_arr_to_qimage(out)
+
+    def tileImage(self, level, col, row):
+        s = self.tile_size
+        return self.display(
+            self.reader.read_window(col * s, row * s, s, s, level))
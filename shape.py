@@ -1,14 +1,15 @@
 import copy
 import math
 
+import numpy as np
+
 from PyQt5 import QtCore
 from PyQt5 import QtGui
 
-import rstools.utils
-
-
-# TODO(unknown):
-# - [opt] Store paths instead of creating new ones at each paint.
+from rstools import utils
+from rstools.annotation import SHAPE_TYPES
+from rstools.annotation import Annotation
+from rstools.annotation import points_bounds
 
 
 DEFAULT_LINE_COLOR = QtGui.QColor(0, 255, 0, 128)
@@ -35,6 +36,8 @@ class Shape(object):
     point_type = P_ROUND
     point_size = 8
     scale = 1.0
+    # Largest size factor of a highlighted vertex, see _highlightSettings.
+    max_highlight_size = 4
 
     def __init__(self, label=None, line_color=None, shape_type=None,
                  flags=None):
@@ -48,7 +51,7 @@ class Shape(object):
         self._highlightIndex = None
         self._highlightMode = self.NEAR_VERTEX
         self._highlightSettings = {
-            self.NEAR_VERTEX: (4, self.P_ROUND),
+            self.NEAR_VERTEX: (self.max_highlight_size, self.P_ROUND),
             self.MOVE_VERTEX: (1.5, self.P_SQUARE),
         }
 
@@ -62,6 +65,87 @@ class Shape(object):
 
         self.shape_type = shape_type
 
+    @classmethod
+    def fromAnnotation(cls, annotation):
+        """Closed shape for the canvas from a Qt-free `Annotation`.
+
+        The shape keeps the vertex array of the annotation, the QPointF
+        list is only built when the shape is painted or edited.
+        """
+        shape = cls(label=annotation.label,
+                    shape_type=annotation.shape_type,
+                    flags=annotation.flags)
+        shape._points = None
+        shape._array = annotation.points.copy()
+        if annotation.line_color:
+            shape.line_color = QtGui.QColor(*annotation.line_color)
+        if annotation.fill_color:
+            shape.fill_color = QtGui.QColor(*annotation.fill_color)
+        shape.close()
+        return shape
+
+    def toAnnotation(self):
+        # Colors are only stored when set on the shape itself.
+        line_color = self.__dict__.get('line_color')
+        fill_color = self.__dict__.get('fill_color')
+        return Annotation(
+            label=self.label,
+            points=self.pointArray(),
+            shape_type=self.shape_type,
+            flags=self.flags,
+            line_color=list(line_color.getRgb()) if line_color else None,
+            fill_color=list(fill_color.getRgb()) if fill_color else None,
+        )
+
+    @property
+    def points(self):
+        if self._points is None:
+            self._points = [QtCore.QPointF(x, y)
+                            for x, y in self._array.tolist()]
+        return self._points
+
+    @points.setter
+    def points(self, value):
+        self._points = value
+        self._invalidate()
+
+    def _invalidate(self):
+        # Drop everything derived from the points, shape_type or closed
+        # state; it is rebuilt lazily on next use.
+        if self._points is None:
+            # The array is the only copy of the vertices so far, build the
+            # points from it before it goes.
+            self._points = self.points
+        self._array = None
+        self._path = None
+        self._line_path = None
+        self._bounding_rect = None
+        self._vrtx_path = None
+        self._vrtx_key = None
+        self._simple_path = None
+        self._simple_key = None
+
+    def __getstate__(self):
+        # Cached QPainterPaths cannot be copied or pickled.
+        state = self.__dict__.copy()
+        for key in ['_path', '_line_path', '_bounding_rect',
+                    '_vrtx_path', '_vrtx_key', '_simple_path', '_simple_key']:
+            state[key] = None
+        if state['_points'] is not None:
+            state['_array'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def pointArray(self):
+        """Vertices as a contiguous (N, 2) float array, rebuilt on change."""
+        if self._array is None:
+            self._array = np.array(
+                [(p.x(), p.y()) for p in self._points], dtype=np.float64,
+            ).reshape(-1, 2)
+        return self._array
+
     @property
     def shape_type(self):
         return self._shape_type
@@ -70,33 +154,40 @@ class Shape(object):
     def shape_type(self, value):
         if value is None:
             value = 'polygon'
-        if value not in ['polygon', 'rectangle', 'point',
-           'line', 'circle', 'linestrip']:
+        if value not in SHAPE_TYPES:
             raise ValueError('Unexpected shape_type: {}'.format(value))
         self._shape_type = value
+        self._invalidate()
 
     def close(self):
         self._closed = True
+        self._line_path = None
+        self._simple_path = None
 
     def addPoint(self, point):
         if self.points and point == self.points[0]:
             self.close()
         else:
             self.points.append(point)
+            self._invalidate()
 
     def popPoint(self):
         if self.points:
+            self._invalidate()
             return self.points.pop()
         return None
 
     def insertPoint(self, i, point):
         self.points.insert(i, point)
+        self._invalidate()
 
     def isClosed(self):
         return self._closed
 
     def setOpen(self):
         self._closed = False
+        self._line_path = None
+        self._simple_path = None
 
     def getRectFromLine(self, pt1, pt2):
         x1, y1 = pt1.x(), pt1.y()
@@ -104,7 +195,7 @@ class Shape(object):
         return QtCore.QRectF(x1, y1, x2 - x1, y2 - y1)
 
     def paint(self, painter):
-        if self.points:
+        if len(self):
             color = self.select_line_color \
                 if self.selected else self.line_color
             pen = QtGui.QPen(color)
@@ -112,40 +203,8 @@ class Shape(object):
             pen.setWidth(max(1, int(round(2.0 / self.scale))))
             painter.setPen(pen)
 
-            line_path = QtGui.QPainterPath()
-            vrtx_path = QtGui.QPainterPath()
-
-            if self.shape_type == 'rectangle':
-                assert len(self.points) in [1, 2]
-                if len(self.points) == 2:
-                    rectangle = self.getRectFromLine(*self.points)
-                    line_path.addRect(rectangle)
-                for i in range(len(self.points)):
-                    self.drawVertex(vrtx_path, i)
-            elif self.shape_type == "circle":
-                assert len(self.points) in [1, 2]
-                if len(self.points) == 2:
-                    rectangle = self.getCircleRectFromLine(self.points)
-                    line_path.addEllipse(rectangle)
-                for i in range(len(self.points)):
-                    self.drawVertex(vrtx_path, i)
-            elif self.shape_type == "linestrip":
-                line_path.moveTo(self.points[0])
-                for i, p in enumerate(self.points):
-                    line_path.lineTo(p)
-                    self.drawVertex(vrtx_path, i)
-            else:
-                line_path.moveTo(self.points[0])
-                # Uncommenting the following line will draw 2 paths
-                # for the 1st vertex, and make it non-filled, which
-                # may be desirable.
-                # self.drawVertex(vrtx_path, 0)
-
-                for i, p in enumerate(self.points):
-                    line_path.lineTo(p)
-                    self.drawVertex(vrtx_path, i)
-                if self.isClosed():
-                    line_path.lineTo(self.points[0])
+            line_path = self.linePath()
+            vrtx_path = self.vertexPath()
 
             painter.drawPath(line_path)
             painter.drawPath(vrtx_path)
@@ -155,6 +214,94 @@ class Shape(object):
                     if self.selected else self.fill_color
                 painter.fillPath(line_path, color)
 
+    def paintSimplified(self, painter):
+        """Level-of-detail version of `paint` for shapes small on screen.
+
+        The outline is simplified to about one screen pixel and no vertex
+        markers are drawn; shapes below one pixel become a single dot.
+        """
+        if not len(self):
+            return
+        color = self.select_line_color \
+            if self.selected else self.line_color
+        pen = QtGui.QPen(color)
+        pen.setWidth(max(1, int(round(2.0 / self.scale))))
+        painter.setPen(pen)
+
+        rect = self.boundingRect()
+        if max(rect.width(), rect.height()) * self.scale < 1:
+            painter.drawPoint(rect.center())
+            return
+        if self.shape_type in ['polygon', 'linestrip']:
+            path = self.simplifiedPath(1.0 / self.scale)
+        else:
+            path = self.linePath()
+        painter.drawPath(path)
+        if self.fill:
+            color = self.select_fill_color \
+                if self.selected else self.fill_color
+            painter.fillPath(path, color)
+
+    def simplifiedPath(self, tolerance):
+        # Round the tolerance up to a power of two so that the cached path
+        # survives small zoom changes.
+        key = 2 ** math.ceil(math.log(tolerance, 2)) if tolerance > 0 else 0
+        if self._simple_path is None or self._simple_key != key:
+            points = utils.simplify_points(self.pointArray(), key)
+            path = QtGui.QPainterPath(QtCore.QPointF(*points[0]))
+            for x, y in points[1:]:
+                path.lineTo(x, y)
+            if self.shape_type == 'polygon' and self.isClosed():
+                path.closeSubpath()
+            self._simple_path = path
+            self._simple_key = key
+        return self._simple_path
+
+    def linePath(self):
+        """Outline drawn by `paint`, cached until the shape changes."""
+        if self._line_path is not None:
+            return self._line_path
+        line_path = QtGui.QPainterPath()
+        if self.shape_type == 'rectangle':
+            assert len(self.points) in [1, 2]
+            if len(self.points) == 2:
+                rectangle = self.getRectFromLine(*self.points)
+                line_path.addRect(rectangle)
+        elif self.shape_type == "circle":
+            assert len(self.points) in [1, 2]
+            if len(self.points) == 2:
+                rectangle = self.getCircleRectFromLine(self.points)
+                line_path.addEllipse(rectangle)
+        else:
+            points = self.pointArray().tolist()
+            line_path.moveTo(*points[0])
+            for x, y in points:
+                line_path.lineTo(x, y)
+            if self.shape_type != 'linestrip' and self.isClosed():
+                line_path.lineTo(*points[0])
+        self._line_path = line_path
+        return line_path
+
+    def vertexPath(self):
+        """Vertex markers, cached per scale and highlighted vertex."""
+        key = (self.scale, self.point_size, self.point_type,
+               self._highlightIndex, self._highlightMode)
+        if self._vrtx_path is None or self._vrtx_key != key:
+            vrtx_path = QtGui.QPainterPath()
+            # Uncommenting the following line will draw 2 paths
+            # for the 1st vertex, and make it non-filled, which
+            # may be desirable.
+            # self.drawVertex(vrtx_path, 0)
+            for i in range(len(self.points)):
+                self.drawVertex(vrtx_path, i)
+            self._vrtx_path = vrtx_path
+            self._vrtx_key = key
+        if self._highlightIndex is not None:
+            self.vertex_fill_color = self.hvertex_fill_color
+        else:
+            self.vertex_fill_color = Shape.vertex_fill_color
+        return self._vrtx_path
+
     def drawVertex(self, path, i):
         d = self.point_size / self.scale
         shape = self.point_type
@@ -174,25 +321,12 @@ class Shape(object):
             assert False, "unsupported vertex shape"
 
     def nearestVertex(self, point, epsilon):
-        min_distance = float('inf')
-        min_i = None
-        for i, p in enumerate(self.points):
-            dist = utils.distance(p - point)
-            if dist <= epsilon and dist < min_distance:
-                min_distance = dist
-                min_i = i
-        return min_i
+        return utils.nearest_vertex(
+            self.pointArray(), (point.x(), point.y()), epsilon)
 
     def nearestEdge(self, point, epsilon):
-        min_distance = float('inf')
-        post_i = None
-        for i in range(len(self.points)):
-            line = [self.points[i - 1], self.points[i]]
-            dist = utils.distancetoline(point, line)
-            if dist <= epsilon and dist < min_distance:
-                min_distance = dist
-                post_i = i
-        return post_i
+        return utils.nearest_edge(
+            self.pointArray(), (point.x(), point.y()), epsilon)
 
     def containsPoint(self, point):
         return self.makePath().contains(point)
@@ -208,6 +342,8 @@ class Shape(object):
         return rectangle
 
     def makePath(self):
+        if self._path is not None:
+            return self._path
         if self.shape_type == 'rectangle':
             path = QtGui.QPainterPath()
             if len(self.points) == 2:
@@ -219,19 +355,42 @@ class Shape(object):
                 rectangle = self.getCircleRectFromLine(self.points)
                 path.addEllipse(rectangle)
         else:
-            path = QtGui.QPainterPath(self.points[0])
-            for p in self.points[1:]:
-                path.lineTo(p)
+            points = self.pointArray().tolist()
+            path = QtGui.QPainterPath(QtCore.QPointF(*points[0]))
+            for x, y in points[1:]:
+                path.lineTo(x, y)
+        self._path = path
         return path
 
+    def bounds(self):
+        """(xmin, ymin, xmax, ymax) of the shape, from its vertex array."""
+        return points_bounds(self.pointArray(), self.shape_type)
+
     def boundingRect(self):
-        return self.makePath().boundingRect()
+        if self._bounding_rect is None:
+            if len(self):
+                xmin, ymin, xmax, ymax = self.bounds()
+                self._bounding_rect = QtCore.QRectF(
+                    xmin, ymin, xmax - xmin, ymax - ymin)
+            else:
+                self._bounding_rect = QtCore.QRectF()
+        return self._bounding_rect
+
+    @classmethod
+    def paintMargin(cls):
+        """How far painting may go outside `boundingRect`, in image pixels.
+
+        Half of the largest vertex marker plus the outline width.
+        """
+        return cls.point_size * cls.max_highlight_size / 2.0 / cls.scale + \
+            max(1, int(round(2.0 / cls.scale)))
 
     def moveBy(self, offset):
         self.points = [p + offset for p in self.points]
 
     def moveVertexBy(self, i, offset):
         self.points[i] = self.points[i] + offset
+        self._invalidate()
 
     def highlightVertex(self, i, action):
         self._highlightIndex = i
@@ -244,10 +403,13 @@ class Shape(object):
         return copy.deepcopy(self)
 
     def __len__(self):
-        return len(self.points)
+        if self._points is None:
+            return len(self._array)
+        return len(self._points)
 
     def __getitem__(self, key):
         return self.points[key]
 
     def __setitem__(self, key, value):
         self.points[key] = value
+        self._invalidate()
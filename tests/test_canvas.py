@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+QtWidgets = pytest.importorskip('PyQt5.QtWidgets')
+
+from rstools.annotation import Annotation
+from rstools.shape import Shape
+from rstools.utils import GridIndex
+from rstools.widgets import Canvas
+
+
+@pytest.fixture(scope='module')
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def make_shape(label):
+    return Shape.fromAnnotation(
+        Annotation(label, [[0, 0], [10, 0], [10, 10]]))
+
+
+def test_grid_index_insert_after_set_order():
+    index = GridIndex()
+    for item in 'abc':
+        index.insert(item, (0, 0, 1, 1))
+    index.setOrder('a', 3.5)
+    index.insert('d', (0, 0, 1, 1))
+    assert index.query((0, 0, 1, 1)) == ['b', 'c', 'a', 'd']
+
+
+def test_append_after_move_to_end(app):
+    canvas = Canvas()
+    shapes = [make_shape(label) for label in 'abc']
+    canvas.loadShapes(shapes)
+    canvas.reorderShapes([0, 1], [1, 2])
+    d = make_shape('d')
+    canvas.loadShapes([d], replace=False)
+    expected = [shapes[2], shapes[0], shapes[1], d]
+    assert canvas.shapes == expected
+    assert canvas.shapeIndex.query((0, 0, 10, 10)) == expected
@@ -0,0 +1,27 @@
+import warnings
+
+import numpy as np
+import pytest
+
+QtCore = pytest.importorskip('PyQt5.QtCore')
+
+from rstools import utils
+from rstools.utils.qt import distancetoline
+
+
+def test_distances_to_edges_match_distancetoline():
+    rs = np.random.RandomState(0)
+    points = rs.randn(2000, 2) * 100
+    # Degenerate edges, and coordinates rounded like pixel positions.
+    points[rs.rand(len(points)) < 0.05] = points[0]
+    points[::3] = points[::3].round(1)
+    qpoints = [QtCore.QPointF(x, y) for x, y in points]
+    for point in rs.randn(50, 2) * 100:
+        got = utils.distances_to_edges(points, point)
+        q = QtCore.QPointF(*point)
+        with warnings.catch_warnings():
+            # Division by zero for degenerate edges, 2-D np.cross.
+            warnings.simplefilter('ignore')
+            expected = [distancetoline(q, (qpoints[i - 1], qpoints[i]))
+                        for i in range(len(qpoints))]
+        np.testing.assert_array_equal(got, expected)
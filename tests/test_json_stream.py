@@ -0,0 +1,51 @@
+import io
+import json
+
+import numpy as np
+import PIL.Image
+
+from rstools.label_file import LabelFile
+from rstools.utils import iter_label_file
+
+
+def test_skipped_string_range_with_split_character():
+    # The multibyte key after imageData is cut by the end of a chunk for
+    # some of the paddings and chunk sizes.
+    for pad in range(8):
+        data = {'a': 'x' * pad, 'imageData': 'QUJD' * 10, '中文中文': 1}
+        raw = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        for chunk_size in range(1, 8):
+            items = dict(iter_label_file(io.BytesIO(raw),
+                                         chunk_size=chunk_size))
+            start, end = items['imageData']
+            assert raw[start:end] == b'QUJD' * 10
+            assert items['中文中文'] == 1
+
+
+def test_embedded_image_with_split_character(tmp_path):
+    # A label file saved as usual, with a multibyte key after imageData
+    # moved across the end of the first 64 KiB chunk read.
+    pixels = np.random.RandomState(0).randint(
+        0, 256, (128, 127, 3), dtype=np.uint8)
+    f = io.BytesIO()
+    PIL.Image.fromarray(pixels).save(f, format='PNG')
+    image_data = f.getvalue()
+    filename = str(tmp_path / 'label.json')
+    key = '中文说明'
+
+    def save(pad):
+        LabelFile().save(
+            filename, shapes=[], imagePath='x' * pad + '.png',
+            imageHeight=128, imageWidth=127, imageData=image_data,
+            otherData={key: '标注'})
+
+    save(0)
+    with open(filename, 'rb') as f:
+        start = f.read().index(key.encode('utf-8'))
+    first = 1 << 16
+    assert start < first
+    for pad in range(first - start - 12, first - start + 1):
+        save(pad)
+        label_file = LabelFile(filename)
+        assert label_file.imageData == image_data
+        assert label_file.otherData[key] == '标注'
@@ -0,0 +1,138 @@
+import collections
+
+
+# Rough cost of keeping one vertex (a QPointF and its list slot) and one
+# shape reference alive, used to keep the history under its memory cap.
+POINT_BYTES = 64
+SHAPE_BYTES = 512
+
+
+class AddShapes(object):
+
+    """Shapes appended at the end of the canvas."""
+
+    def __init__(self, shapes):
+        self.shapes = list(shapes)
+        self.nbytes = SHAPE_BYTES * len(self.shapes)
+
+    def undo(self, canvas):
+        canvas.removeShapes(self.shapes)
+
+
+def move_items(items, source, target):
+    """List of `items` with the ones at positions `source` moved.
+
+    Item `source[i]` ends up at position `target[i]`; the others keep
+    their order in the remaining positions.
+    """
+    n = len(items)
+    moved = set(source)
+    if len(target) != len(source) or len(moved) != len(source) or \
+            len(set(target)) != len(target) or \
+            not all(0 <= i < n for i in source) or \
+            not all(0 <= i < n for i in target):
+        raise ValueError('Invalid move of items')
+    rest = iter([item for i, item in enumerate(items) if i not in moved])
+    placed = dict(zip(target, (items[i] for i in source)))
+    return [placed[i] if i in placed else next(rest)
+            for i in range(n)]
+
+
+class MoveShapes(object):
+
+    """Shapes moved in the stacking order, from `source` to `target`."""
+
+    def __init__(self, source, target):
+        self.source = list(source)
+        self.target = list(target)
+        self.nbytes = SHAPE_BYTES + 16 * len(self.source)
+
+    def undo(self, canvas):
+        canvas.moveShapesTo(self.target, self.source)
+
+
+class RemoveShapes(object):
+
+    """Shapes removed from the canvas, with the positions they had."""
+
+    def __init__(self, indexed_shapes):
+        self.indexed_shapes = sorted(indexed_shapes, key=lambda x: x[0])
+        self.nbytes = sum(SHAPE_BYTES + POINT_BYTES * len(shape)
+                          for _, shape in self.indexed_shapes)
+
+    def undo(self, canvas):
+        canvas.insertShapes(self.indexed_shapes)
+
+
+class EditPoints(object):
+
+    """Shapes moved or vertex-edited, with their points before the edit."""
+
+    def __init__(self, points):
+        # Points are replaced, never modified in place, so a shallow copy
+        # of each list is enough to restore them.
+        self.points = {shape: list(pts) for shape, pts in points.items()}
+        self.nbytes = sum(SHAPE_BYTES + POINT_BYTES * len(pts)
+                          for pts in self.points.values())
+
+    def undo(self, canvas):
+        for shape, points in self.points.items():
+            canvas.setShapePoints(shape, points)
+
+
+class ReplaceShapes(object):
+
+    """The whole shape list replaced, e.g. reordered from the label list."""
+
+    def __init__(self, shapes):
+        self.shapes = list(shapes)
+        self.nbytes = 8 * len(self.shapes)
+
+    def undo(self, canvas):
+        canvas.replaceShapes(self.shapes)
+
+
+class UndoStack(object):
+
+    """Bounded history of edit commands.
+
+    Only what changed is recorded, and the oldest commands are dropped once
+    there are more than `depth` of them or their estimated size exceeds
+    `max_bytes`.
+    """
+
+    def __init__(self, depth=10, max_bytes=64 * 1024 * 1024):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.clear()
+
+    def clear(self):
+        self._commands = collections.deque()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __bool__(self):
+        return bool(self._commands)
+
+    __nonzero__ = __bool__
+
+    def push(self, command):
+        self._commands.append(command)
+        self.nbytes += command.nbytes
+        while self._commands and (len(self._commands) > self.depth or
+                                  self.nbytes > self.max_bytes):
+            self.nbytes -= self._commands.popleft().nbytes
+
+    def pop(self):
+        command = self._commands.pop()
+        self.nbytes -= command.nbytes
+        return command
+
+    def top(self):
+        return self._commands[-1] if self._commands else None
+
+    def undo(self, canvas):
+        if self._commands:
+            self.pop().undo(canvas)
@@ -5,13 +5,66 @@ from .image import apply_exif_orientation
 from .image import img_arr_to_b64
 from .image import img_b64_to_arr
 from .image import img_data_to_png_data
+from .image import img_data_to_size
 
-from .qt import newIcon
-from .qt import newButton
-from .qt import newAction
-from .qt import addActions
-from .qt import labelValidator
-from .qt import struct
-from .qt import distance
-from .qt import distancetoline
-from .qt import fmtShortcut
+from .geometry import clip_polygon
+from .geometry import clip_polyline
+from .geometry import distances_to_edges
+from .geometry import distances_to_points
+from .geometry import nearest_edge
+from .geometry import nearest_vertex
+from .geometry import simplify_points
+
+from .spatial import GridIndex
+
+from .raster import ArrayReader
+from .raster import RasterError
+from .raster import TiffReader
+from .raster import check_pil_image
+from .raster import open_mapped_raster
+from .raster import open_raster
+
+from .stretch import STRETCH_MODES
+from .stretch import apply_lut
+from .stretch import band_limits
+from .stretch import stretch_lut
+from .stretch import stretch_values
+
+from .statistics import RasterStatistics
+from .statistics import compute_statistics
+from .statistics import load_statistics
+from .statistics import raster_statistics
+from .statistics import save_statistics
+
+from .json_stream import JSONStreamError
+from .json_stream import iter_json_object
+from .json_stream import iter_label_file
+
+from .rasterize import Rasterizer
+from .rasterize import iter_mask_bands
+from .rasterize import mask_dtype
+from .rasterize import rasterize_masks
+from .rasterize import write_masks
+
+# The Qt helpers are only imported when first used, so that everything
+# else works without PyQt5 and a display, e.g. from the command line.
+_qt_names = [
+    'newIcon',
+    'newButton',
+    'newAction',
+    'addActions',
+    'labelValidator',
+    'img_arr_to_qimage',
+    'struct',
+    'distance',
+    'distancetoline',
+    'fmtShortcut',
+]
+
+
+def __getattr__(name):
+    if name in _qt_names:
+        from . import qt
+        return getattr(qt, name)
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,144 @@
+import numpy as np
+
+
+def distances_to_points(points, point):
+    """Distance from `point` to each row of the (N, 2) array `points`."""
+    d = points - np.asarray(point, dtype=np.float64)
+    return np.sqrt(d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1])
+
+
+def _dot(a, b):
+    # Row by row dot products, through the same kernel as np.dot of two
+    # vectors: a0 * b0 + a1 * b1 written out can differ in the last bit.
+    return np.matmul(a[:, None, :], b[:, :, None])[:, 0, 0]
+
+
+def distances_to_edges(points, point):
+    """Distance from `point` to each edge `(points[i - 1], points[i])`.
+
+    This is `distancetoline` evaluated for all the edges of a closed
+    polyline at once, with the same results, including NaN for degenerate
+    edges whose end points coincide.
+    """
+    p1 = np.roll(points, 1, axis=0)
+    p2 = points
+    p3 = np.broadcast_to(np.asarray(point, dtype=np.float64), p2.shape)
+    d21 = p2 - p1
+    d31 = p3 - p1
+    d32 = p3 - p2
+    d13 = p1 - p3
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cross = np.abs(d21[:, 0] * d13[:, 1] - d21[:, 1] * d13[:, 0])
+        dist = cross / np.sqrt(_dot(d21, d21))
+    dist = np.where(_dot(d32, p1 - p2) < 0, np.sqrt(_dot(d32, d32)), dist)
+    dist = np.where(_dot(d31, d21) < 0, np.sqrt(_dot(d31, d31)), dist)
+    return dist
+
+
+def simplify_points(points, tolerance):
+    """Drop consecutive vertices falling in the same `tolerance` grid cell.
+
+    Cheap level-of-detail reduction for drawing outlines that are small on
+    screen; the first and last vertices are always kept.
+    """
+    if len(points) <= 2 or tolerance <= 0:
+        return points
+    cells = np.floor(points / tolerance)
+    keep = np.empty(len(points), dtype=bool)
+    keep[0] = True
+    keep[1:] = (cells[1:] != cells[:-1]).any(axis=1)
+    keep[-1] = True
+    return points[keep]
+
+
+def _nearest(dist, epsilon):
+    # First index of the smallest distance within epsilon, like a loop
+    # keeping the first strictly smaller value; NaN never matches.
+    with np.errstate(invalid='ignore'):
+        dist = np.where(dist <= epsilon, dist, np.inf)
+    if not len(dist):
+        return None
+    i = int(np.argmin(dist))
+    if dist[i] == np.inf:
+        return None
+    return i
+
+
+def nearest_vertex(points, point, epsilon):
+    return _nearest(distances_to_points(points, point), epsilon)
+
+
+def nearest_edge(points, point, epsilon):
+    return _nearest(distances_to_edges(points, point), epsilon)
+
+
+def clip_polygon(points, box):
+    """Part of a polygon inside `box` (x1, y1, x2, y2).
+
+    Sutherland-Hodgman clipping against each side of the box in turn,
+    vectorized over the vertices; the result may have fewer than 3
+    vertices when the polygon is outside.
+    """
+    x1, y1, x2, y2 = box
+    if len(points) and points[:, 0].min() >= x1 and \
+            points[:, 0].max() <= x2 and points[:, 1].min() >= y1 and \
+            points[:, 1].max() <= y2:
+        return points
+    for axis, bound, sign in [(0, x1, 1), (0, x2, -1),
+                              (1, y1, 1), (1, y2, -1)]:
+        if not len(points):
+            break
+        # Inside where v >= 0.
+        v = (points[:, axis] - bound) * sign
+        inside = v >= 0
+        if inside.all():
+            continue
+        prev = np.roll(points, 1, axis=0)
+        prev_v = np.roll(v, 1)
+        # Where the edge from the previous vertex crosses the side, its
+        # intersection comes before the vertex.
+        cross = inside != np.roll(inside, 1)
+        t = (prev_v[cross] / (prev_v[cross] - v[cross]))[:, None]
+        counts = cross.astype(np.int64) + inside
+        positions = np.cumsum(counts) - counts
+        out = np.empty((int(counts.sum()), 2))
+        out[positions[cross]] = \
+            prev[cross] + (points[cross] - prev[cross]) * t
+        out[(positions + cross)[inside]] = points[inside]
+        points = out
+    return points
+
+
+def clip_polyline(points, box):
+    """Parts of a polyline inside `box` (x1, y1, x2, y2), as a list.
+
+    Each segment is clipped with the Liang-Barsky method, vectorized over
+    the segments; consecutive segments left whole are joined again.
+    """
+    x1, y1, x2, y2 = box
+    p0 = points[:-1]
+    d = points[1:] - p0
+    t0 = np.zeros(len(d))
+    t1 = np.ones(len(d))
+    rejected = np.zeros(len(d), dtype=bool)
+    for p, q in [(-d[:, 0], p0[:, 0] - x1), (d[:, 0], x2 - p0[:, 0]),
+                 (-d[:, 1], p0[:, 1] - y1), (d[:, 1], y2 - p0[:, 1])]:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = q / p
+        t0 = np.where(p < 0, np.maximum(t0, r), t0)
+        t1 = np.where(p > 0, np.minimum(t1, r), t1)
+        rejected |= (p == 0) & (q < 0)
+    kept = np.flatnonzero(~rejected & (t0 <= t1))
+    starts = p0 + d * t0[:, None]
+    ends = p0 + d * t1[:, None]
+    parts = []
+    part = None
+    for i in kept.tolist():
+        if part is not None and i == last + 1 and t0[i] == 0 and \
+                t1[last] == 1:
+            part.append(ends[i])
+        else:
+            part = [starts[i], ends[i]]
+            parts.append(part)
+        last = i
+    return [np.array(part) for part in parts]
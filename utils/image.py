@@ -14,6 +14,13 @@ def img_b64_to_arr(img_b64):
     return img_arr
 
 
+def img_data_to_size(img_data):
+    """Read (height, width) from the image header without decoding it."""
+    with io.BytesIO(img_data) as f:
+        width, height = PIL.Image.open(f).size
+    return height, width
+
+
 def img_arr_to_b64(img_arr):
     img_pil = PIL.Image.fromarray(img_arr)
     f = io.BytesIO()
@@ -0,0 +1,158 @@
+import codecs
+import json
+
+
+class JSONStreamError(ValueError):
+    pass
+
+
+_WHITESPACE = ' \t\n\r'
+_AFTER_VALUE = _WHITESPACE + ',:]}'
+
+
+class _Reader(object):
+
+    """Decoded text of a binary file, read in chunks as it is consumed."""
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.bytes_read = 0
+        self.eof = False
+
+    def fill(self, size=None):
+        """Read more text, False at the end of the file."""
+        if self.eof:
+            return False
+        data = self.f.read(size or self.chunk_size)
+        self.bytes_read += len(data)
+        if self.pos > len(self.buf) // 2:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        self.buf += self.decoder.decode(data, final=not data)
+        if not data:
+            self.eof = True
+        return True
+
+    def offset(self):
+        """Byte offset in the file of the current position."""
+        # The bytes of a character cut by the end of the last chunk are
+        # read but still held by the decoder, not in the buffer.
+        pending = len(self.decoder.getstate()[0])
+        return self.bytes_read - pending - \
+            len(self.buf[self.pos:].encode('utf-8'))
+
+    def peek(self):
+        """Next non-whitespace character, without consuming it."""
+        while True:
+            while self.pos < len(self.buf) and \
+                    self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                raise JSONStreamError('Unexpected end of file')
+
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise JSONStreamError('Expected {!r} at byte {}, got {!r}'.format(
+                chars, self.offset(), c))
+        self.pos += 1
+        return c
+
+    def value(self, decoder=json.JSONDecoder()):
+        """Decode the next JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                value, end = None, None
+            # A number cut by the end of the buffer parses as a shorter
+            # one, so the value must be followed by what may come next.
+            if end is not None and (self.eof or (
+                    end < len(self.buf) and self.buf[end] in _AFTER_VALUE)):
+                self.pos = end
+                return value
+            # Read at least as much as is buffered so a large value is
+            # parsed again a logarithmic number of times only.
+            if not self.fill(max(self.chunk_size, len(self.buf) - self.pos)):
+                if end is not None:
+                    self.pos = end
+                    return value
+                raise JSONStreamError(
+                    'Invalid JSON value at byte {}'.format(self.offset()))
+
+    def skip_string(self):
+        """Skip a string, returning the byte range of its content."""
+        self.expect('"')
+        start = self.offset()
+        while True:
+            i = self.buf.find('"', self.pos)
+            if i < 0:
+                # Keep trailing backslashes, they may escape the next quote.
+                self.pos = max(self.pos, len(self.buf.rstrip('\\')))
+                if not self.fill():
+                    raise JSONStreamError('Unterminated string')
+                continue
+            backslashes = 0
+            while i - backslashes - 1 >= self.pos and \
+                    self.buf[i - backslashes - 1] == '\\':
+                backslashes += 1
+            self.pos = i + 1
+            if backslashes % 2 == 0:
+                return start, self.offset() - 1
+
+
+def iter_json_object(f, arrays=None, skip=(), chunk_size=1 << 16):
+    """Parse a JSON object incrementally from a binary file object.
+
+    Yields `(key, value)` for the top-level keys in file order.  The
+    elements of an array under a key of the dict `arrays` are yielded one
+    by one, as soon as they are parsed, under the name `arrays[key]`.
+    String values of the keys in `skip` are not decoded: their value is
+    the `(start, end)` byte range of the string content in the file.
+    Memory use is bounded by the largest single value kept.
+    """
+    arrays = arrays or {}
+    reader = _Reader(f, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        c = reader.peek()
+        if key in arrays and c == '[':
+            reader.expect('[')
+            if reader.peek() != ']':
+                name = arrays[key]
+                while True:
+                    yield name, reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+            else:
+                reader.expect(']')
+        elif key in skip and c == '"':
+            yield key, reader.skip_string()
+        else:
+            yield key, reader.value()
+        if reader.expect(',}') == '}':
+            return
+
+
+def iter_label_file(f, skip=('imageData',), chunk_size=1 << 16):
+    """Parse a label file incrementally from a binary file object.
+
+    Yields `(key, value)` for the top-level keys in file order, except
+    that each element of `shapes` is yielded on its own as
+    `('shape', shape)` as soon as it is parsed.  String values of the keys
+    in `skip` are not decoded: their value is the `(start, end)` byte
+    range of the string content in the file, e.g. to read `imageData`
+    later.  See `iter_json_object`.
+    """
+    return iter_json_object(f, {'shapes': 'shape'}, skip, chunk_size)
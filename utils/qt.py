@@ -67,6 +67,27 @@ class struct(object):
         self.__dict__.update(kwargs)
 
 
+def img_arr_to_qimage(img_arr):
+    """Wrap a uint8 L, RGB or RGBA array as a QImage without copying it.
+
+    The array is kept alive by the returned QImage wrapper, so it must not
+    be modified while the image is in use.
+    """
+    img_arr = np.ascontiguousarray(img_arr)
+    if img_arr.ndim == 2:
+        fmt = QtGui.QImage.Format_Grayscale8
+    elif img_arr.shape[2] == 3:
+        fmt = QtGui.QImage.Format_RGB888
+    elif img_arr.shape[2] == 4:
+        fmt = QtGui.QImage.Format_RGBA8888
+    else:
+        raise ValueError('Unsupported image shape: {}'.format(img_arr.shape))
+    height, width = img_arr.shape[:2]
+    image = QtGui.QImage(img_arr.data, width, height, img_arr.strides[0], fmt)
+    image.ndarray = img_arr
+    return image
+
+
 def distance(p):
     return sqrt(p.x() * p.x() + p.y() * p.y())
 
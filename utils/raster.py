@@ -0,0 +1,471 @@
+import collections
+import math
+import mmap
+import os.path as osp
+import struct as _struct
+import threading
+import zlib
+
+import numpy as np
+import PIL.Image
+import PIL.ImageMode
+
+from .image import apply_exif_orientation
+
+
+# TIFF field types: struct code and size in bytes.
+TIFF_TYPES = {
+    1: ('B', 1), 2: ('c', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8),
+    6: ('b', 1), 7: ('B', 1), 8: ('h', 2), 9: ('i', 4), 10: ('ii', 8),
+    11: ('f', 4), 12: ('d', 8), 13: ('I', 4), 16: ('Q', 8), 17: ('q', 8),
+    18: ('Q', 8),
+}
+
+NEW_SUBFILE_TYPE = 254
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+PREDICTOR = 317
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+SAMPLE_FORMAT = 339
+
+# Compression schemes decoded here: none, Deflate (both codes) and PackBits.
+COMPRESSION_NONE = 1
+COMPRESSION_DEFLATE = [8, 32946]
+COMPRESSION_PACKBITS = 32773
+
+# Decoded chunks of compressed pages kept for the windows that follow,
+# which mostly fall on the same strips or tiles.
+CHUNK_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class RasterError(Exception):
+    pass
+
+
+def _num_levels(width, height):
+    n = 1
+    while width > 1 or height > 1:
+        width, height = max(1, (width + 1) // 2), max(1, (height + 1) // 2)
+        n += 1
+    return n
+
+
+class ArrayReader(object):
+
+    """Raster reader over an array already in memory, shape (H, W, bands).
+
+    Reduced levels are decimated on the fly.
+    """
+
+    def __init__(self, array):
+        if array.ndim == 2:
+            array = array[:, :, None]
+        self._array = array
+        self.height, self.width, self.bands = array.shape
+        self.dtype = array.dtype
+        self.num_levels = _num_levels(self.width, self.height)
+
+    def level_size(self, level):
+        """(width, height) of a level, each level halving the previous."""
+        f = 2 ** level
+        return (max(1, int(math.ceil(self.width / float(f)))),
+                max(1, int(math.ceil(self.height / float(f)))))
+
+    def read_window(self, x, y, w, h, level=0):
+        """Pixels of a window in level coordinates, shape (h, w, bands).
+
+        The window is clipped to the level, so the result may be smaller
+        than requested near the right and bottom edges.
+        """
+        step = 2 ** level
+        return np.array(self._array[y * step:(y + h) * step:step,
+                                    x * step:(x + w) * step:step])
+
+    def close(self):
+        pass
+
+
+def _unpackbits(data):
+    """Decode PackBits data."""
+    out = bytearray()
+    i, n = 0, len(data)
+    while i < n:
+        c = data[i]
+        i += 1
+        if c < 128:
+            out += data[i:i + c + 1]
+            i += c + 1
+        elif c > 128:
+            out += data[i:i + 1] * (257 - c)
+            i += 1
+    return bytes(out)
+
+
+class _TiffPage(object):
+
+    """One image file directory of a TIFF.
+
+    Uncompressed chunks are array views of the mapped file, compressed
+    ones are decoded when read.
+    """
+
+    def __init__(self, data, tags, byteorder):
+        self.width = int(tags[IMAGE_WIDTH][0])
+        self.height = int(tags[IMAGE_LENGTH][0])
+        self.bands = int(tags.get(SAMPLES_PER_PIXEL, [1])[0])
+        bits = set(int(b) for b in tags.get(BITS_PER_SAMPLE, [1]))
+        sample_format = int(tags.get(SAMPLE_FORMAT, [1])[0])
+        self.compression = int(tags.get(COMPRESSION, [1])[0])
+        self.predictor = int(tags.get(PREDICTOR, [1])[0])
+        if self.compression != COMPRESSION_NONE and \
+                self.compression != COMPRESSION_PACKBITS and \
+                self.compression not in COMPRESSION_DEFLATE:
+            raise RasterError(
+                'unsupported TIFF compression {}'.format(self.compression))
+        if len(bits) != 1 or bits.pop() not in [8, 16, 32, 64] or \
+                sample_format not in [1, 2, 3]:
+            raise RasterError('unsupported TIFF sample type')
+        # Horizontal differencing only, of integer samples.
+        if self.predictor not in [1, 2] or \
+                self.predictor == 2 and sample_format == 3:
+            raise RasterError(
+                'unsupported TIFF predictor {}'.format(self.predictor))
+        nbytes = int(tags[BITS_PER_SAMPLE][0]) // 8
+        kind = {1: 'u', 2: 'i', 3: 'f'}[sample_format]
+        self.dtype = np.dtype(byteorder + kind + str(nbytes))
+        self.planar = int(tags.get(PLANAR_CONFIGURATION, [1])[0])
+        self.subfile_type = int(tags.get(NEW_SUBFILE_TYPE, [0])[0])
+        self._data = data
+        if TILE_OFFSETS in tags:
+            self.chunk_w = int(tags[TILE_WIDTH][0])
+            self.chunk_h = int(tags[TILE_LENGTH][0])
+            self._offsets = tags[TILE_OFFSETS]
+            self._counts = tags.get(TILE_BYTE_COUNTS)
+        else:
+            self.chunk_w = self.width
+            self.chunk_h = min(self.height, int(
+                tags.get(ROWS_PER_STRIP, [self.height])[0]))
+            self._offsets = tags[STRIP_OFFSETS]
+            self._counts = tags.get(STRIP_BYTE_COUNTS)
+        self.chunks_x = -(-self.width // self.chunk_w)
+        self.chunks_y = -(-self.height // self.chunk_h)
+        per_plane = self.chunks_x * self.chunks_y
+        planes = self.bands if self.planar == 2 else 1
+        if len(self._offsets) < per_plane * planes:
+            raise RasterError('truncated TIFF chunk table')
+        if self.compression != COMPRESSION_NONE and (
+                self._counts is None or
+                len(self._counts) < per_plane * planes):
+            raise RasterError('truncated TIFF chunk table')
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = 0
+        self._cache_lock = threading.Lock()
+        self._full = None
+        if self.compression == COMPRESSION_NONE:
+            self._full = self._contiguous()
+
+    def _chunk_shape(self, row):
+        # Strips are cut at the bottom of the image, tiles are not.
+        rows = self.chunk_h
+        if self.chunk_w == self.width:
+            rows = min(rows, self.height - row * self.chunk_h)
+        if self.planar == 2:
+            return rows, self.chunk_w
+        return rows, self.chunk_w, self.bands
+
+    def _chunk(self, col, row, plane=0):
+        index = plane * self.chunks_x * self.chunks_y + \
+            row * self.chunks_x + col
+        shape = self._chunk_shape(row)
+        count = int(np.prod(shape))
+        if self.compression == COMPRESSION_NONE:
+            return np.frombuffer(
+                self._data, self.dtype, count=count,
+                offset=int(self._offsets[index])).reshape(shape)
+        with self._cache_lock:
+            chunk = self._cache.get(index)
+            if chunk is not None:
+                self._cache.move_to_end(index)
+                return chunk
+        chunk = self._decode(index, count).reshape(shape)
+        with self._cache_lock:
+            if index not in self._cache:
+                self._cache[index] = chunk
+                self._cache_bytes += chunk.nbytes
+            while self._cache_bytes > CHUNK_CACHE_BYTES and \
+                    len(self._cache) > 1:
+                self._cache_bytes -= self._cache.popitem(last=False)[1].nbytes
+        return chunk
+
+    def _decode(self, index, count):
+        start = int(self._offsets[index])
+        raw = self._data[start:start + int(self._counts[index])]
+        try:
+            if self.compression == COMPRESSION_PACKBITS:
+                raw = _unpackbits(raw)
+            else:
+                raw = zlib.decompress(raw)
+        except zlib.error as e:
+            raise RasterError('invalid TIFF chunk: {}'.format(e))
+        # Writers may pad the last strip to the full strip size.
+        if len(raw) < count * self.dtype.itemsize:
+            raise RasterError('truncated TIFF chunk')
+        chunk = np.frombuffer(raw, self.dtype, count=count)
+        if self.predictor == 2:
+            # Undo the differencing along rows, wrapping around like
+            # the writer did.
+            native = self.dtype.newbyteorder('=')
+            shape = (-1, self.chunk_w) if self.planar == 2 else \
+                (-1, self.chunk_w, self.bands)
+            chunk = np.cumsum(chunk.astype(native).reshape(shape),
+                              axis=1, dtype=native)
+        return chunk
+
+    def _contiguous(self):
+        # Strips stored back to back in a chunky file form one big array.
+        if self.chunk_w != self.width or self.planar != 1:
+            return None
+        row_bytes = self.width * self.bands * self.dtype.itemsize
+        start = int(self._offsets[0])
+        for i in range(self.chunks_y):
+            if int(self._offsets[i]) != start + i * self.chunk_h * row_bytes:
+                return None
+        count = self.width * self.height * self.bands
+        if start + count * self.dtype.itemsize > len(self._data):
+            raise RasterError('truncated TIFF image data')
+        return np.frombuffer(self._data, self.dtype, count=count,
+                             offset=start).reshape(
+                                 self.height, self.width, self.bands)
+
+    def read(self, x, y, w, h, step=1):
+        """Pixels in rows y:y+h:step and columns x:x+w:step."""
+        x2, y2 = min(x + w, self.width), min(y + h, self.height)
+        out_h = max(0, -(-(y2 - y) // step))
+        out_w = max(0, -(-(x2 - x) // step))
+        if self._full is not None:
+            return np.array(self._full[y:y2:step, x:x2:step])
+        out = np.empty((out_h, out_w, self.bands), self.dtype)
+        if not out.size:
+            return out
+        for row in range(y // self.chunk_h, (y2 - 1) // self.chunk_h + 1):
+            cy = row * self.chunk_h
+            # First row of the window falling on the sampling grid.
+            sy = max(y, cy)
+            sy += (y - sy) % step
+            ey = min(y2, cy + self.chunk_h)
+            if sy >= ey:
+                continue
+            oy = (sy - y) // step
+            for col in range(x // self.chunk_w, (x2 - 1) // self.chunk_w + 1):
+                cx = col * self.chunk_w
+                sx = max(x, cx)
+                sx += (x - sx) % step
+                ex = min(x2, cx + self.chunk_w)
+                if sx >= ex:
+                    continue
+                ox = (sx - x) // step
+                rows = slice(sy - cy, ey - cy, step)
+                cols = slice(sx - cx, ex - cx, step)
+                if self.planar == 2:
+                    for b in range(self.bands):
+                        part = self._chunk(col, row, b)[rows, cols]
+                        out[oy:oy + part.shape[0],
+                            ox:ox + part.shape[1], b] = part
+                else:
+                    part = self._chunk(col, row)[rows, cols]
+                    out[oy:oy + part.shape[0],
+                        ox:ox + part.shape[1]] = part
+        return out
+
+
+class TiffReader(ArrayReader):
+
+    """Memory-mapped reader for stripped or tiled (Big)TIFFs.
+
+    Nothing is read up front besides the directory: windows are sliced out
+    of the mapped file, and reduced levels use the reduced-resolution
+    pages stored in the file when there are some, else are decimated.
+    Uncompressed, Deflate and PackBits data are read, decoding only the
+    compressed strips or tiles a window falls on; LZW, JPEG and the other
+    compression schemes raise RasterError.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise RasterError('empty file')
+        if hasattr(self._mmap, 'madvise'):
+            # Windows and decimated levels touch scattered pages, reading
+            # ahead around them would pull most of the file in.
+            self._mmap.madvise(mmap.MADV_RANDOM)
+        try:
+            pages = self._parse()
+        except (IndexError, KeyError, _struct.error) as e:
+            self.close()
+            raise RasterError('invalid TIFF: {}'.format(e))
+        except RasterError:
+            self.close()
+            raise
+        self._page = pages[0]
+        self.width = self._page.width
+        self.height = self._page.height
+        self.bands = self._page.bands
+        self.dtype = self._page.dtype.newbyteorder('=')
+        self.num_levels = _num_levels(self.width, self.height)
+        self._overviews = {}
+        for page in pages[1:]:
+            if not page.subfile_type & 1 or page.bands != self.bands:
+                continue
+            # Writers round reduced sizes either way.
+            for level in range(1, self.num_levels):
+                if abs(page.width - self.level_size(level)[0]) <= 1:
+                    self._overviews[level] = page
+
+    def _parse(self):
+        data = self._mmap
+        byteorder = {b'II': '<', b'MM': '>'}.get(data[:2])
+        if byteorder is None:
+            raise RasterError('not a TIFF file')
+        version, = _struct.unpack(byteorder + 'H', data[2:4])
+        if version == 42:
+            offset, = _struct.unpack(byteorder + 'I', data[4:8])
+            count_fmt, entry_size, offset_fmt = 'H', 12, 'I'
+        elif version == 43:
+            offset, = _struct.unpack(byteorder + 'Q', data[8:16])
+            count_fmt, entry_size, offset_fmt = 'Q', 20, 'Q'
+        else:
+            raise RasterError('not a TIFF file')
+        count_size = _struct.calcsize(count_fmt)
+        value_size = _struct.calcsize(offset_fmt)
+        pages = []
+        seen = set()
+        while offset and offset not in seen:
+            seen.add(offset)
+            n, = _struct.unpack(byteorder + count_fmt,
+                                data[offset:offset + count_size])
+            tags = {}
+            pos = offset + count_size
+            for _ in range(n):
+                tag, typ = _struct.unpack(byteorder + 'HH', data[pos:pos + 4])
+                count, = _struct.unpack(byteorder + offset_fmt,
+                                        data[pos + 4:pos + 4 + value_size])
+                value_pos = pos + 4 + value_size
+                pos += entry_size
+                if typ not in TIFF_TYPES:
+                    continue
+                code, size = TIFF_TYPES[typ]
+                if count * size > value_size:
+                    value_pos, = _struct.unpack(
+                        byteorder + offset_fmt,
+                        data[value_pos:value_pos + value_size])
+                if typ == 2:
+                    continue
+                dtype = np.dtype(byteorder + code[0])
+                tags[tag] = np.frombuffer(
+                    data, dtype, count=count * len(code), offset=value_pos)
+            offset, = _struct.unpack(byteorder + offset_fmt,
+                                     data[pos:pos + value_size])
+            if IMAGE_WIDTH not in tags:
+                continue
+            try:
+                pages.append(_TiffPage(data, tags, byteorder))
+            except RasterError:
+                if not pages:
+                    raise
+        if not pages:
+            raise RasterError('TIFF file has no image')
+        return pages
+
+    def read_window(self, x, y, w, h, level=0):
+        page = self._overviews.get(level)
+        if level == 0 or page is not None:
+            page = page or self._page
+            arr = page.read(x, y, w, h)
+        else:
+            # Decimate from the closest finer level stored in the file.
+            base = max([0] + [k for k in self._overviews if k < level])
+            step = 2 ** (level - base)
+            page = self._overviews.get(base, self._page)
+            arr = page.read(x * step, y * step, w * step, h * step, step)
+        return arr.astype(self.dtype, copy=False)
+
+    def close(self):
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Arrays still refer to the mapping, it goes away with them.
+            pass
+
+
+def open_mapped_raster(filename):
+    """TiffReader for `filename`, or None if it cannot be read with one."""
+    if osp.splitext(filename)[1].lower() not in ['.tif', '.tiff']:
+        return None
+    try:
+        return TiffReader(filename)
+    except (IOError, RasterError):
+        return None
+
+
+def check_pil_image(image_pil):
+    """Raise RasterError if PIL decodes fewer bands or bits than stored.
+
+    PIL has no mode for most multi-band or high bit depth TIFFs and reads
+    them as 8-bit RGB.
+    """
+    tags = getattr(image_pil, 'tag_v2', None)
+    if tags is None:
+        return
+    samples = int(tags.get(SAMPLES_PER_PIXEL, 1))
+    bits = tags.get(BITS_PER_SAMPLE, 1)
+    bits = max(bits) if isinstance(bits, tuple) else int(bits)
+    mode = PIL.ImageMode.getmode(image_pil.mode)
+    if image_pil.mode == '1':
+        decoded_bits = 1
+    else:
+        decoded_bits = np.dtype(mode.typestr).itemsize * 8
+    if len(mode.bands) < samples or decoded_bits < bits:
+        raise RasterError(
+            'cannot decode {} bands of {} bits, the image would be read '
+            'as {}'.format(samples, bits, image_pil.mode))
+
+
+def open_raster(filename):
+    """Raster reader for any image, memory-mapped when the format allows.
+
+    Other images are decoded in full with PIL, in the bands and sample
+    type it reads them as; RasterError is raised for TIFFs it would read
+    with fewer bands or bits than stored.
+    """
+    reason = None
+    if osp.splitext(filename)[1].lower() in ['.tif', '.tiff']:
+        try:
+            return TiffReader(filename)
+        except RasterError as e:
+            reason = e
+        except IOError as e:
+            raise RasterError(e)
+    try:
+        image_pil = PIL.Image.open(filename)
+    except IOError as e:
+        raise RasterError(e)
+    try:
+        check_pil_image(image_pil)
+    except RasterError as e:
+        if reason is None:
+            raise
+        raise RasterError('{} ({})'.format(e, reason))
+    return ArrayReader(np.asarray(apply_exif_orientation(image_pil)))
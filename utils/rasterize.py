@@ -0,0 +1,297 @@
+"""Scanline rasterization of shapes into label masks, window by window.
+
+Shapes are turned into spans of pixels with numpy for all the shapes of a
+window at once, instead of being drawn one by one.  A pixel belongs to a
+shape when its center, at integer coordinates, is inside: polygons use
+the even-odd rule with edges covering [top, bottom) and [left, right), so
+that adjacent polygons share no pixels and areas add up; rectangles,
+circles and points include their boundary.  Lines and linestrips are
+`line_width` wide, points are discs of radius `point_size`.
+
+Masks are produced in bands of rows, each rasterized tile by tile, and
+`write_masks` writes them to `.npy` files as they come, so that a mask
+larger than memory is never held in it.
+"""
+import numpy as np
+
+
+def _expand(starts, counts):
+    """Concatenated ranges [start, start + count) of each pair."""
+    total = int(counts.sum())
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return offsets + np.arange(total, dtype=np.int64)
+
+
+def _line_quads(points, counts, width):
+    """(N, 4, 2) rectangles of `width` around the segments of polylines.
+
+    `points` are the vertices of the polylines back to back, `counts` the
+    number of vertices of each.  Also returns the polyline of each quad.
+    """
+    ends = np.cumsum(counts)
+    first = np.ones(len(points), dtype=bool)
+    first[ends[:-1]] = False
+    first[0] = False
+    # Segments go from vertex i - 1 to i, within a polyline.
+    segment = np.flatnonzero(first) if len(points) else first[:0]
+    line = np.searchsorted(ends, segment, side='right')
+    p0 = points[segment - 1]
+    p1 = points[segment]
+    d = p1 - p0
+    length = np.hypot(d[:, 0], d[:, 1])
+    keep = length > 0
+    p0, p1, d, length, line = (
+        p0[keep], p1[keep], d[keep], length[keep], line[keep])
+    normal = np.column_stack([-d[:, 1], d[:, 0]]) * (
+        width / 2.0 / length)[:, None]
+    quads = np.stack([p0 + normal, p1 + normal, p1 - normal, p0 - normal],
+                     axis=1)
+    return quads, line
+
+
+class Rasterizer(object):
+
+    """Which shape covers each pixel of a window.
+
+    `annotations` are `rstools.annotation.Annotation`; the shapes are
+    converted once into arrays of polygons, discs and rectangles, and then
+    any number of windows are rasterized from them.
+    """
+
+    def __init__(self, annotations, line_width=10, point_size=5):
+        polygons, polygon_ids = [], []
+        lines, line_ids = [], []
+        discs = []
+        rects = []
+        for i, a in enumerate(annotations):
+            points = a.points
+            if a.shape_type == 'rectangle' and len(points) == 2:
+                (x1, y1), (x2, y2) = points.tolist()
+                rects.append((min(x1, x2), min(y1, y2),
+                              max(x1, x2), max(y1, y2), i))
+            elif a.shape_type == 'circle' and len(points) == 2:
+                (cx, cy), (px, py) = points.tolist()
+                discs.append((cx, cy, np.hypot(px - cx, py - cy), i))
+            elif a.shape_type == 'point' and len(points) == 1:
+                discs.append((points[0, 0], points[0, 1], point_size, i))
+            elif a.shape_type in ['line', 'linestrip'] and len(points) >= 2:
+                lines.append(points)
+                line_ids.append(i)
+            elif a.shape_type == 'polygon' and len(points) >= 3:
+                polygons.append(points)
+                polygon_ids.append(i)
+
+        # Lines become one quad per segment, appended to the polygons.
+        points = np.concatenate(polygons) if polygons else np.empty((0, 2))
+        counts = np.array([len(p) for p in polygons], dtype=np.int64)
+        ids = np.array(polygon_ids, dtype=np.int64)
+        if lines:
+            quads, line = _line_quads(
+                np.concatenate(lines),
+                np.array([len(p) for p in lines], dtype=np.int64),
+                line_width)
+            points = np.concatenate([points, quads.reshape(-1, 2)])
+            counts = np.concatenate(
+                [counts, np.full(len(quads), 4, dtype=np.int64)])
+            ids = np.concatenate(
+                [ids, np.array(line_ids, dtype=np.int64)[line]])
+        starts = np.cumsum(counts) - counts
+        # Edges go from each vertex to the next one, closing each polygon.
+        following = np.arange(1, len(points) + 1)
+        following[starts + counts - 1] = starts
+        self._edges = np.column_stack([points, points[following]])
+        self._edge_starts = starts
+        self._edge_counts = counts
+        self._polygon_ids = ids
+        if len(counts):
+            self._polygon_boxes = np.column_stack([
+                np.minimum.reduceat(points, starts),
+                np.maximum.reduceat(points, starts)])
+        else:
+            self._polygon_boxes = np.empty((0, 4))
+        self._discs = np.array(discs, dtype=np.float64).reshape(-1, 4)
+        self._rects = np.array(rects, dtype=np.float64).reshape(-1, 5)
+        self._disc_boxes = np.column_stack([
+            self._discs[:, 0] - self._discs[:, 2],
+            self._discs[:, 1] - self._discs[:, 2],
+            self._discs[:, 0] + self._discs[:, 2],
+            self._discs[:, 1] + self._discs[:, 2],
+        ])
+
+    @staticmethod
+    def _hits(boxes, row, col, height, width):
+        return ((boxes[:, 0] < col + width) & (boxes[:, 2] >= col - 1) &
+                (boxes[:, 1] < row + height) & (boxes[:, 3] >= row - 1))
+
+    def _polygon_spans(self, row, col, height, width):
+        selected = np.flatnonzero(
+            self._hits(self._polygon_boxes, row, col, height, width))
+        counts = self._edge_counts[selected]
+        edges = self._edges[_expand(self._edge_starts[selected], counts)]
+        polygon = np.repeat(selected, counts)
+        x0, y0, x1, y1 = edges.T
+        horizontal = y0 == y1
+        ylo = np.minimum(y0, y1)
+        yhi = np.maximum(y0, y1)
+        # Rows r with ylo <= r < yhi, within the window.
+        first = np.maximum(np.ceil(ylo), row).astype(np.int64)
+        last = np.minimum(np.ceil(yhi) - 1, row + height - 1).astype(np.int64)
+        n = np.where(horizontal, 0, np.maximum(last - first + 1, 0))
+        edge = np.repeat(np.arange(len(edges)), n)
+        rows = _expand(first, n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (x1 - x0) / (y1 - y0)
+        x = x0[edge] + (rows - y0[edge]) * slope[edge]
+        # Each polygon crosses each row an even number of times: grouped by
+        # polygon and row, and sorted by x, crossings pair up into spans.
+        key = polygon[edge] * height + (rows - row)
+        order = np.argsort(key, kind='stable')
+        key = key[order]
+        x = x[order]
+        starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+        sizes = np.diff(np.r_[starts, len(key)])
+        # Most groups are one pair, ordered below; only sort the others.
+        many = np.flatnonzero(np.repeat(sizes > 2, sizes))
+        if len(many):
+            x[many] = x[many][np.lexsort((x[many], key[many]))]
+        left = np.minimum(x[0::2], x[1::2])
+        right = np.maximum(x[0::2], x[1::2])
+        key = key[0::2]
+        return (key % height + row, np.ceil(left).astype(np.int64),
+                np.ceil(right).astype(np.int64),
+                self._polygon_ids[key // height])
+
+    def _disc_spans(self, row, col, height, width):
+        discs = self._discs[
+            self._hits(self._disc_boxes, row, col, height, width)]
+        cx, cy, r, ids = discs.T
+        first = np.maximum(np.ceil(cy - r), row).astype(np.int64)
+        last = np.minimum(np.floor(cy + r), row + height - 1).astype(np.int64)
+        n = np.maximum(last - first + 1, 0)
+        disc = np.repeat(np.arange(len(discs)), n)
+        rows = _expand(first, n)
+        dy = rows - cy[disc]
+        half = np.sqrt(np.maximum(r[disc] ** 2 - dy * dy, 0))
+        return (rows, np.ceil(cx[disc] - half).astype(np.int64),
+                np.floor(cx[disc] + half).astype(np.int64) + 1,
+                ids[disc].astype(np.int64))
+
+    def _rect_spans(self, row, col, height, width):
+        rects = self._rects[
+            self._hits(self._rects, row, col, height, width)]
+        xmin, ymin, xmax, ymax, ids = rects.T
+        first = np.maximum(np.ceil(ymin), row).astype(np.int64)
+        last = np.minimum(np.floor(ymax), row + height - 1).astype(np.int64)
+        n = np.maximum(last - first + 1, 0)
+        rect = np.repeat(np.arange(len(rects)), n)
+        return (_expand(first, n), np.ceil(xmin[rect]).astype(np.int64),
+                np.floor(xmax[rect]).astype(np.int64) + 1,
+                ids[rect].astype(np.int64))
+
+    def shape_ids(self, row, col, height, width):
+        """(height, width) index of the last shape covering each pixel.
+
+        The window starts at pixel (`row`, `col`); -1 where no shape is.
+        """
+        spans = [self._polygon_spans(row, col, height, width),
+                 self._disc_spans(row, col, height, width),
+                 self._rect_spans(row, col, height, width)]
+        rows, starts, ends, ids = [np.concatenate(a) for a in zip(*spans)]
+        starts = np.maximum(starts, col)
+        ends = np.minimum(ends, col + width)
+        n = np.maximum(ends - starts, 0)
+        pixels = _expand((rows - row) * width + starts - col, n)
+        out = np.full(height * width, -1, dtype=np.int64)
+        # Later shapes are drawn over earlier ones.
+        np.maximum.at(out, pixels, np.repeat(ids, n))
+        return out.reshape(height, width)
+
+
+def mask_dtype(max_value):
+    """Smallest unsigned integer type holding values up to `max_value`."""
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.uint64)
+
+
+def iter_mask_bands(annotations, label_name_to_value, height, width,
+                    instances=False, tile_size=1024, line_width=10,
+                    point_size=5):
+    """Class and instance masks, `tile_size` rows at a time.
+
+    Yields (row, classes, instances) where the masks are the rows from
+    `row` on, rasterized one `tile_size` square at a time; instances is
+    None unless asked for.  Shapes whose label is missing from
+    `label_name_to_value` are skipped.  Instance numbers are the position
+    of the shape in `annotations` plus one, 0 where no shape is.
+    """
+    kept = [i for i, a in enumerate(annotations)
+            if a.label in label_name_to_value]
+    rasterizer = Rasterizer([annotations[i] for i in kept],
+                            line_width=line_width, point_size=point_size)
+    # Index -1, no shape, maps to the last entry: background.
+    values = np.array([label_name_to_value[annotations[i].label]
+                       for i in kept] + [0])
+    values = values.astype(mask_dtype(values.max()))
+    numbers = np.array([i + 1 for i in kept] + [0])
+    numbers = numbers.astype(mask_dtype(len(annotations)))
+    for row in range(0, height, tile_size):
+        h = min(tile_size, height - row)
+        classes = np.empty((h, width), dtype=values.dtype)
+        shapes = np.empty((h, width), dtype=numbers.dtype) \
+            if instances else None
+        for col in range(0, width, tile_size):
+            w = min(tile_size, width - col)
+            ids = rasterizer.shape_ids(row, col, h, w)
+            classes[:, col:col + w] = values[ids]
+            if instances:
+                shapes[:, col:col + w] = numbers[ids]
+        yield row, classes, shapes
+
+
+def rasterize_masks(annotations, label_name_to_value, height, width,
+                    instances=False, **kwargs):
+    """Class mask, and instance mask if asked for, as arrays in memory."""
+    bands = list(iter_mask_bands(annotations, label_name_to_value,
+                                 height, width, instances, **kwargs))
+    classes = np.concatenate([band[1] for band in bands]) if bands else \
+        np.zeros((0, width), dtype=np.uint8)
+    if not instances:
+        return classes, None
+    return classes, np.concatenate([band[2] for band in bands])
+
+
+def _npy_header(f, height, width, dtype):
+    np.lib.format.write_array_header_1_0(f, dict(
+        descr=np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        fortran_order=False,
+        shape=(height, width),
+    ))
+
+
+def write_masks(annotations, label_name_to_value, height, width,
+                class_file, instance_file=None, **kwargs):
+    """Write the masks to `.npy` files band after band.
+
+    Only one band of `tile_size` rows is in memory at a time, whatever
+    the size of the image; the files load with `np.load`, or
+    `np.load(filename, mmap_mode='r')` to read parts of them.
+    """
+    bands = iter_mask_bands(annotations, label_name_to_value, height, width,
+                            instances=instance_file is not None, **kwargs)
+    files = [open(class_file, 'wb')]
+    if instance_file is not None:
+        files.append(open(instance_file, 'wb'))
+    try:
+        for i, (row, classes, shapes) in enumerate(bands):
+            for f, band in zip(files, [classes, shapes]):
+                if not i:
+                    _npy_header(f, height, width, band.dtype)
+                f.write(band.tobytes())
+        if not height:
+            for f in files:
+                _npy_header(f, height, width, np.uint8)
+    finally:
+        for f in files:
+            f.close()
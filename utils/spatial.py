@@ -0,0 +1,109 @@
+import math
+
+
+class GridIndex(object):
+
+    """Uniform grid over item bounding boxes.
+
+    Items are hashed into every cell their box `(x1, y1, x2, y2)` overlaps.
+    Each item also keeps the order in which it was inserted, so queries can
+    return candidates in the same stacking order as the list they mirror.
+    """
+
+    def __init__(self, cell_size=256.0):
+        self.cell_size = float(cell_size)
+        self.clear()
+
+    def clear(self):
+        self._cells = {}
+        self._items = {}
+        self._counter = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def _cellRange(self, box):
+        x1, y1, x2, y2 = box
+        s = self.cell_size
+        return (int(math.floor(x1 / s)), int(math.floor(y1 / s)),
+                int(math.floor(x2 / s)), int(math.floor(y2 / s)))
+
+    def insert(self, item, box):
+        if item in self._items:
+            self.remove(item)
+        cells = self._cellRange(box)
+        ix1, iy1, ix2, iy2 = cells
+        for ix in range(ix1, ix2 + 1):
+            for iy in range(iy1, iy2 + 1):
+                self._cells.setdefault((ix, iy), set()).add(item)
+        self._items[item] = (cells, box, self._counter)
+        self._counter += 1
+
+    def remove(self, item):
+        entry = self._items.pop(item, None)
+        if entry is None:
+            return
+        ix1, iy1, ix2, iy2 = entry[0]
+        for ix in range(ix1, ix2 + 1):
+            for iy in range(iy1, iy2 + 1):
+                cell = self._cells[(ix, iy)]
+                cell.discard(item)
+                if not cell:
+                    del self._cells[(ix, iy)]
+
+    def update(self, item, box):
+        """Move an item to a new box, keeping its stacking order."""
+        entry = self._items.get(item)
+        if entry is None:
+            return self.insert(item, box)
+        cells = self._cellRange(box)
+        order = entry[2]
+        if cells != entry[0]:
+            self.remove(item)
+            ix1, iy1, ix2, iy2 = cells
+            for ix in range(ix1, ix2 + 1):
+                for iy in range(iy1, iy2 + 1):
+                    self._cells.setdefault((ix, iy), set()).add(item)
+        self._items[item] = (cells, box, order)
+
+    def box(self, item):
+        return self._items[item][1]
+
+    def order(self, item):
+        return self._items[item][2]
+
+    def setOrder(self, item, order):
+        """Move an item in the stacking order, e.g. between two others.
+
+        `order` is any number, compared with those of the other items.
+        Items inserted afterwards still stack above it.
+        """
+        cells, box, _ = self._items[item]
+        self._items[item] = (cells, box, order)
+        self._counter = max(self._counter, int(math.floor(order)) + 1)
+
+    def query(self, box):
+        """Items whose box intersects `box`, in stacking order."""
+        x1, y1, x2, y2 = box
+        ix1, iy1, ix2, iy2 = self._cellRange(box)
+        candidates = set()
+        if (ix2 - ix1 + 1) * (iy2 - iy1 + 1) > len(self._cells):
+            for cell in self._cells.values():
+                candidates.update(cell)
+        else:
+            for ix in range(ix1, ix2 + 1):
+                for iy in range(iy1, iy2 + 1):
+                    cell = self._cells.get((ix, iy))
+                    if cell:
+                        candidates.update(cell)
+        items = self._items
+        found = []
+        for item in candidates:
+            bx1, by1, bx2, by2 = items[item][1]
+            if bx1 <= x2 and x1 <= bx2 and by1 <= y2 and y1 <= by2:
+                found.append(item)
+        found.sort(key=lambda item: items[item][2])
+        return found
@@ -0,0 +1,221 @@
+import os
+import os.path as osp
+import warnings
+import zipfile
+
+import numpy as np
+
+
+# Bins of the histograms of floating point bands, between the extremes
+# found on an overview; integer bands get one bin per value.
+FLOAT_BINS = 4096
+# Pixels per block read by compute_statistics.
+BLOCK_PIXELS = 1 << 22
+# Pixels of the overview used for approximate statistics.
+APPROXIMATE_PIXELS = 1 << 20
+
+
+class RasterStatistics(object):
+
+    """Per-band histograms of a raster and the statistics derived from them.
+
+    `histograms` is a (bands, bins) count array whose bin `i` starts at
+    `edges[band] + i * widths[band]`; integer bands have bins of width one
+    starting at the smallest value of their type, so their percentiles
+    are exact.
+    """
+
+    def __init__(self, histograms, edges, widths, minimum, maximum,
+                 approximate=False):
+        self.histograms = histograms
+        self.edges = np.asarray(edges, np.float64)
+        self.widths = np.asarray(widths, np.float64)
+        self.min = np.asarray(minimum, np.float64)
+        self.max = np.asarray(maximum, np.float64)
+        self.approximate = approximate
+
+    @property
+    def bands(self):
+        return len(self.histograms)
+
+    def count(self, band):
+        return int(self.histograms[band].sum())
+
+    def _centers(self, band):
+        n = self.histograms.shape[1]
+        return self.edges[band] + self.widths[band] * (
+            np.arange(n) + (0.5 if self.widths[band] != 1 else 0))
+
+    def mean(self, band):
+        hist = self.histograms[band]
+        if not hist.any():
+            return float('nan')
+        return float(np.dot(hist, self._centers(band)) / hist.sum())
+
+    def std(self, band):
+        hist = self.histograms[band]
+        if not hist.any():
+            return float('nan')
+        d = self._centers(band) - self.mean(band)
+        return float(np.sqrt(np.dot(hist, d * d) / hist.sum()))
+
+    def percentile(self, band, q):
+        """Smallest value with at least `q` percent of the pixels below or
+        at it, clamped to the range of the band."""
+        cum = np.cumsum(self.histograms[band])
+        if not len(cum) or not cum[-1]:
+            return float('nan')
+        i = int(np.searchsorted(cum, cum[-1] * q / 100.0))
+        value = self.edges[band] + self.widths[band] * min(i, len(cum) - 1)
+        return float(min(max(value, self.min[band]), self.max[band]))
+
+    def limits(self, band, mode='percent', low=2.0, high=98.0):
+        """Stretch limits of a band, see `band_limits`."""
+        if mode == 'percent':
+            return self.percentile(band, low), self.percentile(band, high)
+        return float(self.min[band]), float(self.max[band])
+
+    def save(self, file, key):
+        np.savez_compressed(
+            file, key=np.array(key), histograms=self.histograms,
+            edges=self.edges, widths=self.widths, min=self.min, max=self.max,
+            approximate=self.approximate,
+        )
+
+    @classmethod
+    def load(cls, filename, key):
+        with np.load(filename) as data:
+            if data['key'].tolist() != list(key):
+                return None
+            return cls(data['histograms'], data['edges'], data['widths'],
+                       data['min'], data['max'],
+                       approximate=bool(data['approximate']))
+
+
+def _overview_level(reader, max_pixels):
+    level = 0
+    while level < reader.num_levels - 1:
+        w, h = reader.level_size(level)
+        if w * h <= max_pixels:
+            break
+        level += 1
+    return level
+
+
+def compute_statistics(reader, approximate=False, cancelled=None):
+    """Histograms of every band of a raster reader, in one streaming pass.
+
+    The raster is read in blocks of rows so memory use stays bounded.
+    With `approximate`, only an overview of about a million pixels is
+    read, which is enough for stretching but not for exact percentiles.
+    `cancelled` is called before each block; once it returns true, the
+    pass stops and None is returned.
+    """
+    level = _overview_level(reader, APPROXIMATE_PIXELS) if approximate else 0
+    width, height = reader.level_size(level)
+    bands = reader.bands
+    dtype = np.dtype(reader.dtype)
+    if dtype.kind in 'ui' and dtype.itemsize <= 2:
+        info = np.iinfo(dtype)
+        nbins = int(info.max) - int(info.min) + 1
+        edges = np.full(bands, info.min, np.float64)
+        widths = np.ones(bands)
+    else:
+        # Bin floats and wide integers over the range of an overview,
+        # values outside of it fall in the end bins.
+        overview = _overview_level(reader, APPROXIMATE_PIXELS)
+        w, h = reader.level_size(overview)
+        sample = reader.read_window(0, 0, w, h, overview)
+        sample = sample.reshape(-1, bands).astype(np.float64)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            lo = np.nan_to_num(np.nanmin(sample, axis=0))
+            hi = np.nan_to_num(np.nanmax(sample, axis=0))
+        nbins = FLOAT_BINS
+        edges = lo
+        widths = np.maximum(hi - lo, 1e-12) / nbins
+    histograms = np.zeros((bands, nbins), np.int64)
+    minimum = np.full(bands, np.inf)
+    maximum = np.full(bands, -np.inf)
+    rows = max(1, BLOCK_PIXELS // max(1, width))
+    for y in range(0, height, rows):
+        if cancelled is not None and cancelled():
+            return None
+        block = reader.read_window(0, y, width, rows, level)
+        for b in range(bands):
+            values = block[:, :, b].ravel()
+            if dtype.kind == 'f':
+                values = values[~np.isnan(values)]
+            if not len(values):
+                continue
+            minimum[b] = min(minimum[b], values.min())
+            maximum[b] = max(maximum[b], values.max())
+            if widths[b] == 1 and dtype.itemsize <= 2:
+                if dtype.kind == 'i':
+                    values = values.astype(np.int32) - int(edges[b])
+                histograms[b] += np.bincount(values, minlength=nbins)
+            else:
+                index = ((values - edges[b]) / widths[b]).astype(np.int64)
+                np.clip(index, 0, nbins - 1, out=index)
+                histograms[b] += np.bincount(index, minlength=nbins)
+    return RasterStatistics(histograms, edges, widths, minimum, maximum,
+                            approximate=level > 0)
+
+
+def statistics_sidecar(filename):
+    return filename + '.stats.npz'
+
+
+def _sidecar_key(filename):
+    st = os.stat(filename)
+    return [osp.abspath(filename), str(st.st_size), str(st.st_mtime_ns)]
+
+
+def load_statistics(filename):
+    """Statistics saved next to `filename`, or None if missing or stale.
+
+    They are only reused while the path, size and modification time of
+    the raster are those they were computed for.
+    """
+    sidecar = statistics_sidecar(filename)
+    if not osp.exists(sidecar):
+        return None
+    try:
+        return RasterStatistics.load(sidecar, _sidecar_key(filename))
+    except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile):
+        return None
+
+
+def save_statistics(filename, stats):
+    """Write the statistics sidecar of `filename`, False if not possible.
+
+    The sidecar is replaced atomically so readers never see a partial one.
+    """
+    sidecar = statistics_sidecar(filename)
+    tmp = sidecar + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            stats.save(f, _sidecar_key(filename))
+        os.replace(tmp, sidecar)
+    except (IOError, OSError):
+        if osp.exists(tmp):
+            os.remove(tmp)
+        return False
+    return True
+
+
+def raster_statistics(filename, reader, approximate=False, cancelled=None):
+    """Statistics of a raster file, from its sidecar when up to date.
+
+    Exact statistics also serve approximate requests and replace
+    approximate ones in the sidecar once computed.  None when cancelled,
+    see `compute_statistics`.
+    """
+    stats = load_statistics(filename)
+    if stats is not None and (approximate or not stats.approximate):
+        return stats
+    stats = compute_statistics(reader, approximate=approximate,
+                               cancelled=cancelled)
+    if stats is not None:
+        save_statistics(filename, stats)
+    return stats
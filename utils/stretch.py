@@ -0,0 +1,51 @@
+import numpy as np
+
+
+STRETCH_MODES = ['none', 'minmax', 'percent']
+
+
+def band_limits(arr, mode='percent', low=2.0, high=98.0):
+    """Per-band values mapped to 0 and 255 by a stretch of `arr`.
+
+    `arr` is an (H, W, bands) sample of the raster, e.g. an overview.
+    'none' keeps the full range of integer types, 'minmax' uses the range
+    of the data and 'percent' clips `low` and `high` percent of it.
+    """
+    flat = arr.reshape(-1, arr.shape[-1])
+    if mode == 'none' and arr.dtype.kind in 'ui':
+        info = np.iinfo(arr.dtype)
+        n = flat.shape[1]
+        return np.full(n, info.min, np.float64), \
+            np.full(n, info.max, np.float64)
+    if mode in ['none', 'minmax']:
+        return flat.min(axis=0).astype(np.float64), \
+            flat.max(axis=0).astype(np.float64)
+    if mode == 'percent':
+        lo, hi = np.percentile(flat, [low, high], axis=0)
+        return lo, hi
+    raise ValueError('Unexpected stretch mode: {}'.format(mode))
+
+
+def stretch_lut(dtype, low, high):
+    """uint8 lookup table of a linear stretch for 8 or 16 bit integers.
+
+    The table is indexed by the raw value, offset by the minimum of signed
+    types.
+    """
+    info = np.iinfo(dtype)
+    values = np.arange(info.min, info.max + 1, dtype=np.float64)
+    return stretch_values(values, low, high)
+
+
+def stretch_values(arr, low, high):
+    scale = 255.0 / max(high - low, 1e-12)
+    out = (arr - low) * scale
+    np.clip(out, 0, 255, out=out)
+    return (out + 0.5).astype(np.uint8)
+
+
+def apply_lut(arr, lut):
+    """Map an 8 or 16 bit integer array through a `stretch_lut` table."""
+    if arr.dtype.kind == 'i':
+        return lut[arr.astype(np.int32) - np.iinfo(arr.dtype).min]
+    return lut[arr]
@@ -11,6 +11,9 @@ from .canvas import Canvas
 
 from .label_qlist_widget import LabelQListWidget
 
+from .shape_list_view import ShapeListModel
+from .shape_list_view import ShapeListView
+
 from .tool_bar import ToolBar
 
 from .zoom_widget import ZoomWidget
@@ -8,7 +8,17 @@ import os
 #from labelme impor
 sys.path.append('../')
 sys.path.append(os.getcwd())
+from rstools.pyramid import ImagePyramid
+from rstools.pyramid import RasterPyramid
 from rstools.shape import Shape
+from rstools.undo import AddShapes
+from rstools.undo import EditPoints
+from rstools.undo import MoveShapes
+from rstools.undo import RemoveShapes
+from rstools.undo import ReplaceShapes
+from rstools.undo import UndoStack
+from rstools.undo import move_items
+from rstools.utils import GridIndex
 #from rstools.shape import shape
 #import rstools.utils
 
@@ -31,6 +41,19 @@ class Canvas(QtWidgets.QWidget):
     newShape = QtCore.pyqtSignal()
     selectionChanged = QtCore.pyqtSignal(list)
     shapeMoved = QtCore.pyqtSignal()
+    shapesDeleted = QtCore.pyqtSignal()
+    shapesRestored = QtCore.pyqtSignal()
+    # Number of shapes appended to self.shapes.
+    shapesAppended = QtCore.pyqtSignal(int)
+    # Ascending positions of the shapes removed from self.shapes (before
+    # the removal), inserted into it (after the insertion) or relabeled.
+    shapesRemoved = QtCore.pyqtSignal(list)
+    shapesInserted = QtCore.pyqtSignal(list)
+    shapesRelabeled = QtCore.pyqtSignal(list)
+    # Shapes moved in self.shapes, see rstools.undo.move_items.
+    shapesMoved = QtCore.pyqtSignal(list, list)
+    # self.shapes replaced as a whole.
+    shapesChanged = QtCore.pyqtSignal()
     drawingPolygon = QtCore.pyqtSignal(bool)
     edgeSelected = QtCore.pyqtSignal(bool)
 
@@ -41,13 +64,25 @@ class Canvas(QtWidgets.QWidget):
 
     _fill_drawing = False
 
+    # Shapes smaller than this many screen pixels are drawn without vertex
+    # markers and with a simplified outline.
+    lod_size = 24
+
     def __init__(self, *args, **kwargs):
         self.epsilon = kwargs.pop('epsilon', 10.0)
+        self.history = UndoStack(
+            depth=kwargs.pop('undo_depth', 10),
+            max_bytes=kwargs.pop('undo_max_bytes', 64 * 1024 * 1024),
+        )
         super(Canvas, self).__init__(*args, **kwargs)
         # Initialise local state.
         self.mode = self.EDIT
         self.shapes = []
-        self.shapesBackups = []
+        self.shapeIndex = GridIndex()
+        # Points of the shapes being dragged, as they were before the drag.
+        self.movedPoints = {}
+        # rstools.journal.Journal recording the edits, if any.
+        self.journal = None
         self.current = None
         self.selectedShapes = []  # save the selected shapes here
         self.selectedShapesCopy = []
@@ -62,7 +97,7 @@ class Canvas(QtWidgets.QWidget):
         self.prevMovePoint = QtCore.QPoint()
         self.offsets = QtCore.QPoint(), QtCore.QPoint()
         self.scale = 1.0
-        self.pixmap = QtGui.QPixmap()
+        self.pyramid = None
         self.visible = {}
         self._hideBackround = False
         self.hideBackround = False
@@ -97,30 +132,19 @@ class Canvas(QtWidgets.QWidget):
             raise ValueError('Unsupported createMode: %s' % value)
         self._createMode = value
 
-    def storeShapes(self):
-        shapesBackup = []
-        for shape in self.shapes:
-            shapesBackup.append(shape.copy())
-        if len(self.shapesBackups) >= 10:
-            self.shapesBackups = self.shapesBackups[-9:]
-        self.shapesBackups.append(shapesBackup)
-
     @property
     def isShapeRestorable(self):
-        if len(self.shapesBackups) < 2:
-            return False
-        return True
+        return bool(self.history)
 
     def restoreShape(self):
         if not self.isShapeRestorable:
             return
-        self.shapesBackups.pop()  # latest
-        shapesBackup = self.shapesBackups.pop()
-        self.shapes = shapesBackup
+        self.history.undo(self)
         self.selectedShapes = []
         for shape in self.shapes:
             shape.selected = False
         self.repaint()
+        self.shapesRestored.emit()
 
     def enterEvent(self, ev):
         self.overrideCursor(self._cursor)
@@ -225,11 +249,13 @@ class Canvas(QtWidgets.QWidget):
         self.movingShape = False
         if QtCore.Qt.LeftButton & ev.buttons():
             if self.selectedVertex():
+                self.recordPoints([self.hShape])
                 self.boundedMoveVertex(pos)
                 self.repaint()
                 self.movingShape = True
             elif self.selectedShapes and self.prevPoint:
                 self.overrideCursor(CURSOR_MOVE)
+                self.recordPoints(self.selectedShapes)
                 self.boundedMoveShapes(self.selectedShapes, pos)
                 self.repaint()
                 self.movingShape = True
@@ -240,11 +266,12 @@ class Canvas(QtWidgets.QWidget):
         # - Highlight vertex
         # Update shape/vertex fill and tooltip value accordingly.
         self.setToolTip("Image")
-        for shape in reversed([s for s in self.shapes if self.isVisible(s)]):
+        epsilon = self.epsilon / self.scale
+        for shape in reversed(self.shapesNear(pos, epsilon)):
             # Look for a nearby vertex to highlight. If that fails,
             # check if we happen to be inside a shape.
-            index = shape.nearestVertex(pos, self.epsilon / self.scale)
-            index_edge = shape.nearestEdge(pos, self.epsilon / self.scale)
+            index = shape.nearestVertex(pos, epsilon)
+            index_edge = shape.nearestEdge(pos, epsilon)
             if index is not None:
                 if self.selectedVertex():
                     self.hShape.highlightClear()
@@ -284,7 +311,10 @@ class Canvas(QtWidgets.QWidget):
         shape = self.hShape
         index = self.hEdge
         point = self.prevMovePoint
+        self.history.push(EditPoints({shape: shape.points}))
         shape.insertPoint(index, point)
+        self.reindexShapes([shape])
+        self.journalPoints([shape])
         shape.highlightVertex(index, shape.MOVE_VERTEX)
         self.hShape = shape
         self.hVertex = index
@@ -350,9 +380,18 @@ class Canvas(QtWidgets.QWidget):
         elif ev.button() == QtCore.Qt.LeftButton and self.selectedShapes:
             self.overrideCursor(CURSOR_GRAB)
         if self.movingShape:
-            self.storeShapes()
+            if self.movedPoints:
+                self.history.push(EditPoints(self.movedPoints))
+                self.journalPoints(list(self.movedPoints))
+                self.movedPoints = {}
             self.shapeMoved.emit()
 
+    def recordPoints(self, shapes):
+        """Remember the points of shapes about to be dragged, for undo."""
+        for shape in shapes:
+            if shape not in self.movedPoints:
+                self.movedPoints[shape] = list(shape.points)
+
     def endMove(self, copy):
         assert self.selectedShapes and self.selectedShapesCopy
         assert len(self.selectedShapesCopy) == len(self.selectedShapes)
@@ -361,14 +400,21 @@ class Canvas(QtWidgets.QWidget):
         if copy:
             for i, shape in enumerate(self.selectedShapesCopy):
                 self.shapes.append(shape)
+                self.indexShapes([shape])
                 self.selectedShapes[i].selected = False
                 self.selectedShapes[i] = shape
+            self.history.push(AddShapes(self.selectedShapesCopy))
+            self.journalAppended(self.selectedShapesCopy)
+            self.shapesAppended.emit(len(self.selectedShapesCopy))
         else:
+            self.history.push(EditPoints(
+                {s: s.points for s in self.selectedShapes}))
             for i, shape in enumerate(self.selectedShapesCopy):
                 self.selectedShapes[i].points = shape.points
+            self.reindexShapes(self.selectedShapes)
+            self.journalPoints(self.selectedShapes)
         self.selectedShapesCopy = []
         self.repaint()
-        self.storeShapes()
         return True
 
     def hideBackroundShapes(self, value):
@@ -403,8 +449,8 @@ class Canvas(QtWidgets.QWidget):
             index, shape = self.hVertex, self.hShape
             shape.highlightVertex(index, shape.MOVE_VERTEX)
         else:
-            for shape in reversed(self.shapes):
-                if self.isVisible(shape) and shape.containsPoint(point):
+            for shape in reversed(self.shapesNear(point)):
+                if shape.containsPoint(point):
                     self.calculateOffsets(shape, point)
                     self.setHiding()
                     if multiple_selection_mode:
@@ -422,7 +468,7 @@ class Canvas(QtWidgets.QWidget):
         y1 = rect.y() - point.y()
         x2 = (rect.x() + rect.width() - 1) - point.x()
         y2 = (rect.y() + rect.height() - 1) - point.y()
-        self.offsets = QtCore.QPoint(x1, y1), QtCore.QPoint(x2, y2)
+        self.offsets = QtCore.QPointF(x1, y1), QtCore.QPointF(x2, y2)
 
     def boundedMoveVertex(self, pos):
         index, shape = self.hVertex, self.hShape
@@ -430,17 +476,18 @@ class Canvas(QtWidgets.QWidget):
         if self.outOfPixmap(pos):
             pos = self.intersectionPoint(point, pos)
         shape.moveVertexBy(index, pos - point)
+        self.reindexShapes([shape])
 
     def boundedMoveShapes(self, shapes, pos):
         if self.outOfPixmap(pos):
             return False  # No need to move
         o1 = pos + self.offsets[0]
         if self.outOfPixmap(o1):
-            pos -= QtCore.QPoint(min(0, o1.x()), min(0, o1.y()))
+            pos -= QtCore.QPointF(min(0, o1.x()), min(0, o1.y()))
         o2 = pos + self.offsets[1]
         if self.outOfPixmap(o2):
-            pos += QtCore.QPoint(min(0, self.pixmap.width() - o2.x()),
-                                 min(0, self.pixmap.height() - o2.y()))
+            pos += QtCore.QPointF(min(0, self.pyramid.width() - o2.x()),
+                                  min(0, self.pyramid.height() - o2.y()))
         # XXX: The next line tracks the new position of the cursor
         # relative to the shape, but also results in making it
         # a bit "shaky" when nearing the border and allows it to
@@ -450,6 +497,7 @@ class Canvas(QtWidgets.QWidget):
         if dp:
             for shape in shapes:
                 shape.moveBy(dp)
+            self.reindexShapes(shapes)
             self.prevPoint = pos
             return True
         return False
@@ -463,12 +511,15 @@ class Canvas(QtWidgets.QWidget):
     def deleteSelected(self):
         deleted_shapes = []
         if self.selectedShapes:
-            for shape in self.selectedShapes:
-                self.shapes.remove(shape)
-                deleted_shapes.append(shape)
-            self.storeShapes()
+            indexed_shapes = list(zip(
+                self.shapePositions(self.selectedShapes),
+                self.selectedShapes))
+            self.removeShapes(self.selectedShapes)
+            deleted_shapes.extend(self.selectedShapes)
+            self.history.push(RemoveShapes(indexed_shapes))
             self.selectedShapes = []
             self.update()
+            self.shapesDeleted.emit()
         return deleted_shapes
 
     def copySelectedShapes(self):
@@ -482,14 +533,14 @@ class Canvas(QtWidgets.QWidget):
         # Try to move in one direction, and if it fails in another.
         # Give up if both fail.
         point = shapes[0][0]
-        offset = QtCore.QPoint(2.0, 2.0)
+        offset = QtCore.QPointF(2.0, 2.0)
         self.offsets = QtCore.QPoint(), QtCore.QPoint()
         self.prevPoint = point
         if not self.boundedMoveShapes(shapes, point - offset):
             self.boundedMoveShapes(shapes, point + offset)
 
     def paintEvent(self, event):
-        if not self.pixmap:
+        if not self.pyramid:
             return super(Canvas, self).paintEvent(event)
 
         p = self._painter
@@ -501,13 +552,26 @@ class Canvas(QtWidgets.QWidget):
         p.scale(self.scale, self.scale)
         p.translate(self.offsetToCenter())
 
-        p.drawPixmap(0, 0, self.pixmap)
+        rect = self.visibleImageRect(event.rect())
+        self.pyramid.paint(p, rect, self.scale)
         Shape.scale = self.scale
-        for shape in self.shapes:
+        # Only shapes overlapping the exposed area, in stacking order.  The
+        # index holds the bare outlines: widen the area by the vertex
+        # markers and pen around them, or these would not be repainted.
+        m = Shape.paintMargin()
+        box = (rect.left() - m, rect.top() - m,
+               rect.right() + m, rect.bottom() + m)
+        for shape in self.shapeIndex.query(box):
             if (shape.selected or not self._hideBackround) and \
                     self.isVisible(shape):
                 shape.fill = shape.selected or shape == self.hShape
-                shape.paint(p)
+                bounds = shape.boundingRect()
+                size = max(bounds.width(), bounds.height()) * self.scale
+                if shape.fill or shape.shape_type == 'point' or \
+                        size >= self.lod_size:
+                    shape.paint(p)
+                else:
+                    shape.paintSimplified(p)
         if self.current:
             self.current.paint(p)
             self.line.paint(p)
@@ -525,6 +589,13 @@ class Canvas(QtWidgets.QWidget):
 
         p.end()
 
+    def visibleImageRect(self, rect):
+        """Map a widget rectangle to the image area it shows."""
+        top_left = self.transformPos(QtCore.QPointF(rect.topLeft()))
+        return QtCore.QRectF(top_left.x(), top_left.y(),
+                             rect.width() / self.scale,
+                             rect.height() / self.scale)
+
     def transformPos(self, point):
         """Convert from widget-logical coordinates to painter-logical ones."""
         return point / self.scale - self.offsetToCenter()
@@ -532,21 +603,24 @@ class Canvas(QtWidgets.QWidget):
     def offsetToCenter(self):
         s = self.scale
         area = super(Canvas, self).size()
-        w, h = self.pixmap.width() * s, self.pixmap.height() * s
+        w, h = self.pyramid.width() * s, self.pyramid.height() * s
         aw, ah = area.width(), area.height()
         x = (aw - w) / (2 * s) if aw > w else 0
         y = (ah - h) / (2 * s) if ah > h else 0
-        return QtCore.QPoint(x, y)
+        return QtCore.QPointF(x, y)
 
     def outOfPixmap(self, p):
-        w, h = self.pixmap.width(), self.pixmap.height()
+        w, h = self.pyramid.width(), self.pyramid.height()
         return not (0 <= p.x() < w and 0 <= p.y() < h)
 
     def finalise(self):
         assert self.current
         self.current.close()
         self.shapes.append(self.current)
-        self.storeShapes()
+        self.indexShapes([self.current])
+        self.history.push(AddShapes([self.current]))
+        self.journalAppended([self.current])
+        self.shapesAppended.emit(1)
         self.current = None
         self.setHiding(False)
         self.newShape.emit()
@@ -563,7 +637,7 @@ class Canvas(QtWidgets.QWidget):
         # Cycle through each image edge in clockwise fashion,
         # and find the one intersecting the current line segment.
         # http://paulbourke.net/geometry/lineline2d/
-        size = self.pixmap.size()
+        size = self.pyramid.size()
         points = [(0, 0),
                   (size.width() - 1, 0),
                   (size.width() - 1, size.height() - 1),
@@ -616,8 +690,8 @@ class Canvas(QtWidgets.QWidget):
         return self.minimumSizeHint()
 
     def minimumSizeHint(self):
-        if self.pixmap:
-            return self.scale * self.pixmap.size()
+        if self.pyramid:
+            return self.scale * self.pyramid.size()
         return super(Canvas, self).minimumSizeHint()
 
     def wheelEvent(self, ev):
@@ -670,15 +744,26 @@ class Canvas(QtWidgets.QWidget):
 
     def setLastLabel(self, text, flags):
         assert text
+        # The label belongs to the shape just added, whose AddShapes entry
+        # already refers to it, so the history needs no new entry.
         self.shapes[-1].label = text
         self.shapes[-1].flags = flags
-        self.shapesBackups.pop()
-        self.storeShapes()
+        if self.journal is not None:
+            self.journal.label(len(self.shapes) - 1, text, flags)
+        self.shapesRelabeled.emit([len(self.shapes) - 1])
         return self.shapes[-1]
 
     def undoLastLine(self):
         assert self.shapes
         self.current = self.shapes.pop()
+        self.shapeIndex.remove(self.current)
+        if self.journal is not None:
+            self.journal.remove(len(self.shapes))
+        self.shapesRemoved.emit([len(self.shapes)])
+        top = self.history.top()
+        if isinstance(top, AddShapes) and top.shapes == [self.current]:
+            # The shape goes back to being drawn, so adding it is undone.
+            self.history.pop()
         self.current.setOpen()
         if self.createMode in ['polygon', 'linestrip']:
             self.line.points = [self.current[-1], self.current[0]]
@@ -700,19 +785,213 @@ class Canvas(QtWidgets.QWidget):
         self.repaint()
 
     def loadPixmap(self, pixmap):
-        self.pixmap = pixmap
+        self.loadImage(pixmap.toImage())
+
+    def setImage(self, image, size=None):
+        """Show `image`, stretched to `size` if it is a reduced preview.
+
+        Shapes and history are kept, e.g. to swap a preview for the full
+        resolution image.
+        """
+        self.pyramid = ImagePyramid(image, size=size)
+        self.update()
+
+    def loadImage(self, image, size=None):
+        self.loadPyramid(ImagePyramid(image, size=size))
+
+    def loadRaster(self, reader, bands=None, stretch=None):
+        """Show a raster reader, reading only the tiles being painted."""
+        self.loadPyramid(RasterPyramid(reader, bands, stretch))
+
+    def setRasterDisplay(self, bands=None, stretch=None):
+        """Change the band combination and stretch of a raster."""
+        if isinstance(self.pyramid, RasterPyramid) and \
+                self.pyramid.setDisplay(bands, stretch):
+            self.update()
+
+    def loadPyramid(self, pyramid):
+        self.pyramid = pyramid
         self.shapes = []
+        self.shapeIndex.clear()
+        self.history.clear()
+        self.shapesChanged.emit()
         self.repaint()
 
+    def shapeBox(self, shape):
+        rect = shape.boundingRect()
+        return rect.left(), rect.top(), rect.right(), rect.bottom()
+
+    def reindexShapes(self, shapes):
+        """Refresh the spatial index entries of moved or edited shapes."""
+        for shape in shapes:
+            if shape in self.shapeIndex:
+                self.shapeIndex.update(shape, self.shapeBox(shape))
+
+    def indexShapes(self, shapes):
+        """Add shapes appended to `self.shapes` to the spatial index."""
+        for shape in shapes:
+            self.shapeIndex.insert(shape, self.shapeBox(shape))
+
+    def rebuildShapeIndex(self):
+        self.shapeIndex.clear()
+        self.indexShapes(self.shapes)
+
+    def shapesNear(self, point, radius=0):
+        """Visible shapes whose bounds are within `radius` of `point`.
+
+        They are returned in stacking order, like `self.shapes`.
+        """
+        box = (point.x() - radius, point.y() - radius,
+               point.x() + radius, point.y() + radius)
+        return [s for s in self.shapeIndex.query(box) if self.isVisible(s)]
+
+    def removeShapes(self, shapes):
+        positions = set(self.shapePositions(shapes))
+        if self.journal is not None:
+            # From the end, so that each position is still valid.
+            for index in sorted(positions, reverse=True):
+                self.journal.remove(index)
+        self.shapes = [s for i, s in enumerate(self.shapes)
+                       if i not in positions]
+        for shape in shapes:
+            self.shapeIndex.remove(shape)
+        self.shapesRemoved.emit(sorted(positions))
+
+    def insertShapes(self, indexed_shapes):
+        """Put shapes back at their positions, sorted by position."""
+        for index, shape in indexed_shapes:
+            self.shapes.insert(index, shape)
+            if self.journal is not None:
+                self.journal.add(index, shape.toAnnotation().to_dict())
+        positions = [index for index, _ in indexed_shapes]
+        self.indexShapes([shape for _, shape in indexed_shapes])
+        # Back in the middle of the stacking order, not on top.
+        self.reorderShapeIndex(positions)
+        self.shapesInserted.emit(positions)
+
+    def reorderShapes(self, source, target):
+        """Move the shapes at positions `source` to `target`, undoably."""
+        self.history.push(MoveShapes(source, target))
+        self.moveShapesTo(source, target)
+
+    def moveShapesTo(self, source, target):
+        """Move the shapes at positions `source` to positions `target`.
+
+        See `rstools.undo.move_items`.  Only the moved shapes change in
+        the spatial index and the journal, whatever the number of shapes.
+        """
+        self.shapes = move_items(self.shapes, source, target)
+        self.reorderShapeIndex(target)
+        if self.journal is not None:
+            self.journal.move(list(source), list(target))
+        self.shapesMoved.emit(list(source), list(target))
+
+    def reorderShapeIndex(self, positions):
+        """Stacking order in the index of the shapes moved to `positions`.
+
+        Each run of consecutive positions is given orders evenly spaced
+        between those of the shapes around it, which did not move.
+        """
+        index = self.shapeIndex
+        shapes = self.shapes
+        positions = sorted(positions)
+        runs = []
+        for i in positions:
+            if runs and runs[-1][1] == i - 1:
+                runs[-1][1] = i
+            else:
+                runs.append([i, i])
+        for start, end in runs:
+            count = end - start + 1
+            before = index.order(shapes[start - 1]) if start > 0 else None
+            after = index.order(shapes[end + 1]) \
+                if end + 1 < len(shapes) else None
+            if before is None and after is None:
+                self.rebuildShapeIndex()
+                return
+            if before is None:
+                before = after - count - 1
+            if after is None:
+                after = before + count + 1
+            step = (after - before) / float(count + 1)
+            orders = [before + step * (k + 1) for k in range(count)]
+            bounds = [before] + orders + [after]
+            if any(a >= b for a, b in zip(bounds, bounds[1:])):
+                # Out of float precision after many moves in one place.
+                self.rebuildShapeIndex()
+                return
+            for k, order in enumerate(orders):
+                index.setOrder(shapes[start + k], order)
+
+    def setShapePoints(self, shape, points):
+        shape.points = list(points)
+        self.reindexShapes([shape])
+        self.journalPoints([shape])
+
+    def replaceShapes(self, shapes):
+        self.shapes = list(shapes)
+        self.rebuildShapeIndex()
+        if self.journal is not None:
+            self.journal.replace(
+                [s.toAnnotation().to_dict() for s in self.shapes])
+        self.shapesChanged.emit()
+
+    def journalAppended(self, shapes):
+        """Record shapes just appended to `self.shapes` in the journal."""
+        if self.journal is None:
+            return
+        start = len(self.shapes) - len(shapes)
+        for i, shape in enumerate(shapes):
+            self.journal.add(start + i, shape.toAnnotation().to_dict())
+
+    def shapePositions(self, shapes):
+        """Positions of `shapes` in `self.shapes`, in one pass for many."""
+        if len(shapes) == 1:
+            return [self.shapes.index(shapes[0])]
+        positions = {id(s): i for i, s in enumerate(self.shapes)}
+        return [positions[id(s)] for s in shapes]
+
+    def journalPoints(self, shapes):
+        """Record the new points of edited shapes in the journal."""
+        if self.journal is None:
+            return
+        for index, shape in zip(self.shapePositions(shapes), shapes):
+            self.journal.points(index, shape.pointArray().tolist())
+
     def loadShapes(self, shapes, replace=True):
         if replace:
-            self.shapes = list(shapes)
+            if self.shapes:
+                self.history.push(ReplaceShapes(self.shapes))
+            self.replaceShapes(shapes)
         else:
+            shapes = list(shapes)
             self.shapes.extend(shapes)
-        self.storeShapes()
+            self.indexShapes(shapes)
+            self.history.push(AddShapes(shapes))
+            self.journalAppended(shapes)
+            self.shapesAppended.emit(len(shapes))
         self.current = None
         self.repaint()
 
+    def appendShapes(self, shapes):
+        """Add shapes read from a label file, without an undo step.
+
+        Used to show a large label file progressively, in batches.
+        """
+        shapes = list(shapes)
+        self.shapes.extend(shapes)
+        self.indexShapes(shapes)
+        self.shapesAppended.emit(len(shapes))
+        self.update()
+
+    def loadAnnotations(self, annotations, replace=True):
+        """Show Qt-free annotations, see `rstools.annotation`."""
+        self.loadShapes(
+            [Shape.fromAnnotation(a) for a in annotations], replace=replace)
+
+    def annotations(self):
+        return [shape.toAnnotation() for shape in self.shapes]
+
     def setShapeVisible(self, shape, value):
         self.visible[shape] = value
         self.repaint()
@@ -727,6 +1006,6 @@ class Canvas(QtWidgets.QWidget):
 
     def resetState(self):
         self.restoreCursor()
-        self.pixmap = None
-        self.shapesBackups = []
+        self.pyramid = None
+        self.history.clear()
         self.update()
@@ -6,22 +6,71 @@ class LabelQListWidget(QtWidgets.QListWidget):
     def __init__(self, *args, **kwargs):
         super(LabelQListWidget, self).__init__(*args, **kwargs)
         self.canvas = None
-        self.itemsToShapes = []
+        # Both ways between items and shapes.  Items are keyed by id(): the
+        # item is kept alive by the other map, so its id stays unique.
+        self._itemShapes = {}
+        self._shapeItems = {}
         self.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        # Rows are laid out without measuring every item.
+        self.setUniformItemSizes(True)
+
+    @property
+    def itemsToShapes(self):
+        """(item, shape) pairs in row order."""
+        return [(self.item(i), shape)
+                for i, shape in enumerate(self.shapes)]
 
     def get_shape_from_item(self, item):
-        for index, (item_, shape) in enumerate(self.itemsToShapes):
-            if item_ is item:
-                return shape
+        return self._itemShapes.get(id(item))
 
     def get_item_from_shape(self, shape):
-        for index, (item, shape_) in enumerate(self.itemsToShapes):
-            if shape_ is shape:
-                return item
+        return self._shapeItems.get(shape)
+
+    def add_shape_item(self, item, shape):
+        """Append an item standing for a shape."""
+        self.addItem(item)
+        self._itemShapes[id(item)] = shape
+        self._shapeItems[shape] = item
+
+    def remove_shape_item(self, item):
+        self.remove_shape_items([item])
+
+    def add_shape_items(self, items_shapes):
+        """Append (item, shape) pairs, repainting once at the end."""
+        self.setUpdatesEnabled(False)
+        try:
+            for item, shape in items_shapes:
+                self.add_shape_item(item, shape)
+        finally:
+            self.setUpdatesEnabled(True)
+
+    def remove_shape_items(self, items):
+        """Remove items, repainting once at the end."""
+        shapes = [self._itemShapes.pop(id(item), None) for item in items]
+        for shape in shapes:
+            self._shapeItems.pop(shape, None)
+        removed = set(id(item) for item in items)
+        # One pass over the rows: looking up the row of each item would
+        # scan the list for every one of them.
+        rows = [i for i in range(self.count())
+                if id(self.item(i)) in removed]
+        self.setUpdatesEnabled(False)
+        try:
+            for row in reversed(rows):
+                self.takeItem(row)
+        finally:
+            self.setUpdatesEnabled(True)
+
+    def remove_shapes(self, shapes):
+        """Remove the items of shapes, e.g. deleted on the canvas."""
+        items = [self._shapeItems[shape] for shape in shapes
+                 if shape in self._shapeItems]
+        self.remove_shape_items(items)
 
     def clear(self):
         super(LabelQListWidget, self).clear()
-        self.itemsToShapes = []
+        self._itemShapes = {}
+        self._shapeItems = {}
 
     def setParent(self, parent):
         self.parent = parent
@@ -38,9 +87,6 @@ class LabelQListWidget(QtWidgets.QListWidget):
 
     @property
     def shapes(self):
-        shapes = []
-        for i in range(self.count()):
-            item = self.item(i)
-            shape = self.get_shape_from_item(item)
-            shapes.append(shape)
-        return shapes
+        item_shapes = self._itemShapes
+        return [item_shapes.get(id(self.item(i)))
+                for i in range(self.count())]
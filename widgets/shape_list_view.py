@@ -0,0 +1,305 @@
+import bisect
+
+from PyQt5 import QtCore
+from PyQt5 import QtWidgets
+
+
+def _runs(positions):
+    """[first, last] of each run of consecutive ascending positions."""
+    runs = []
+    for i in positions:
+        if runs and runs[-1][1] == i - 1:
+            runs[-1][1] = i
+        else:
+            runs.append([i, i])
+    return runs
+
+
+class ShapeListModel(QtCore.QAbstractListModel):
+
+    """Rows over `canvas.shapes`, without an item per shape.
+
+    Data is read from the shapes when the view asks for it, i.e. only for
+    the rows on screen.  Without a filter, row i is shape i of the canvas;
+    with a label filter, `_rows` holds the canvas index of each row.
+    The number of rows is kept apart: the view asks for it for every row
+    it lays out, and it must only change along with the notifications.
+    Edits of the canvas update the rows they touch, so that they cost
+    little whatever the number of shapes and keep the selection; only
+    replacing all the shapes or changing the filter resets the model.
+    """
+
+    MIME_TYPE = 'application/x-rstools-shape-rows'
+
+    def __init__(self, canvas, parent=None):
+        super(ShapeListModel, self).__init__(parent)
+        self.canvas = canvas
+        self._filter = None
+        self._rows = None
+        self._count = len(canvas.shapes)
+        canvas.shapesAppended.connect(self.shapesAppended)
+        canvas.shapesRemoved.connect(self.shapesRemoved)
+        canvas.shapesInserted.connect(self.shapesInserted)
+        canvas.shapesMoved.connect(self.shapesMoved)
+        canvas.shapesRelabeled.connect(self.shapesRelabeled)
+        canvas.shapesChanged.connect(self.shapesChanged)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self._count
+
+    def shapeIndex(self, row):
+        """Index in `canvas.shapes` of a row."""
+        return row if self._rows is None else self._rows[row]
+
+    def _row(self, i):
+        # Row of shape i of the canvas with a filter, None if not shown.
+        row = bisect.bisect_left(self._rows, i)
+        if row < len(self._rows) and self._rows[row] == i:
+            return row
+        return None
+
+    def shape(self, row):
+        return self.canvas.shapes[self.shapeIndex(row)]
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        shape = self.shape(index.row())
+        if role == QtCore.Qt.DisplayRole:
+            return shape.label
+        if role == QtCore.Qt.CheckStateRole:
+            if self.canvas.isVisible(shape):
+                return QtCore.Qt.Checked
+            return QtCore.Qt.Unchecked
+        if role == QtCore.Qt.UserRole:
+            return shape
+        return None
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        if not index.isValid() or role != QtCore.Qt.CheckStateRole:
+            return False
+        self.canvas.setShapeVisible(self.shape(index.row()),
+                                    value == QtCore.Qt.Checked)
+        self.dataChanged.emit(index, index, [role])
+        return True
+
+    def flags(self, index):
+        if not index.isValid():
+            # Dropping between rows.
+            return QtCore.Qt.ItemIsDropEnabled
+        return (QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable |
+                QtCore.Qt.ItemIsUserCheckable | QtCore.Qt.ItemIsDragEnabled)
+
+    def supportedDropActions(self):
+        return QtCore.Qt.MoveAction
+
+    def mimeTypes(self):
+        return [self.MIME_TYPE]
+
+    def mimeData(self, indexes):
+        data = QtCore.QMimeData()
+        rows = sorted(set(index.row() for index in indexes))
+        data.setData(self.MIME_TYPE,
+                     ','.join(str(row) for row in rows).encode())
+        return data
+
+    def setFilter(self, label=None):
+        """Only show the shapes with this label, all of them with None."""
+        self._filter = label
+        self.shapesChanged()
+
+    def filter(self):
+        return self._filter
+
+    def shapesAppended(self, count):
+        """`count` shapes were appended to `canvas.shapes`."""
+        shapes = self.canvas.shapes
+        if self._rows is None:
+            start = len(shapes) - count
+        else:
+            start = len(self._rows)
+            rows = [i for i in range(len(shapes) - count, len(shapes))
+                    if shapes[i].label == self._filter]
+            count = len(rows)
+        if not count:
+            return
+        # One insertion for the whole batch, not one per shape.
+        self.beginInsertRows(QtCore.QModelIndex(), start, start + count - 1)
+        if self._rows is not None:
+            self._rows.extend(rows)
+        self._count += count
+        self.endInsertRows()
+
+    def shapesRemoved(self, positions):
+        """Shapes at ascending `positions` were removed from the canvas."""
+        if self._rows is None:
+            rows = positions
+        else:
+            rows = [self._row(i) for i in positions]
+            rows = [r for r in rows if r is not None]
+            # Shapes after a removed one moved up in the canvas.
+            self._rows = [i - bisect.bisect_left(positions, i)
+                          for i in self._rows]
+        # From the end, so that each row is still valid.
+        for first, last in reversed(_runs(rows)):
+            self.beginRemoveRows(QtCore.QModelIndex(), first, last)
+            if self._rows is not None:
+                del self._rows[first:last + 1]
+            self._count -= last - first + 1
+            self.endRemoveRows()
+
+    def shapesInserted(self, positions):
+        """Shapes were inserted at ascending `positions` of the canvas."""
+        if self._rows is None:
+            rows = positions
+        else:
+            # Shape i of the canvas moved down by the number of shapes
+            # inserted before it, i.e. the m-th one at a position p with
+            # p - m <= i.
+            before = [p - m for m, p in enumerate(positions)]
+            self._rows = [i + bisect.bisect_right(before, i)
+                          for i in self._rows]
+            shapes = self.canvas.shapes
+            positions = [i for i in positions
+                         if shapes[i].label == self._filter]
+            rows = [bisect.bisect_left(self._rows, i) + k
+                    for k, i in enumerate(positions)]
+        start = 0
+        for first, last in _runs(rows):
+            self.beginInsertRows(QtCore.QModelIndex(), first, last)
+            if self._rows is not None:
+                count = last - first + 1
+                self._rows[first:first] = positions[start:start + count]
+                start += count
+            self._count += last - first + 1
+            self.endInsertRows()
+
+    def shapesMoved(self, source, target):
+        """Shapes of the canvas were moved from `source` to `target`."""
+        pairs = sorted(zip(source, target))
+        first, dest = pairs[0]
+        count = len(pairs)
+        block = all(s == first + k and t == dest + k
+                    for k, (s, t) in enumerate(pairs))
+        if self._rows is None and block:
+            if first == dest:
+                return
+            # Qt counts the destination row before the move.
+            row = dest if dest < first else dest + count
+            if self.beginMoveRows(QtCore.QModelIndex(), first,
+                                  first + count - 1, QtCore.QModelIndex(),
+                                  row):
+                self.endMoveRows()
+                return
+        self.shapesRemoved(sorted(source))
+        self.shapesInserted(sorted(target))
+
+    def shapesRelabeled(self, positions):
+        """Shapes at ascending `positions` of the canvas were relabeled."""
+        if self._rows is None:
+            for first, last in _runs(positions):
+                self.dataChanged.emit(self.index(first), self.index(last),
+                                      [QtCore.Qt.DisplayRole])
+            return
+        shapes = self.canvas.shapes
+        for i in positions:
+            row = bisect.bisect_left(self._rows, i)
+            shown = self._row(i) is not None
+            wanted = shapes[i].label == self._filter
+            if shown and not wanted:
+                self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+                del self._rows[row]
+                self._count -= 1
+                self.endRemoveRows()
+            elif wanted and not shown:
+                self.beginInsertRows(QtCore.QModelIndex(), row, row)
+                self._rows.insert(row, i)
+                self._count += 1
+                self.endInsertRows()
+
+    def shapesChanged(self):
+        """All the shapes were replaced, or the filter changed."""
+        self.beginResetModel()
+        if self._filter is None:
+            self._rows = None
+            self._count = len(self.canvas.shapes)
+        else:
+            self._rows = [i for i, shape in enumerate(self.canvas.shapes)
+                          if shape.label == self._filter]
+            self._count = len(self._rows)
+        self.endResetModel()
+
+    def moveShapes(self, rows, row):
+        """Move the shapes of `rows` before the shape of `row`.
+
+        The canvas order changes accordingly, as one undoable step.
+        Returns the new rows of the moved shapes.
+        """
+        shapes = self.canvas.shapes
+        moved = [self.shapeIndex(r) for r in rows]
+        if row < self.rowCount():
+            target = self.shapeIndex(row)
+        else:
+            target = len(shapes)
+        # In the list without the moved shapes, they go before the target.
+        position = target - sum(1 for i in moved if i < target)
+        positions = list(range(position, position + len(moved)))
+        if positions == moved:
+            return list(rows)
+        self.canvas.reorderShapes(moved, positions)
+        # Rows before the target that were not moved stay in place.
+        first = row - sum(1 for r in rows if r < row)
+        return list(range(first, first + len(rows)))
+
+
+class ShapeListView(QtWidgets.QListView):
+
+    """List of the shapes of a canvas, reordered by drag and drop."""
+
+    # The order of the shapes was changed by dragging rows.
+    shapesReordered = QtCore.pyqtSignal()
+
+    def __init__(self, canvas, parent=None):
+        super(ShapeListView, self).__init__(parent)
+        self.canvas = canvas
+        self.setModel(ShapeListModel(canvas, self))
+        self.setSelectionMode(QtWidgets.QAbstractItemView.ExtendedSelection)
+        self.setDragDropMode(QtWidgets.QAbstractItemView.InternalMove)
+        # Rows are laid out without asking for the size of each one.
+        self.setUniformItemSizes(True)
+
+    def setFilter(self, label=None):
+        self.model().setFilter(label)
+
+    def selectedShapes(self):
+        model = self.model()
+        return [model.shape(index.row())
+                for index in self.selectionModel().selectedRows()]
+
+    def dropEvent(self, event):
+        if event.source() is not self:
+            event.ignore()
+            return
+        index = self.indexAt(event.pos())
+        if not index.isValid():
+            row = self.model().rowCount()
+        elif self.dropIndicatorPosition() == self.BelowItem:
+            row = index.row() + 1
+        else:
+            row = index.row()
+        rows = sorted(index.row()
+                      for index in self.selectionModel().selectedRows())
+        if not rows:
+            event.ignore()
+            return
+        rows = self.model().moveShapes(rows, row)
+        selection = QtCore.QItemSelection(
+            self.model().index(rows[0]), self.model().index(rows[-1]))
+        self.selectionModel().select(
+            selection, QtCore.QItemSelectionModel.ClearAndSelect)
+        # Moved here already, the drag must not remove the source rows.
+        event.setDropAction(QtCore.Qt.CopyAction)
+        event.accept()
+        self.shapesReordered.emit()